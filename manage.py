@@ -24,40 +24,226 @@ manager = Manager(setup_app)
 manager.add_option('-c', '--config', dest='config')
 
 
-@manager.command
-def gather_siteinfo():
+@manager.option('-w', '--workers', dest='workers', type=int,
+                help="Concurrent requests (HARVEST_WORKERS)")
+@manager.option('--connect-timeout', dest='connect_timeout', type=float,
+                help="Seconds to wait for a connection to each site")
+@manager.option('--read-timeout', dest='read_timeout', type=float,
+                help="Seconds to wait for each site's siteinfo")
+@manager.option('--deadline', dest='deadline', type=int,
+                help="Seconds the whole harvest may take (HARVEST_DEADLINE)")
+@manager.option('-f', '--full', dest='full', action='store_true',
+                help="Harvest every site, not only those that are due")
+def gather_siteinfo(workers=None, connect_timeout=None, read_timeout=None,
+                    deadline=None, full=False):
     """
     Gather SiteInfo
 
     This is a nice management wrapper to the util method that grabs moodle
-    sitedata from the orvsd_siteinfo webservice plugin for all sites in
-    orvsd_central's database
+    sitedata from the orvsd_siteinfo webservice plugin for the sites in
+    orvsd_central's database whose next harvest is due, or all of them with
+    --full. Sites are requested concurrently and a summary of the run is
+    printed at the end, after a new report snapshot is built. Old site
+    details are thinned out afterwards if RETENTION_AFTER_HARVEST is set.
     """
 
     with current_app.app_context():
-        from orvsd_central.models import Site
-        from orvsd_central.util import gather_siteinfo
+        from orvsd_central.harvest import get_harvest_sites, harvest_siteinfo
+        from orvsd_central.retention import prune_site_details
+        from orvsd_central.snapshot import build_report_snapshot
+        from orvsd_central.util import moodle_timeout
         g.db_session = create_db_session()
 
-        for site in Site.query.all():
-            gather_siteinfo(site)
+        default_connect, default_read = moodle_timeout()
+        timeout = (connect_timeout or default_connect,
+                   read_timeout or default_read)
+
+        summary = harvest_siteinfo(get_harvest_sites(full), workers=workers,
+                                   timeout=timeout, deadline=deadline)
+        build_report_snapshot()
+        print summary.report()
+
+        if current_app.config.get('RETENTION_AFTER_HARVEST', False):
+            print "Deleted %(deleted)d old site details" % prune_site_details()
+
+
+@manager.option('--full-days', dest='full_days', type=int,
+                help="Days all site details are kept (RETENTION_FULL_DAYS)")
+@manager.option('--daily-days', dest='daily_days', type=int,
+                help="Days one site detail per day is kept "
+                     "(RETENTION_DAILY_DAYS)")
+@manager.option('--chunk-size', dest='chunk_size', type=int,
+                help="Site details per delete (RETENTION_CHUNK_SIZE)")
+@manager.option('-n', '--dry-run', dest='dry_run', action='store_true',
+                help="Only count the site details that would be deleted")
+def prune_site_details(full_days=None, daily_days=None, chunk_size=None,
+                       dry_run=False):
+    """
+    Thins out old site details: all are kept for RETENTION_FULL_DAYS, then
+    each site's newest of every day until RETENTION_DAILY_DAYS, then its
+    newest of every week.
+    """
 
+    with current_app.app_context():
+        from orvsd_central import retention
+        g.db_session = create_db_session()
 
-@manager.command
-def gather_tokens():
+        counts = retention.prune_site_details(full_days, daily_days,
+                                              chunk_size, dry_run)
+        print "%s %d site details of %d sites" % (
+            "Would delete" if dry_run else "Deleted",
+            counts['deleted'], counts['sites']
+        )
+
+
+@manager.option('-d', '--days', dest='days', type=int,
+                help="Days install events are kept (INSTALL_EVENTS_DAYS)")
+def prune_install_events(days=None):
+    """
+    Deletes the progress events of course installs older than
+    INSTALL_EVENTS_DAYS.
+    """
+
+    with current_app.app_context():
+        from orvsd_central.progress import prune_install_events
+        g.db_session = create_db_session()
+
+        print "Deleted %d install events" % prune_install_events(days)
+
+
+@manager.option('-f', '--format', dest='fmt', default='csv',
+                choices=['csv', 'ndjson'], help="csv or ndjson")
+@manager.option('-o', '--output', dest='output',
+                help="File to write the report to, standard output if unset")
+@manager.option('--district', dest='district', type=int,
+                help="Only sites of this district id")
+@manager.option('--county', dest='county',
+                help="Only sites of schools in this county")
+@manager.option('--since', dest='since',
+                help="Newest siteinfo gathered at or after YYYY-MM-DD")
+@manager.option('--until', dest='until',
+                help="Newest siteinfo gathered before YYYY-MM-DD")
+def export_report(fmt='csv', output=None, district=None, county=None,
+                  since=None, until=None):
+    """
+    Writes the usage report, a row per site, as CSV or NDJSON. Rows are
+    written as they are read, so the whole report is never held in memory.
+    """
+
+    with current_app.app_context():
+        from datetime import datetime
+        from orvsd_central.export import REPORT_COLUMNS, iter_usage_report
+        from orvsd_central.serialize import csv_rows, ndjson
+        g.db_session = create_db_session()
+
+        since, until = [datetime.strptime(date, '%Y-%m-%d') if date else None
+                        for date in [since, until]]
+        rows = iter_usage_report(district, county, since, until)
+        if fmt == 'csv':
+            chunks = csv_rows(rows, REPORT_COLUMNS)
+        else:
+            chunks = ndjson(rows)
+
+        out = open(output, 'wb') if output else sys.stdout
+        try:
+            for chunk in chunks:
+                out.write(chunk)
+        finally:
+            if output:
+                out.close()
+
+
+@manager.option('-k', '--keep', dest='keep', type=int,
+                help="Snapshots to keep (REPORT_SNAPSHOTS_KEPT)")
+def snapshot_report(keep=None):
+    """
+    Builds a new report snapshot from the sites' newest siteinfo, as
+    gather_siteinfo does at the end of each run.
+    """
+
+    with current_app.app_context():
+        from orvsd_central.snapshot import build_report_snapshot
+        g.db_session = create_db_session()
+
+        snapshot = build_report_snapshot(keep)
+        print "Report snapshot %d: %d sites in %d districts" % (
+            snapshot.id, snapshot.sites, snapshot.districts
+        )
+
+
+@manager.option('--host', dest='host',
+                help="Only requeue installs to this host")
+def requeue_installs(host=None):
+    """
+    Queues the course installs that failed too many times, recorded in
+    install_dead_letters, again.
+    """
+
+    with current_app.app_context():
+        from orvsd_central.util import requeue_dead_installs
+        g.db_session = create_db_session()
+
+        batch_id, count = requeue_dead_installs(host)
+        if batch_id:
+            print "Requeued %d installs as batch %s" % (count, batch_id)
+        else:
+            print "No installs to requeue"
+
+
+@manager.option('-w', '--workers', dest='workers', type=int,
+                help="Concurrent sites (HARVEST_WORKERS)")
+@manager.option('--deadline', dest='deadline', type=int,
+                help="Seconds the whole run may take (HARVEST_DEADLINE)")
+def gather_tokens(workers=None, deadline=None):
     """
     For all sites added to ORVSD_Central's database and all services listed
     in the MOODLE_SERVICES config option, gather will gather all tokens for
-    each service of every site
+    each service of every site. Sites are requested concurrently and their
+    new tokens committed in batches.
     """
 
     with current_app.app_context():
+        from orvsd_central.harvest import harvest_tokens
         from orvsd_central.models import Site
-        from orvsd_central.util import gather_tokens
         g.db_session = create_db_session()
 
-        for site in Site.query.all():
-            gather_tokens(site)
+        summary = harvest_tokens(Site.query.all(), workers=workers,
+                                 deadline=deadline)
+        print summary.report()
+
+
+@manager.option('-w', '--workers', dest='workers', type=int,
+                help="Processes reading backups (COURSE_INGEST_WORKERS)")
+@manager.option('-b', '--batch-size', dest='batch_size', type=int,
+                help="Files per commit (COURSE_INGEST_BATCH_SIZE)")
+def update_courses(workers=None, batch_size=None):
+    """
+    Updates the course list from the course backups in
+    INSTALL_COURSE_FILE_PATH. Only files added or changed since the last
+    update are read, on a pool of processes.
+    """
+
+    with current_app.app_context():
+        from orvsd_central.catalog import ingest_workers, update_course_list
+        g.db_session = create_db_session()
+
+        base_path = current_app.config.get('INSTALL_COURSE_FILE_PATH', None)
+        if not base_path or not os.path.exists(base_path):
+            print "Invalid INSTALL_COURSE_FILE_PATH in your config"
+            return
+
+        def progress(done, total):
+            sys.stdout.write("\rRead %d/%d backups" % (done, total))
+            if done == total:
+                sys.stdout.write("\n")
+            sys.stdout.flush()
+
+        counts = update_course_list(base_path,
+                                    workers=ingest_workers(workers),
+                                    batch_size=batch_size, progress=progress)
+        print ("Files: %(added)d added, %(changed)d changed, %(removed)d "
+               "removed, %(failed)d unreadable. %(courses)d new courses."
+               % counts)
 
 
 @manager.option('-d', "--data", help="CSV to import of Districts and Schools")
@@ -0,0 +1,49 @@
+"""latest site detail pointer
+
+Revision ID: 1f3c9a7d2e84
+Revises: 506c416e8750
+Create Date: 2026-10-18 09:12:44.518302
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1f3c9a7d2e84'
+down_revision = '506c416e8750'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(engine_name):
+    eval("upgrade_%s" % engine_name)()
+
+
+def downgrade(engine_name):
+    eval("downgrade_%s" % engine_name)()
+
+
+def upgrade_engine1():
+    op.add_column(
+        'sites',
+        sa.Column('latest_site_detail_id', sa.Integer)
+    )
+
+    # Point every site at its newest site_details row
+    op.execute(
+        "UPDATE sites SET latest_site_detail_id = ("
+        "SELECT sd.id FROM site_details sd "
+        "WHERE sd.site_id = sites.id "
+        "ORDER BY sd.timemodified DESC, sd.id DESC LIMIT 1)"
+    )
+
+    op.create_foreign_key(
+        'fk_sites_latest_site_detail_id', 'sites', 'site_details',
+        ['latest_site_detail_id'], ['id']
+    )
+
+
+def downgrade_engine1():
+    op.drop_constraint(
+        'fk_sites_latest_site_detail_id', 'sites', type_='foreignkey'
+    )
+    op.drop_column('sites', 'latest_site_detail_id')
@@ -0,0 +1,44 @@
+"""add harvest schedules
+
+Revision ID: 3c5e8b1f6a90
+Revises: 1f3c9a7d2e84
+Create Date: 2026-10-18 11:40:03.266915
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3c5e8b1f6a90'
+down_revision = '1f3c9a7d2e84'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(engine_name):
+    eval("upgrade_%s" % engine_name)()
+
+
+def downgrade(engine_name):
+    eval("downgrade_%s" % engine_name)()
+
+
+def upgrade_engine1():
+    op.create_table(
+        'harvest_schedules',
+        sa.Column('site_id', sa.Integer,
+                  sa.ForeignKey('sites.id',
+                                name='fk_harvest_schedules_site_id'),
+                  primary_key=True),
+        sa.Column('interval', sa.Float),
+        sa.Column('next_harvest', sa.DateTime),
+        sa.Column('harvests', sa.Integer),
+        sa.Column('changes', sa.Integer),
+        sa.Column('last_changed', sa.DateTime)
+    )
+    op.create_index('ix_harvest_schedules_next_harvest', 'harvest_schedules',
+                    ['next_harvest'])
+
+
+def downgrade_engine1():
+    op.drop_index('ix_harvest_schedules_next_harvest')
+    op.drop_table('harvest_schedules')
@@ -0,0 +1,39 @@
+"""add course files manifest
+
+Revision ID: 4d2a6f0c9b17
+Revises: 3c5e8b1f6a90
+Create Date: 2026-10-18 13:05:51.730144
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4d2a6f0c9b17'
+down_revision = '3c5e8b1f6a90'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(engine_name):
+    eval("upgrade_%s" % engine_name)()
+
+
+def downgrade(engine_name):
+    eval("downgrade_%s" % engine_name)()
+
+
+def upgrade_engine1():
+    op.create_table(
+        'course_files',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('path', sa.String(1024)),
+        sa.Column('size', sa.BigInteger),
+        sa.Column('mtime', sa.Integer),
+        sa.Column('course_id', sa.Integer,
+                  sa.ForeignKey('courses.id',
+                                name='fk_course_files_course_id'))
+    )
+
+
+def downgrade_engine1():
+    op.drop_table('course_files')
@@ -0,0 +1,89 @@
+"""add report snapshots
+
+Revision ID: 5b7e2d4a1c36
+Revises: 4d2a6f0c9b17
+Create Date: 2026-10-18 15:21:08.402715
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5b7e2d4a1c36'
+down_revision = '4d2a6f0c9b17'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(engine_name):
+    eval("upgrade_%s" % engine_name)()
+
+
+def downgrade(engine_name):
+    eval("downgrade_%s" % engine_name)()
+
+
+def upgrade_engine1():
+    op.create_table(
+        'report_snapshots',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('created', sa.DateTime),
+        sa.Column('complete', sa.Boolean),
+        sa.Column('active_since', sa.DateTime),
+        sa.Column('districts', sa.Integer),
+        sa.Column('schools', sa.Integer),
+        sa.Column('sites', sa.Integer),
+        sa.Column('courses', sa.Integer),
+        sa.Column('admins', sa.Integer),
+        sa.Column('teachers', sa.Integer),
+        sa.Column('totalusers', sa.Integer),
+        sa.Column('activeusers', sa.Integer)
+    )
+    op.create_index('ix_report_snapshots_complete', 'report_snapshots',
+                    ['complete'])
+
+    op.create_table(
+        'report_snapshot_districts',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('snapshot_id', sa.Integer,
+                  sa.ForeignKey('report_snapshots.id')),
+        sa.Column('district_id', sa.Integer),
+        sa.Column('name', sa.String(255)),
+        sa.Column('shortname', sa.String(255)),
+        sa.Column('schools', sa.Integer),
+        sa.Column('sites', sa.Integer),
+        sa.Column('admins', sa.Integer),
+        sa.Column('teachers', sa.Integer),
+        sa.Column('totalusers', sa.Integer),
+        sa.Column('activeusers', sa.Integer)
+    )
+    op.create_index('ix_report_snapshot_districts_snapshot_district',
+                    'report_snapshot_districts',
+                    ['snapshot_id', 'district_id'])
+
+    op.create_table(
+        'report_snapshot_sites',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('snapshot_id', sa.Integer,
+                  sa.ForeignKey('report_snapshots.id')),
+        sa.Column('district_id', sa.Integer),
+        sa.Column('district_name', sa.String(255)),
+        sa.Column('district_shortname', sa.String(255)),
+        sa.Column('school_id', sa.Integer),
+        sa.Column('school_name', sa.String(255)),
+        sa.Column('site_id', sa.Integer),
+        sa.Column('site_name', sa.String(255)),
+        sa.Column('baseurl', sa.String(255)),
+        sa.Column('adminlist', sa.Text),
+        sa.Column('teachers', sa.Integer),
+        sa.Column('activeusers', sa.Integer),
+        sa.Column('totalusers', sa.Integer),
+        sa.Column('courses', sa.Integer)
+    )
+    op.create_index('ix_report_snapshot_sites_snapshot_district',
+                    'report_snapshot_sites', ['snapshot_id', 'district_id'])
+
+
+def downgrade_engine1():
+    op.drop_table('report_snapshot_sites')
+    op.drop_table('report_snapshot_districts')
+    op.drop_table('report_snapshots')
@@ -0,0 +1,89 @@
+"""add site detail courses
+
+Revision ID: 6a1d9c3e5f27
+Revises: 5b7e2d4a1c36
+Create Date: 2026-10-18 16:02:37.915220
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6a1d9c3e5f27'
+down_revision = '5b7e2d4a1c36'
+
+import json
+
+from alembic import op
+import sqlalchemy as sa
+
+# site_details rows read per batch while copying their courses
+BATCH_SIZE = 500
+
+
+def upgrade(engine_name):
+    eval("upgrade_%s" % engine_name)()
+
+
+def downgrade(engine_name):
+    eval("downgrade_%s" % engine_name)()
+
+
+def upgrade_engine1():
+    op.create_table(
+        'site_detail_courses',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('site_detail_id', sa.Integer,
+                  sa.ForeignKey('site_details.id',
+                                name='fk_site_detail_courses_site_detail_id'),
+                  nullable=False),
+        sa.Column('serial', sa.String(255)),
+        sa.Column('shortname', sa.String(255)),
+        sa.Column('fullname', sa.String(255)),
+        sa.Column('enrolled', sa.Integer)
+    )
+    op.create_index('ix_site_detail_courses_site_detail_enrolled',
+                    'site_detail_courses', ['site_detail_id', 'enrolled'])
+
+    # Copy the courses out of every site_details row's JSON
+    connection = op.get_bind()
+    site_details = sa.sql.table('site_details',
+                                sa.sql.column('id', sa.Integer),
+                                sa.sql.column('courses', sa.Text))
+    site_detail_courses = sa.sql.table(
+        'site_detail_courses',
+        sa.sql.column('site_detail_id', sa.Integer),
+        sa.sql.column('serial', sa.String),
+        sa.sql.column('shortname', sa.String),
+        sa.sql.column('fullname', sa.String),
+        sa.sql.column('enrolled', sa.Integer)
+    )
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            sa.select([site_details.c.id, site_details.c.courses]).where(
+                site_details.c.id > last_id
+            ).order_by(site_details.c.id).limit(BATCH_SIZE)
+        ).fetchall()
+        if not rows:
+            break
+
+        entries = []
+        for site_detail_id, courses in rows:
+            try:
+                courses = json.loads(courses) if courses else []
+            except ValueError:
+                courses = []
+            if not isinstance(courses, list):
+                continue
+            entries.extend({'site_detail_id': site_detail_id,
+                            'serial': course.get('serial'),
+                            'shortname': course.get('shortname'),
+                            'fullname': course.get('fullname'),
+                            'enrolled': course.get('enrolled')}
+                           for course in courses if isinstance(course, dict))
+        if entries:
+            connection.execute(site_detail_courses.insert(), entries)
+        last_id = rows[-1][0]
+
+
+def downgrade_engine1():
+    op.drop_table('site_detail_courses')
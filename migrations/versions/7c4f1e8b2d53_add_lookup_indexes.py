@@ -0,0 +1,49 @@
+"""add lookup indexes
+
+Revision ID: 7c4f1e8b2d53
+Revises: 6a1d9c3e5f27
+Create Date: 2026-10-18 16:48:19.604481
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7c4f1e8b2d53'
+down_revision = '6a1d9c3e5f27'
+
+from alembic import op
+import sqlalchemy as sa
+
+# name, table, columns and keyword arguments of each index. The courses
+# columns are TEXT, MySQL can only index their start.
+INDEXES = [
+    ('ix_site_details_site_id_timemodified', 'site_details',
+     ['site_id', 'timemodified'], {}),
+    ('ix_sites_baseurl', 'sites', ['baseurl'], {}),
+    ('ix_sites_school_id_sitetype', 'sites', ['school_id', 'sitetype'], {}),
+    ('ix_sites_sitetype', 'sites', ['sitetype'], {}),
+    ('ix_schools_district_id', 'schools', ['district_id'], {}),
+    ('ix_courses_source_filename', 'courses', ['source', 'filename'],
+     {'mysql_length': {'source': 64, 'filename': 255}}),
+    ('ix_courses_filename', 'courses', ['filename'], {'mysql_length': 255}),
+    ('ix_courses_name', 'courses', ['name'], {'mysql_length': 255}),
+    ('ix_sites_courses_site_id_course_id', 'sites_courses',
+     ['site_id', 'course_id'], {}),
+]
+
+
+def upgrade(engine_name):
+    eval("upgrade_%s" % engine_name)()
+
+
+def downgrade(engine_name):
+    eval("downgrade_%s" % engine_name)()
+
+
+def upgrade_engine1():
+    for name, table, columns, kw in INDEXES:
+        op.create_index(name, table, columns, **kw)
+
+
+def downgrade_engine1():
+    for name, table, columns, kw in reversed(INDEXES):
+        op.drop_index(name, table)
@@ -0,0 +1,40 @@
+"""record install task and batch ids on sites_courses
+
+Revision ID: 8e3b5a7c9d14
+Revises: 7c4f1e8b2d53
+Create Date: 2026-10-18 17:26:51.118094
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8e3b5a7c9d14'
+down_revision = '7c4f1e8b2d53'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(engine_name):
+    eval("upgrade_%s" % engine_name)()
+
+
+def downgrade(engine_name):
+    eval("downgrade_%s" % engine_name)()
+
+
+def upgrade_engine1():
+    op.add_column('sites_courses',
+                  sa.Column('celery_task_id', sa.String(255)))
+    op.add_column('sites_courses',
+                  sa.Column('install_batch_id', sa.String(255)))
+    op.create_index('ix_sites_courses_celery_task_id', 'sites_courses',
+                    ['celery_task_id'])
+    op.create_index('ix_sites_courses_install_batch_id', 'sites_courses',
+                    ['install_batch_id'])
+
+
+def downgrade_engine1():
+    op.drop_index('ix_sites_courses_install_batch_id', 'sites_courses')
+    op.drop_index('ix_sites_courses_celery_task_id', 'sites_courses')
+    op.drop_column('sites_courses', 'install_batch_id')
+    op.drop_column('sites_courses', 'celery_task_id')
@@ -0,0 +1,58 @@
+"""add install_host_slots and install_dead_letters
+
+Revision ID: 9a6c2e4f7b81
+Revises: 8e3b5a7c9d14
+Create Date: 2026-10-18 18:04:12.530217
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9a6c2e4f7b81'
+down_revision = '8e3b5a7c9d14'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(engine_name):
+    eval("upgrade_%s" % engine_name)()
+
+
+def downgrade(engine_name):
+    eval("downgrade_%s" % engine_name)()
+
+
+def upgrade_engine1():
+    op.create_table(
+        'install_host_slots',
+        sa.Column('host', sa.String(255), primary_key=True),
+        sa.Column('slot', sa.Integer, primary_key=True,
+                  autoincrement=False),
+        sa.Column('task_id', sa.String(255)),
+        sa.Column('expires', sa.DateTime)
+    )
+    op.create_table(
+        'install_dead_letters',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('task_id', sa.String(255)),
+        sa.Column('site_id', sa.Integer,
+                  sa.ForeignKey('sites.id',
+                                name='fk_install_dead_letters_site_id',
+                                ondelete='CASCADE')),
+        sa.Column('course_id', sa.Integer,
+                  sa.ForeignKey('courses.id',
+                                name='fk_install_dead_letters_course_id',
+                                ondelete='CASCADE')),
+        sa.Column('host', sa.String(255)),
+        sa.Column('attempts', sa.Integer),
+        sa.Column('error', sa.Text),
+        sa.Column('failed', sa.DateTime)
+    )
+    op.create_index('ix_install_dead_letters_task_id',
+                    'install_dead_letters', ['task_id'])
+
+
+def downgrade_engine1():
+    op.drop_index('ix_install_dead_letters_task_id', 'install_dead_letters')
+    op.drop_table('install_dead_letters')
+    op.drop_table('install_host_slots')
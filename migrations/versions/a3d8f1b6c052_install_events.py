@@ -0,0 +1,43 @@
+"""add install_events
+
+Revision ID: a3d8f1b6c052
+Revises: 9a6c2e4f7b81
+Create Date: 2026-10-18 18:51:37.204618
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a3d8f1b6c052'
+down_revision = '9a6c2e4f7b81'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(engine_name):
+    eval("upgrade_%s" % engine_name)()
+
+
+def downgrade(engine_name):
+    eval("downgrade_%s" % engine_name)()
+
+
+def upgrade_engine1():
+    op.create_table(
+        'install_events',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('task_id', sa.String(255)),
+        sa.Column('status', sa.String(32)),
+        sa.Column('message', sa.Text),
+        sa.Column('created', sa.DateTime)
+    )
+    op.create_index('ix_install_events_task_id', 'install_events',
+                    ['task_id'])
+    op.create_index('ix_install_events_created', 'install_events',
+                    ['created'])
+
+
+def downgrade_engine1():
+    op.drop_index('ix_install_events_created', 'install_events')
+    op.drop_index('ix_install_events_task_id', 'install_events')
+    op.drop_table('install_events')
@@ -0,0 +1,32 @@
+"""index course_files by path
+
+Revision ID: b5e9c2d7a413
+Revises: a3d8f1b6c052
+Create Date: 2026-10-18 20:12:45.318204
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b5e9c2d7a413'
+down_revision = 'a3d8f1b6c052'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(engine_name):
+    eval("upgrade_%s" % engine_name)()
+
+
+def downgrade(engine_name):
+    eval("downgrade_%s" % engine_name)()
+
+
+def upgrade_engine1():
+    # A prefix of the path, MySQL keys are too short for all of it
+    op.create_index('ix_course_files_path', 'course_files', ['path'],
+                    mysql_length=255)
+
+
+def downgrade_engine1():
+    op.drop_index('ix_course_files_path', 'course_files')
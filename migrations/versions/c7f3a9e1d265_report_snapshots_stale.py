@@ -0,0 +1,31 @@
+"""mark report snapshots stale
+
+Revision ID: c7f3a9e1d265
+Revises: b5e9c2d7a413
+Create Date: 2026-10-18 21:04:37.529816
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c7f3a9e1d265'
+down_revision = 'b5e9c2d7a413'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade(engine_name):
+    eval("upgrade_%s" % engine_name)()
+
+
+def downgrade(engine_name):
+    eval("downgrade_%s" % engine_name)()
+
+
+def upgrade_engine1():
+    op.add_column('report_snapshots',
+                  sa.Column('stale', sa.Boolean, server_default='0'))
+
+
+def downgrade_engine1():
+    op.drop_column('report_snapshots', 'stale')
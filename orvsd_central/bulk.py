@@ -0,0 +1,204 @@
+"""
+Bulk changes to the objects of a category.
+
+A batch of add, update and delete operations is applied in one transaction
+and committed once. Operations are worked through BULK_CHUNK_SIZE at a time:
+the objects a chunk updates or deletes are loaded with a single query and
+the chunk is flushed as a whole, so a batch costs a few statements per chunk
+rather than a round trip and a commit per object.
+
+Operations that are invalid, or name an object that does not exist, are
+skipped and reported in their result, the others still apply. If the
+database rejects a chunk, nothing is committed.
+
+Added sites are harvested by a celery task once the batch is committed.
+"""
+from flask import current_app, g
+from sqlalchemy.exc import SQLAlchemyError
+
+from orvsd_central.cache import invalidate_user_cache, report_changed
+from orvsd_central.harvest import harvest_new_sites
+from orvsd_central.models import Site, SiteDetail, User
+from orvsd_central.util import (column_value, get_site_enrolments,
+                                refresh_latest_site_detail)
+
+OPERATIONS = ['add', 'update', 'delete']
+
+# Columns the api never sets, latest_site_detail_id is maintained by
+# gather_siteinfo
+READ_ONLY_COLUMNS = ['id', 'latest_site_detail_id']
+
+
+class OperationError(Exception):
+    """
+    An operation that can not be applied, reported in its result.
+    """
+
+
+def read_values(obj, data):
+    """
+    Converts an operation's 'data' to column values of 'obj'.
+    """
+    if not isinstance(data, dict):
+        raise OperationError("'data' must be an object")
+
+    columns = obj.__table__.columns
+    values = {}
+    for name, value in data.items():
+        if name not in columns or name in READ_ONLY_COLUMNS:
+            raise OperationError("Unknown column %s" % name)
+        try:
+            values[name] = column_value(columns[name], value)
+        except (TypeError, ValueError):
+            raise OperationError("Invalid value for %s" % name)
+    return values
+
+
+def operation_id(operation):
+    """
+    Returns the id of the object an operation is for, None if it has none.
+    """
+    try:
+        return int(operation['id'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def apply_operation(obj, operation, existing, site_ids):
+    """
+    Applies one operation to the session, see apply_operations.
+
+    existing -- The chunk's objects to update or delete, by id
+    site_ids -- Collects the sites whose SiteDetails changed
+    """
+    if operation.get('op') not in OPERATIONS:
+        raise OperationError("'op' must be one of %s" %
+                             ", ".join(OPERATIONS))
+
+    if operation['op'] == 'add':
+        values = dict((column.name, None) for column in obj.__table__.columns
+                      if column.name not in READ_ONLY_COLUMNS)
+        values.update(read_values(obj, operation.get('data', {})))
+        new_obj = obj(**values)
+        g.db_session.add(new_obj)
+        if isinstance(new_obj, SiteDetail):
+            site_ids.add(new_obj.site_id)
+        return {'status': 'ok', 'object': new_obj}
+
+    modified_obj = existing.get(operation_id(operation))
+    if modified_obj is None:
+        raise OperationError("No such object")
+
+    if isinstance(modified_obj, SiteDetail):
+        site_ids.add(modified_obj.site_id)
+
+    if operation['op'] == 'update':
+        values = read_values(obj, operation.get('data', {}))
+        for name, value in values.items():
+            setattr(modified_obj, name, value)
+        if isinstance(modified_obj, SiteDetail):
+            if 'courses' in values:
+                modified_obj.enrolments = get_site_enrolments(
+                    values['courses']
+                )
+            site_ids.add(modified_obj.site_id)
+    else:
+        if isinstance(modified_obj, SiteDetail):
+            # Release the site's pointer before the row goes away
+            g.db_session.query(Site).filter(
+                Site.latest_site_detail_id == modified_obj.id
+            ).update({'latest_site_detail_id': None},
+                     synchronize_session=False)
+        g.db_session.delete(modified_obj)
+
+    return {'status': 'ok', 'id': modified_obj.id}
+
+
+def apply_chunk(obj, chunk, site_ids):
+    """
+    Applies a chunk of operations to the session, loading the objects they
+    update or delete with one query.
+
+    Returns:
+        list. Each operation's result, those of adds hold the new 'object'
+        until it is flushed
+    """
+    ids = set(operation_id(operation) for operation in chunk)
+    ids.discard(None)
+    existing = dict(
+        (modified_obj.id, modified_obj)
+        for modified_obj in obj.query.filter(obj.id.in_(ids))
+    ) if ids else {}
+
+    results = []
+    for operation in chunk:
+        try:
+            if not isinstance(operation, dict):
+                raise OperationError("Operations must be objects")
+            results.append(apply_operation(obj, operation, existing,
+                                           site_ids))
+        except OperationError as e:
+            results.append({'status': 'error',
+                            'id': operation_id(operation),
+                            'message': str(e)})
+    return results
+
+
+def apply_operations(obj, operations, chunk_size=None):
+    """
+    Applies a batch of operations to the objects of a model, in one
+    transaction.
+
+    Each operation is a dict with 'op', one of OPERATIONS, and:
+        add    - 'data', the new object's columns, missing ones are null
+        update - 'id' and 'data', the columns to change
+        delete - 'id'
+
+    Args:
+        obj: The model, see util.get_obj_by_category
+        operations (list): The operations, in order
+        chunk_size (int): Operations per flush, BULK_CHUNK_SIZE
+
+    Returns:
+        tuple. Whether the batch was committed, each operation's result, a
+        dict of its 'status', 'ok' or 'error', the object's 'id' and the
+        error's 'message', and the database's error if it was not committed
+    """
+    chunk_size = chunk_size or current_app.config.get('BULK_CHUNK_SIZE', 100)
+
+    results = []
+    added = []
+    site_ids = set()
+    try:
+        for start in range(0, len(operations), chunk_size):
+            chunk_results = apply_chunk(
+                obj, operations[start:start + chunk_size], site_ids
+            )
+            g.db_session.flush()
+
+            for result in chunk_results:
+                if 'object' in result:
+                    added.append(result.pop('object'))
+                    result['id'] = added[-1].id
+            results.extend(chunk_results)
+
+        # The sites whose SiteDetails changed may have a new latest one
+        site_ids.discard(None)
+        for site_id in site_ids:
+            refresh_latest_site_detail(site_id)
+        g.db_session.commit()
+    except SQLAlchemyError as e:
+        g.db_session.rollback()
+        return False, results, str(e)
+
+    if any(result['status'] == 'ok' for result in results):
+        report_changed()
+        if obj is User:
+            invalidate_user_cache()
+
+    new_site_ids = [new_obj.id for new_obj in added
+                    if isinstance(new_obj, Site)]
+    if new_site_ids:
+        harvest_new_sites.delay(new_site_ids)
+
+    return True, results, None
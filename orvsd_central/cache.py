@@ -0,0 +1,284 @@
+"""
+Server side cache for the report.
+
+The report only changes when a harvest stores siteinfo or an object is edited
+through the api, so its results are kept until one of those changes. Every
+key includes the newest complete report snapshot and the newest SiteDetail,
+read with one cheap query, so a harvest run from cron is seen by every web
+process whichever backend is used.
+
+Edits through the api call report_changed, which also marks the report
+snapshots stale so the report is read live until the next one is built.
+Invalidating the cache does not
+touch the cached entries, it starts a new generation that every key also
+includes, kept in the cache itself. Only processes sharing a file or
+memcached backend see it, with 'lru' the other processes of a multi-process
+server serve their entries until REPORT_CACHE_TIMEOUT.
+
+The backend is chosen with REPORT_CACHE:
+    'lru'       - in process, least recently used entries are dropped
+    'file'      - files under REPORT_CACHE_DIR
+    'memcached' - any memcached protocol server in REPORT_CACHE_SERVERS
+    None        - no caching
+
+Logged in users are kept apart from the report, in a small cache of each
+process, see util.load_user. A process drops its copy of a user when the
+user is edited through it, other processes keep theirs for at most
+USER_CACHE_TIMEOUT seconds.
+"""
+from collections import OrderedDict
+from functools import wraps
+import hashlib
+import threading
+import time
+
+from flask import current_app, g, request
+from sqlalchemy.sql import func, select
+from werkzeug.contrib.cache import (BaseCache, FileSystemCache,
+                                    MemcachedCache, NullCache)
+from werkzeug.http import http_date
+
+from orvsd_central.models import ReportSnapshot, SiteDetail
+
+GENERATION_KEY = 'report:generation'
+
+
+class LRUCache(BaseCache):
+    """
+    In process cache holding at most 'threshold' entries, dropping the least
+    recently used one when full. Safe to share between threads.
+    """
+
+    def __init__(self, threshold=500, default_timeout=300):
+        BaseCache.__init__(self, default_timeout)
+        self._threshold = threshold
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            expires, value = self._cache.pop(key, (0, None))
+            if expires > time.time():
+                # Re-inserted as the most recently used
+                self._cache[key] = (expires, value)
+                return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        with self._lock:
+            self._cache.pop(key, None)
+            self._cache[key] = (time.time() + timeout, value)
+            while len(self._cache) > self._threshold:
+                self._cache.popitem(last=False)
+
+    def add(self, key, value, timeout=None):
+        with self._lock:
+            expires, _ = self._cache.get(key, (0, None))
+            if expires > time.time():
+                return False
+        self.set(key, value, timeout)
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            return self._cache.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+        return True
+
+
+def create_cache(config):
+    """
+    Returns the cache backend described by the REPORT_CACHE options.
+    """
+    backend = config.get('REPORT_CACHE', 'lru')
+    timeout = config.get('REPORT_CACHE_TIMEOUT', 3600)
+
+    if backend == 'lru':
+        return LRUCache(config.get('REPORT_CACHE_SIZE', 500), timeout)
+    if backend == 'file':
+        return FileSystemCache(config['REPORT_CACHE_DIR'],
+                               config.get('REPORT_CACHE_SIZE', 500), timeout)
+    if backend == 'memcached':
+        return MemcachedCache(config.get('REPORT_CACHE_SERVERS', None),
+                              timeout, key_prefix='orvsd_central:')
+    if not backend:
+        return NullCache()
+
+    raise ValueError("Unknown REPORT_CACHE %r" % backend)
+
+
+def get_cache():
+    """
+    Returns the app's report cache, creating it on first use.
+    """
+    cache = current_app.extensions.get('report_cache')
+    if cache is None:
+        cache = create_cache(current_app.config)
+        current_app.extensions['report_cache'] = cache
+    return cache
+
+
+def get_user_cache():
+    """
+    Returns the process's cache of logged in users, creating it on first use.
+    A USER_CACHE_TIMEOUT of 0 disables it.
+    """
+    cache = current_app.extensions.get('user_cache')
+    if cache is None:
+        timeout = current_app.config.get('USER_CACHE_TIMEOUT', 60)
+        if timeout:
+            cache = LRUCache(current_app.config.get('USER_CACHE_SIZE', 500),
+                             timeout)
+        else:
+            cache = NullCache()
+        current_app.extensions['user_cache'] = cache
+    return cache
+
+
+def invalidate_user_cache():
+    """
+    Drops every cached user of this process. Called after users have been
+    added, edited or deleted.
+    """
+    get_user_cache().clear()
+
+
+def get_generation():
+    """
+    Returns the time the report cache was last invalidated, starting a
+    generation if there is none yet.
+    """
+    cache = get_cache()
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        cache.add(GENERATION_KEY, time.time(), timeout=0x7fffffff)
+        # Another process may have got there first
+        generation = cache.get(GENERATION_KEY) or time.time()
+    return generation
+
+
+def get_data_version():
+    """
+    Returns the id and creation time of the current report snapshot, see
+    snapshot.get_report_snapshot, and the newest SiteDetail id, all None
+    before the first harvest.
+    """
+    newest = select([func.max(ReportSnapshot.id)]).where(
+        (ReportSnapshot.complete == True) & (ReportSnapshot.stale == False)
+    ).as_scalar()
+    return g.db_session.execute(select([
+        select([ReportSnapshot.created]).where(
+            ReportSnapshot.id == newest
+        ).label('created'),
+        newest.label('snapshot_id'),
+        select([func.max(SiteDetail.id)]).label('detail_id')
+    ])).first()
+
+
+def get_version():
+    """
+    Returns the key part identifying the current report, see get_generation
+    and get_data_version, and the time it was last changed.
+    """
+    generation = get_generation()
+    created, snapshot_id, detail_id = get_data_version()
+    changed = generation
+    if created is not None:
+        changed = max(changed, time.mktime(created.timetuple()))
+    return "%r:%s:%s" % (generation, snapshot_id, detail_id), changed
+
+
+def invalidate_report_cache():
+    """
+    Drops every cached report result, in all processes sharing the cache.
+    Called after anything the report is built from has been committed.
+    """
+    get_cache().set(GENERATION_KEY, time.time(), timeout=0x7fffffff)
+
+
+def report_changed():
+    """
+    Marks every report snapshot stale and drops the cached report. Called
+    after an edit of anything the report is built from has been committed,
+    the report is read live until the next snapshot is built.
+    """
+    g.db_session.query(ReportSnapshot).filter(
+        ReportSnapshot.stale == False
+    ).update({'stale': True}, synchronize_session=False)
+    g.db_session.commit()
+    invalidate_report_cache()
+
+
+def cached(name, func, *args):
+    """
+    Returns func(*args), computed at most once per version of the report.
+
+    name -- Identifies func and its args in the cache
+    """
+    cache = get_cache()
+    key = "report:%s:%s" % (name, get_version()[0])
+    value = cache.get(key)
+    if value is None:
+        value = func(*args)
+        cache.set(key, value)
+    return value
+
+
+def cached_items(name, func, *args):
+    """
+    Generates the items of func(*args), from the cache if it holds them for
+    this version of the report. Otherwise they are passed on as func yields
+    them and cached as a list once all have been read.
+    """
+    cache = get_cache()
+    key = "report:%s:%s" % (name, get_version()[0])
+    items = cache.get(key)
+    if items is not None:
+        for item in items:
+            yield item
+        return
+
+    items = []
+    for item in func(*args):
+        items.append(item)
+        yield item
+    cache.set(key, items)
+
+
+def cached_response(view):
+    """
+    Caches a report view's response, by URL, until the next invalidation.
+
+    Responses carry an ETag and a Last-Modified of the version's start, so
+    browsers can revalidate them and be answered with a 304.
+    """
+    @wraps(view)
+    def decorated_view(*args, **kwargs):
+        version, changed = get_version()
+        # Hashed, memcached keys may not have spaces
+        url = hashlib.md5(request.full_path.encode('utf-8')).hexdigest()
+        key = "report:%s:%s:%s" % (view.__name__, url, version)
+
+        cache = get_cache()
+        cached_value = cache.get(key)
+        if cached_value is None:
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            body = response.get_data()
+            cached_value = (body, response.mimetype,
+                            hashlib.md5(body).hexdigest())
+            cache.set(key, cached_value)
+
+        body, mimetype, etag = cached_value
+        response = current_app.response_class(body, mimetype=mimetype)
+        response.set_etag(etag)
+        response.headers['Last-Modified'] = http_date(changed)
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+    return decorated_view
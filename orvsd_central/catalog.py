@@ -0,0 +1,265 @@
+"""
+Keeps the course list in step with the backups under INSTALL_COURSE_FILE_PATH.
+
+Every file's size and modification time are kept in the course_files
+manifest, so an update only reads the backups that were added or changed
+since the last one.
+
+Web requests read backups one after the other. manage.py update_courses
+reads them on a pool of processes, see ingest_workers, which only parse the
+zip files: forking a web worker with its connections and app state is not
+safe. Everything that touches the database stays in the calling process,
+where the new courses are given consecutive serials and committed in
+batches.
+"""
+import logging
+import multiprocessing
+import os
+import stat
+
+from flask import current_app, g
+
+from orvsd_central.cache import report_changed
+from orvsd_central.models import Course, CourseFile
+from orvsd_central.util import (get_path_and_source, new_course_from_backup,
+                                next_course_serial, read_backup_information)
+
+# Number of filenames or names per IN clause when matching existing courses
+FILENAME_CHUNK_SIZE = 500
+
+
+def scan_course_files(base_path):
+    """
+    Finds every file under base_path.
+
+    Returns:
+        dict. Path relative to base_path -> (size, mtime)
+    """
+    files = {}
+    for root, sub_folders, filenames in os.walk(base_path):
+        for filename in filenames:
+            full_file_path = os.path.join(root, filename)
+            try:
+                info = os.stat(full_file_path)
+            except OSError:
+                # Removed while we were walking
+                continue
+            if stat.S_ISREG(info.st_mode):
+                path = os.path.relpath(full_file_path, base_path)
+                files[path] = (info.st_size, int(info.st_mtime))
+    return files
+
+
+def get_courses_by_file(base_path, paths):
+    """
+    Matches files to the courses that were already created from them.
+
+    Returns:
+        dict. Path relative to base_path -> course id
+    """
+    by_file = {}
+    for path in paths:
+        source, file_path = get_path_and_source(
+            base_path, os.path.join(base_path, path)
+        )
+        by_file[(source.replace('/', ''), file_path)] = path
+
+    filenames = sorted(set(file_path for _, file_path in by_file))
+    courses = {}
+    for i in range(0, len(filenames), FILENAME_CHUNK_SIZE):
+        matches = g.db_session.query(
+            Course.id, Course.source, Course.filename
+        ).filter(
+            Course.filename.in_(filenames[i:i + FILENAME_CHUNK_SIZE])
+        )
+        for course_id, source, filename in matches:
+            path = by_file.get((source, filename))
+            if path:
+                courses[path] = course_id
+    return courses
+
+
+def _read_backup(job):
+    """
+    Runs in a worker process, returns (path, info, error) where exactly one
+    of info and error is set.
+    """
+    path, full_path = job
+    try:
+        return path, read_backup_information(full_path), None
+    except Exception as e:
+        # Only the message, not every exception can be pickled
+        return path, None, "%s: %s" % (type(e).__name__, e)
+
+
+def ingest_workers(workers=None):
+    """
+    Returns the number of processes manage.py update_courses reads backups
+    with: 'workers', COURSE_INGEST_WORKERS or one per CPU.
+    """
+    return workers or current_app.config.get('COURSE_INGEST_WORKERS') or \
+        multiprocessing.cpu_count()
+
+
+def read_backups(base_path, paths, workers=1, progress=None):
+    """
+    Reads the information of many backups at once.
+
+    Args:
+        base_path (string): INSTALL_COURSE_FILE_PATH
+        paths (list): Paths of the backups relative to base_path
+        workers (int): Number of processes, see ingest_workers. With one
+            worker, or one backup, they are read in this process.
+        progress: Called with (done, total) after each backup is read
+
+    Returns:
+        dict. Path -> (info, error), see _read_backup
+    """
+    jobs = [(path, os.path.join(base_path, path)) for path in paths]
+    results = {}
+
+    if workers <= 1 or len(jobs) <= 1:
+        pool = None
+        read = (_read_backup(job) for job in jobs)
+    else:
+        pool = multiprocessing.Pool(min(workers, len(jobs)))
+        # Backups vary a lot in size, so hand them out a few at a time
+        read = pool.imap_unordered(
+            _read_backup, jobs,
+            chunksize=max(1, min(8, len(jobs) // (workers * 4)))
+        )
+
+    try:
+        for path, info, error in read:
+            results[path] = (info, error)
+            if progress:
+                progress(len(results), len(jobs))
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+
+    return results
+
+
+def get_courses_by_name(names):
+    """
+    Returns:
+        dict. Course name -> the first course with that name
+    """
+    names = sorted(set(names))
+    courses = {}
+    for i in range(0, len(names), FILENAME_CHUNK_SIZE):
+        matches = Course.query.filter(
+            Course.name.in_(names[i:i + FILENAME_CHUNK_SIZE])
+        ).order_by(Course.id)
+        for course in matches:
+            courses.setdefault(course.name, course)
+    return courses
+
+
+def update_course_list(base_path, workers=1, batch_size=None,
+                       progress=None):
+    """
+    Brings the course list and the course_files manifest up to date with the
+    files under base_path.
+
+    Added files that were already made into courses are only recorded in the
+    manifest, other added and changed files are read with read_backups. A
+    backup becomes a new course unless a course is named after its full or
+    short name. Removed files are dropped from the manifest, their courses
+    are kept.
+
+    Args:
+        base_path (string): INSTALL_COURSE_FILE_PATH
+        workers (int): Processes reading backups, see read_backups. Only
+            manage.py may use more than one
+        batch_size (int): Files per commit, COURSE_INGEST_BATCH_SIZE
+        progress: Called with (done, total) as backups are read
+
+    Returns:
+        dict. Number of files 'added', 'changed', 'removed' and 'failed',
+        and the number of new 'courses'
+    """
+    batch_size = batch_size or \
+        current_app.config.get('COURSE_INGEST_BATCH_SIZE', 200)
+
+    on_disk = scan_course_files(base_path)
+    manifest = dict((entry.path, entry) for entry in CourseFile.query.all())
+
+    added = set(on_disk) - set(manifest)
+    removed = set(manifest) - set(on_disk)
+    changed = set(
+        path for path in set(on_disk) & set(manifest)
+        if (manifest[path].size, manifest[path].mtime) != on_disk[path]
+    )
+
+    for path in removed:
+        g.db_session.delete(manifest[path])
+
+    existing = get_courses_by_file(base_path, added)
+    backups = read_backups(
+        base_path,
+        sorted(path for path in added | changed if path not in existing),
+        workers, progress
+    )
+
+    by_name = get_courses_by_name(
+        info[field] for info, error in backups.values() if info
+        for field in ('original_course_fullname',
+                      'original_course_shortname')
+    )
+    serial = None
+    created = 0
+    failed = 0
+    uncommitted = 0
+
+    for path in sorted(added | changed):
+        entry = manifest.get(path) or CourseFile(path=path)
+
+        if path in existing:
+            entry.course_id = existing[path]
+        else:
+            info, error = backups[path]
+            if error:
+                # Recorded anyway, so it is not read again until it changes.
+                # A changed file keeps the course it was last read as.
+                logging.error("Unable to read course from %s: %s" %
+                              (path, error))
+                failed += 1
+            else:
+                course = by_name.get(info['original_course_fullname']) or \
+                    by_name.get(info['original_course_shortname'])
+                if course is None:
+                    if serial is None:
+                        serial = next_course_serial()
+                    source, file_path = get_path_and_source(
+                        base_path, os.path.join(base_path, path)
+                    )
+                    course = new_course_from_backup(info, source, file_path,
+                                                    serial)
+                    g.db_session.add(course)
+                    # Later copies of the same course in this drop match it
+                    by_name.setdefault(course.name, course)
+                    serial += 1
+                    created += 1
+                entry.course = course
+
+        entry.size, entry.mtime = on_disk[path]
+        g.db_session.add(entry)
+
+        uncommitted += 1
+        if uncommitted >= batch_size:
+            g.db_session.commit()
+            uncommitted = 0
+
+    g.db_session.commit()
+    if created:
+        # The report counts the courses
+        report_changed()
+
+    return {'added': len(added),
+            'changed': len(changed),
+            'removed': len(removed),
+            'failed': failed,
+            'courses': created}
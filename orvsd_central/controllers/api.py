@@ -1,25 +1,45 @@
+from datetime import datetime
 import json
-
-from flask import Blueprint, abort, g, jsonify, request
-
-from orvsd_central.models import Course, District, School, Site, SiteDetail
-from orvsd_central.util import (get_obj_by_category, get_obj_identifier,
-                                get_active_counts, get_schools, string_to_type,
-                                gather_tokens, gather_siteinfo)
+import os
+
+from flask import (Blueprint, Response, abort, current_app, g, jsonify,
+                   request, stream_with_context)
+from flask.ext.login import login_required
+
+from orvsd_central.bulk import apply_operations
+from orvsd_central.cache import (cached_items, cached_response,
+                                 invalidate_user_cache, report_changed)
+from orvsd_central.catalog import update_course_list
+from orvsd_central.export import REPORT_COLUMNS, iter_usage_report
+from orvsd_central.models import Course, Site, SiteDetail, User
+from orvsd_central.progress import stream_batch, wait_for_batch
+from orvsd_central.serialize import (get_fields, get_objects, iter_objects,
+                                     iter_sites_with_details, stream_response)
+from orvsd_central.snapshot import (report_active_districts, report_counts,
+                                    report_districts, report_schools)
+from orvsd_central.util import (get_install_tasks, get_obj_by_category,
+                                get_obj_identifier, get_object_page,
+                                get_schools, get_site_courses,
+                                get_site_enrolments, get_task_statuses,
+                                string_to_type, gather_tokens,
+                                gather_siteinfo, refresh_latest_site_detail,
+                                requires_role)
 
 
 mod = Blueprint('api', __name__, url_prefix="/1")
 
+# Bounds on what one request may ask for
+MAX_TASKS_PER_PAGE = 1000
+MAX_TASK_STATUS_IDS = 1000
+MAX_OBJECTS_PER_PAGE = 1000
+MAX_BULK_OPERATIONS = 5000
+MAX_OBJECT_IDS = 1000
+
 
 @mod.route("/districts/active", methods=['GET'])
+@cached_response
 def active_districts():
-    active_districts = g.db_session.query(
-        District.name,
-        District.shortname,
-        District.id
-    ).join(School).join(Site).join(SiteDetail).distinct().all()
-
-    return jsonify(category=active_districts)
+    return jsonify(category=report_active_districts())
 
 
 @mod.route("/<category>/object/add", methods=["POST"])
@@ -41,13 +61,18 @@ def add_object(category):
         # Here we update our dict with new values
         # A one liner is too messy :(
         for column in obj.__table__.columns:
-            if column.name is not 'id':
+            # latest_site_detail_id is maintained by gather_siteinfo
+            if column.name not in ['id', 'latest_site_detail_id']:
                 inputs.update({column.name: string_to_type(
                                request.form.get(column.name))})
 
         obj = obj(**inputs)
         g.db_session.add(obj)
         g.db_session.commit()
+        report_changed()
+        if isinstance(obj, User):
+            # The id may be that of a deleted user still cached
+            invalidate_user_cache()
 
         if isinstance(obj, Site):
             gather_tokens(obj)
@@ -70,27 +95,103 @@ def delete_object(category, id):
     if obj:
         modified_obj = obj.query.filter_by(id=request.form.get("id")).first()
         if modified_obj:
+            if isinstance(modified_obj, SiteDetail):
+                # Release the site's pointer before the row goes away
+                g.db_session.query(Site).filter(
+                    Site.latest_site_detail_id == modified_obj.id
+                ).update({'latest_site_detail_id': None},
+                         synchronize_session=False)
+
             g.db_session.delete(modified_obj)
+            g.db_session.flush()
+
+            if isinstance(modified_obj, SiteDetail):
+                refresh_latest_site_detail(modified_obj.site_id)
+
             g.db_session.commit()
+            report_changed()
+            if obj is User:
+                invalidate_user_cache()
             return jsonify({'message': "Object deleted successfully!"})
 
     abort(404)
 
 
-# Get all task IDs
-# TODO: Needs testing
-@mod.route('/celery/id/all')
-def get_all_ids():
+@mod.route("/<category>/bulk", methods=["POST"])
+def bulk_objects(category):
+    """
+    Applies a JSON list of add, update and delete operations to a category's
+    objects in one transaction, see bulk.apply_operations. The body is the
+    list, or an object with the list as 'operations'.
+
+    Returns:
+        JSON response with 'committed', each operation's result in 'results'
+        and the database's 'error' when nothing was committed.
+    """
+    obj = get_obj_by_category(category)
+    if not obj:
+        abort(404)
+
+    operations = request.get_json(silent=True)
+    if isinstance(operations, dict):
+        operations = operations.get('operations')
+    if (not isinstance(operations, list) or
+            len(operations) > MAX_BULK_OPERATIONS):
+        abort(400)
+
+    committed, results, error = apply_operations(obj, operations)
+    response = jsonify(committed=committed, results=results, error=error)
+    if not committed:
+        response.status_code = 409
+    return response
+
+
+def parse_date(value):
     """
-    Returns JSONified metadata for all celery tasks.
+    Parses a ?since= or ?until= date, as YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS.
+    Answers 400 if it is neither.
     """
-    # TODO: "result" is another column, but SQLAlchemy
-    # complains of some encoding error.
-    statuses = g.db_session.query(
-        "id", "task_id", "status", "date_done", "traceback"
-    ).from_statement("SELECT * FROM celery_taskmeta").all()
+    for fmt in ['%Y-%m-%dT%H:%M:%S', '%Y-%m-%d']:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    abort(400)
 
-    return jsonify(status=statuses)
+
+@mod.route('/celery/tasks')
+def get_tasks():
+    """
+    Returns a JSONified page of course install tasks, newest first.
+
+    Filters:
+        ?status=      comma separated task states, PENDING, SUCCESS, ...
+        ?since=       tasks done at or after this date
+        ?until=       tasks done before this date
+        ?site_id=     installs to this site
+        ?course_id=   installs of this course
+
+    ?limit= sets the page size (TASKS_PER_PAGE). 'next' is passed as ?after=
+    to get the following page, it is null on the last page.
+    """
+    statuses = request.args.get('status', None)
+    since = request.args.get('since', None)
+    until = request.args.get('until', None)
+    limit = min(request.args.get(
+        'limit', current_app.config.get('TASKS_PER_PAGE', 100), type=int
+    ), MAX_TASKS_PER_PAGE)
+
+    tasks, after = get_install_tasks(
+        statuses=statuses.upper().split(',') if statuses else None,
+        since=parse_date(since) if since else None,
+        until=parse_date(until) if until else None,
+        site_id=request.args.get('site_id', None, type=int),
+        course_id=request.args.get('course_id', None, type=int),
+        after=request.args.get('after', None, type=int),
+        limit=max(limit, 1)
+    )
+
+    return jsonify(tasks=tasks, next=after)
 
 
 @mod.route("/<category>/<id>/update", methods=["POST"])
@@ -114,7 +215,20 @@ def update_object(category, id):
             g.db_session.query(obj).filter_by(
                 id=request.form.get("id")
             ).update(inputs)
+
+            if isinstance(modified_obj, SiteDetail):
+                modified_obj.enrolments = get_site_enrolments(
+                    inputs['courses']
+                )
+                # Either site may have a new latest SiteDetail
+                refresh_latest_site_detail(modified_obj.site_id)
+                if inputs['site_id'] != modified_obj.site_id:
+                    refresh_latest_site_detail(inputs['site_id'])
+
             g.db_session.commit()
+            report_changed()
+            if obj is User:
+                invalidate_user_cache()
 
             return jsonify({'identifier': identifier,
                             identifier: inputs[identifier],
@@ -128,20 +242,31 @@ def get_courses_by_site(site_id):
     """
     Returns a JSONified list of course details from the most recent
     site_details object for a given site_id.
-    """
-    # SiteDetails hold the course information we are looking for
-    site_details = SiteDetail.query.filter_by(site_id=site_id) \
-                                   .order_by(SiteDetail
-                                             .timemodified
-                                             .desc()) \
-                                   .first()
 
-    if site_details and site_details.courses:
-        return jsonify(content=json.loads(site_details.courses))
-    elif not site_details:
+    ?min_enrolled= only lists courses with more users enrolled, ?page= and
+    ?per_page= return one page of them. 'total' is the number of courses on
+    all pages.
+    """
+    latest_id = g.db_session.query(Site.latest_site_detail_id).filter(
+        Site.id == site_id
+    ).scalar()
+    if latest_id is None:
         return jsonify({'error:': 'Site not found.'})
-    else:
-        return jsonify({'error:': 'No courses found.'})
+
+    page = request.args.get('page', 1, type=int)
+    per_page = request.args.get('per_page', None, type=int)
+    if per_page is None and 'page' in request.args:
+        per_page = 100
+
+    courses, total = get_site_courses(
+        latest_id, request.args.get('min_enrolled', None, type=int),
+        page, per_page
+    )
+
+    if total:
+        return jsonify(content=[course.serialize() for course in courses],
+                       total=total)
+    return jsonify({'error:': 'No courses found.'})
 
 
 @mod.route("/courses/filter", methods=["POST"])
@@ -173,6 +298,25 @@ def get_course_list():
     return jsonify(courses=serialized_courses)
 
 
+@mod.route("/courses/list/update", methods=["POST"])
+@requires_role('helpdesk')
+@login_required
+def update_courses():
+    """
+    Updates the course list from the files in INSTALL_COURSE_FILE_PATH and
+    returns a JSONified count of the files added, changed, removed and failed
+    and of the new courses.
+    """
+    base_path = current_app.config.get('INSTALL_COURSE_FILE_PATH', None)
+
+    if base_path and os.path.exists(base_path):
+        return jsonify(update_course_list(base_path))
+
+    return jsonify(
+        {'error': "Invalid INSTALL_COURSE_FILE_PATH in your config"}
+    )
+
+
 @mod.route("/<category>/keys")
 def get_keys(category):
     """
@@ -181,10 +325,50 @@ def get_keys(category):
     obj = get_obj_by_category(category)
     if obj:
         cols = dict((column.name, '') for column in
-                    obj.__table__.columns)
+                    obj.__table__.columns
+                    if column.name != 'latest_site_detail_id')
         return jsonify(cols)
 
 
+@mod.route("/<category>/list")
+def list_objects(category):
+    """
+    Returns a JSONified page of the objects in a category, with only their
+    id, identifier and sort column, see util.get_object_page.
+
+    ?q= searches the ?field= column, the identifier by default. ?sort= is
+    the column to order by, the identifier by default, ?order=desc reverses
+    it. ?limit= sets the page size (OBJECTS_PER_PAGE), 'next' is passed back
+    as ?after= to get the following page and is null on the last page.
+    """
+    obj = get_obj_by_category(category)
+    if not obj:
+        abort(404)
+
+    identifier = get_obj_identifier(category)
+    limit = min(request.args.get(
+        'limit', current_app.config.get('OBJECTS_PER_PAGE', 100), type=int
+    ), MAX_OBJECTS_PER_PAGE)
+
+    try:
+        after = request.args.get('after', None)
+        objects, next_after = get_object_page(
+            obj, identifier,
+            search=request.args.get('q', None),
+            field=request.args.get('field', None),
+            sort=request.args.get('sort', None),
+            descending=request.args.get('order', 'asc') == 'desc',
+            after=json.loads(after) if after else None,
+            limit=max(limit, 1)
+        )
+    except (TypeError, ValueError, IndexError):
+        abort(400)
+
+    return jsonify(objects=objects,
+                   identifier=identifier,
+                   next=json.dumps(next_after) if next_after else None)
+
+
 @mod.route("/site/<baseurl>/moodle")
 def get_moodle_sites(baseurl):
     """
@@ -197,29 +381,161 @@ def get_moodle_sites(baseurl):
     return jsonify(content=data)
 
 
+def get_fields_arg(name='fields'):
+    """
+    Returns the fields asked for by ?fields=, or the argument 'name', comma
+    separated, or None.
+    """
+    fields = request.args.get(name, None)
+    return [field for field in fields.split(',') if field] if fields else None
+
+
+@mod.route("/<category>", methods=["GET"])
+def get_objects_by_id(category):
+    """
+    Returns a JSONified list of the objects of a 'category' with the ?ids=,
+    comma separated or repeated, loaded in one query. ?fields=, comma
+    separated, limits each object to those attributes, its id is always
+    included.
+    """
+    obj = get_obj_by_category(category)
+    if not obj:
+        abort(404)
+
+    try:
+        ids = [int(object_id) for value in request.args.getlist('ids')
+               for object_id in value.split(',') if object_id]
+    except ValueError:
+        abort(400)
+    if not ids or len(ids) > MAX_OBJECT_IDS:
+        abort(400)
+
+    try:
+        objects = get_objects(obj, ids, get_fields_arg())
+    except ValueError:
+        abort(400)
+
+    return jsonify(objects=objects)
+
+
+@mod.route("/<category>/export", methods=["GET"])
+def export_objects(category):
+    """
+    Streams every object of a 'category', see serialize. ?format=ndjson
+    sends a line of JSON per object instead of one JSON array, ?fields=,
+    comma separated, limits the objects to those attributes.
+
+    For sites, ?details=1 adds each site's latest SiteDetail as
+    'latest_details', ?detail_fields= limits its attributes.
+    """
+    obj = get_obj_by_category(category)
+    if not obj:
+        abort(404)
+
+    fmt = request.args.get('format', 'json')
+    details = request.args.get('details') and obj is Site
+    try:
+        # Checked up front, the response has started once objects are read
+        fields = get_fields(obj, get_fields_arg())
+        if details:
+            detail_fields = get_fields(SiteDetail,
+                                       get_fields_arg('detail_fields'))
+            objects = iter_sites_with_details(fields, detail_fields)
+        else:
+            objects = iter_objects(obj, fields)
+        return stream_response(objects, fmt)
+    except ValueError:
+        abort(400)
+
+
 @mod.route("/<category>/<int:id>", methods=["GET"])
 def get_object(category, id):
     """
     Returns a JSONified dict of attributes on an object defined by it's 'id'
-    and the 'category' (model) it is.
+    and the 'category' (model) it is. ?fields=, comma separated, limits it to
+    those attributes and loads only their columns.
     """
     obj = get_obj_by_category(category)
     if obj:
-        modified_obj = obj.query.filter_by(id=id).first()
-        if modified_obj:
-            return jsonify(modified_obj.serialize())
+        fields = get_fields_arg()
+        if fields:
+            try:
+                objects = get_objects(obj, [id], fields)
+            except ValueError:
+                abort(400)
+            if objects:
+                return jsonify(objects[0])
+        else:
+            modified_obj = obj.query.filter_by(id=id).first()
+            if modified_obj:
+                return jsonify(modified_obj.serialize())
 
     abort(404)
 
 
 @mod.route('/report/get_active_schools', methods=['GET'])
+@cached_response
 def get_active_schools():
     """
     Returns all active schools for a district.
     """
     # From the POST, we need the district id, or distid
     dist_id = request.args.get('distid')
-    return jsonify(get_schools(dist_id, True))
+    return jsonify(report_schools(dist_id))
+
+
+@mod.route('/report/districts', methods=['GET'])
+def district_report():
+    """
+    Returns the whole report in one response: every active district with the
+    sites of its active schools, in the same format as get_active_schools.
+
+    With ?stream=1 each district is sent as a line of JSON as soon as it is
+    built, so the report can be drawn district by district. Either way the
+    report is cached until the next change, see cache.
+    """
+    districts = cached_items('districts', report_districts)
+
+    if request.args.get('stream'):
+        return stream_response(districts, 'ndjson')
+
+    return jsonify(districts=list(districts))
+
+
+@mod.route('/report/export', methods=['GET'])
+def export_report():
+    """
+    Streams the usage report, a row per site, as CSV or with ?format=ndjson
+    a line of JSON per site. See export for the columns.
+
+    Filters:
+        ?district=    district id
+        ?county=      county of the sites' schools
+        ?since=       report the newest siteinfo gathered at or after this
+                      date
+        ?until=       report the newest siteinfo gathered before this date
+    """
+    fmt = request.args.get('format', 'csv')
+    try:
+        dist_id = int(request.args['district']) \
+            if request.args.get('district') else None
+    except ValueError:
+        abort(400)
+    since = request.args.get('since')
+    until = request.args.get('until')
+
+    rows = iter_usage_report(dist_id,
+                             request.args.get('county') or None,
+                             parse_date(since) if since else None,
+                             parse_date(until) if until else None)
+    try:
+        response = stream_response(rows, fmt, REPORT_COLUMNS)
+    except ValueError:
+        abort(400)
+    if fmt == 'csv':
+        response.headers['Content-Disposition'] = \
+            'attachment; filename=usage_report.csv'
+    return response
 
 
 @mod.route('/report/get_inactive_schools', methods=['GET'])
@@ -238,40 +554,90 @@ def get_site_by_url(baseurl):
     Returns a combined JSONified of both Site and SiteDetail information
     for a given 'baseurl'.
     """
-    site = Site.query.filter_by(baseurl=baseurl).first()
-    if site:
-        site_details = SiteDetail.query.filter_by(site_id=site.id) \
-                                       .order_by(SiteDetail
-                                                 .timemodified
-                                                 .desc()) \
-                                       .first()
+    site_and_details = g.db_session.query(Site, SiteDetail).outerjoin(
+        Site.latest_site_detail
+    ).filter(Site.baseurl == baseurl).first()
 
-        site_info = dict(site.serialize().items() +
-                         site_details.serialize().items())
+    if site_and_details:
+        site, site_details = site_and_details
+        site_info = site.serialize()
+        if site_details:
+            site_info.update(site_details.serialize())
 
         return jsonify(content=site_info)
     return jsonify(content={'error': 'Site not found'})
 
 
-@mod.route('/celery/status/<celery_id>')
-def get_task_status(celery_id):
+@mod.route('/celery/status', methods=['GET', 'POST'])
+def get_statuses():
     """
-    Returns a JSONified status of a celery job identified by 'celery_id'.
+    Returns the JSONified statuses of many celery tasks, looked up at once.
+
+    The task ids are given as ?ids=, comma separated or repeated, as ids
+    form fields or as an 'ids' list in a JSON body, at most
+    MAX_TASK_STATUS_IDS of them.
     """
-    status = g.db_session.query("status").from_statement(
-        "SELECT status FROM celery_taskmeta WHERE id=:celery_id"
-    ).params(celery_id=celery_id).first()
-    return jsonify(status=status)
+    ids = []
+    body = request.get_json(silent=True)
+    if body and isinstance(body.get('ids'), list):
+        ids = [str(task_id) for task_id in body['ids']]
+    for value in request.values.getlist('ids'):
+        ids.extend(task_id for task_id in value.split(',') if task_id)
+
+    if len(ids) > MAX_TASK_STATUS_IDS:
+        abort(400)
+
+    return jsonify(statuses=get_task_statuses(ids))
+
+
+@mod.route('/installs/<batch_id>/stream')
+def stream_install_progress(batch_id):
+    """
+    Streams the progress of a batch of course installs as Server-Sent Events,
+    see progress.stream_batch. Resumes after the Last-Event-ID header or
+    ?after= event id.
+    """
+    after = request.headers.get('Last-Event-ID', None, type=int)
+    if after is None:
+        after = request.args.get('after', 0, type=int)
+
+    response = Response(stream_with_context(stream_batch(batch_id, after)),
+                        mimetype='text/event-stream')
+    response.cache_control.no_cache = True
+    # Stops nginx from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@mod.route('/installs/<batch_id>/events')
+def get_install_progress(batch_id):
+    """
+    Long-polling fallback of stream_install_progress. Returns the JSONified
+    events of a batch after the ?after= event id, waiting up to ?wait=
+    seconds (INSTALL_LONG_POLL_WAIT) for one. 'next' is the ?after= of the
+    following request, 'done' is true once every install has finished.
+    """
+    after = request.args.get('after', 0, type=int)
+    wait = request.args.get(
+        'wait', current_app.config.get('INSTALL_LONG_POLL_WAIT', 25), type=int
+    )
+
+    events, after, done = wait_for_batch(batch_id, after,
+                                         min(max(wait, 0), 60))
+    return jsonify(events=[event.serialize() for event in events],
+                   next=after,
+                   done=done)
 
 
 @mod.route("/report/stats", methods=['GET'])
+@cached_response
 def report_stats():
     """
     Get the stats of active users, teachers, admins, districts, schools, sites,
     and the numebr of total users and available courses
     """
 
-    return jsonify(get_active_counts())
+    return jsonify(report_counts())
 
 
 @mod.route('/get_site_by/<int:site_id>', methods=['GET'])
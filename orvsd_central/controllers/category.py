@@ -6,13 +6,14 @@ from flask import (Blueprint, abort, current_app, flash, g, render_template,
 from flask.ext.login import current_user, login_required
 from sqlalchemy import and_
 
+from orvsd_central.catalog import update_course_list
 from orvsd_central.forms import InstallCourse
-from orvsd_central.models import (Course, District, School, Site, SiteCourse,
-                                  SiteDetail)
-from orvsd_central.util import (create_course_from_moodle_backup,
-                                get_course_folders, get_path_and_source,
+from orvsd_central.models import (Course, District, School, Site,
+                                  SiteCourse, SiteDetail)
+from orvsd_central.util import (MASKED_COLUMNS, get_course_folders,
                                 get_obj_by_category, get_obj_identifier,
-                                install_course_to_site, requires_role)
+                                get_object_fields, get_site_courses,
+                                queue_course_installs, requires_role)
 
 mod = Blueprint('category', __name__)
 
@@ -27,7 +28,8 @@ All
 @login_required
 def update(category):
     """
-    Returns a rendered template that shows all objects in a given 'category'.
+    Returns a rendered template for browsing and editing the objects in a
+    given 'category'.
     """
     obj = get_obj_by_category(category)
     identifier = get_obj_identifier(category)
@@ -36,10 +38,12 @@ def update(category):
             category = category.split("details")[0] + " Details"
         category = category[0].upper() + category[1:]
 
-        objects = obj.query.order_by(identifier).all()
-        objects = objects if objects else []
+        # The objects are listed a page at a time by update_models.js,
+        # which may search and sort on the columns get_object_page allows
+        columns = [name for name in get_object_fields(obj)
+                   if name not in MASKED_COLUMNS]
         return render_template(
-            "update.html", objects=objects,
+            "update.html", columns=columns,
             identifier=identifier, category=category,
             user=current_user
         )
@@ -72,23 +76,15 @@ def install_course():
             .like('2%')
             ).all()
 
-        # Query all moodle sites
-        sites = g.db_session.query(Site).filter(
-            Site.sitetype == 'moodle')
-
-        moodle_2_sites = []
-
-        # For all sites query the SiteDetail to see if it's a moodle 2.x site
-        for site in sites:
-            details = g.db_session.query(SiteDetail).filter(
-                and_(
-                    SiteDetail.site_id == site.id,
-                    SiteDetail.siterelease.like('2%')
-                )
-            ).order_by(SiteDetail.timemodified.desc()).first()
-
-            if details is not None:
-                moodle_2_sites.append(site)
+        # Query all moodle sites whose latest details report a 2.x release
+        moodle_2_sites = g.db_session.query(Site).join(
+            Site.latest_site_detail
+        ).filter(
+            and_(
+                Site.sitetype == 'moodle',
+                SiteDetail.siterelease.like('2%')
+            )
+        ).all()
 
         # Generate the list of choices for the template
         courses_info = []
@@ -130,39 +126,38 @@ def install_course():
         # An array of unicode strings will be passed, they need to be integers
         # for the query
         selected_courses = [int(cid) for cid in request.form.getlist('course')]
-        site_ids = [site_id for site_id in request.form.getlist('site')]
-        sites = [Site.query.filter_by(id=site).first() for site in site_ids]
+        site_ids = [int(site_id) for site_id in request.form.getlist('site')]
 
+        sites = Site.query.filter(Site.id.in_(site_ids)).order_by(
+            Site.name
+        ).all() if site_ids else []
         course_details = g.db_session.query(Course).filter(
             Course.id.in_(selected_courses)
-        ).all()
+        ).all() if selected_courses else []
 
-        for site in sites:
-            # The site to install the courses
-            install_url = ("http://%s/webservice/rest/server.php?" +
-                           "wstoken=%s&wsfunction=%s") % (
-                        site.baseurl,
-                        site.get_token('orvsd_installcourse'),
-                        current_app.config['INSTALL_COURSE_WS_FUNCTION'])
-            install_url = str(install_url.encode('utf-8'))
-
-            # Loop through the courses, generate the command to be run, run it,
-            # and append the ouput to output
-            #
-            # Currently this will break as our db is not setup correctly yet
-            for course_detail in course_details:
-                res = install_course_to_site.delay(
-                    course_detail.id, install_url
-                )
-                result_data = SiteCourse(site.id, course_detail.id, res.id)
-                g.db_session.add(result_data)
-                g.db_session.commit()
+        # Every (site, course) install goes out as one batch
+        batch_id, skipped = queue_course_installs(sites, course_details)
 
-            output += (str(len(course_details)) + " course install(s) for " +
-                       site.name + " started.\n")
+        for site in sites:
+            if site in skipped:
+                output += "%s has no install token, skipped.\n" % site.name
+            else:
+                output += ("%d course install(s) for %s started.\n" %
+                           (len(course_details), site.name))
+
+        # The batch's installs, followed live on the page
+        installs = g.db_session.query(
+            SiteCourse.celery_task_id, Site.name, Course.name
+        ).join(Site, Site.id == SiteCourse.site_id).join(
+            Course, Course.id == SiteCourse.course_id
+        ).filter(
+            SiteCourse.install_batch_id == batch_id
+        ).order_by(Site.name, Course.name).all() if batch_id else []
 
         return render_template('install_course_output.html',
                                output=output,
+                               batch_id=batch_id,
+                               installs=installs,
                                user=current_user)
 
 
@@ -175,45 +170,22 @@ def update_courselist():
     and course detail entries, based on available files.
     """
     if request.method == "POST":
-        num_courses = 0
         base_path = current_app.config.get('INSTALL_COURSE_FILE_PATH', None)
-        mdl_files = []
 
         if base_path and os.path.exists(base_path):
+            # Only files added or changed since the last update are read
+            counts = update_course_list(base_path)
 
-            # Get a list of all moodle course files
-            # for source in os.listdir(base_path):
-            for root, sub_folders, files in os.walk(base_path):
-                for file in files:
-                    full_file_path = os.path.join(root, file)
-                    if os.path.isfile(full_file_path):
-                        mdl_files.append(full_file_path)
-
-            filenames = []
-            sources = []
-            for filename in mdl_files:
-                source, path = get_path_and_source(base_path, filename)
-                sources.append(source)
-                filenames.append(path)
-
-            courses = g.db_session.query(Course).filter(
-                Course.filename.in_(filenames)
-            ).all()
-
-            for course in courses:
-                if course.filename in filenames:
-                    sources.pop(filenames.index(course.filename))
-                    filenames.pop(filenames.index(course.filename))
-
-            for source, file_path in zip(sources, filenames):
-                create_course_from_moodle_backup(base_path, source, file_path)
-                num_courses += 1
-
-            if num_courses > 0:
+            if counts['courses'] > 0:
                 flash(
-                    "%s new courses added successfully!" % num_courses,
+                    "%s new courses added successfully!" % counts['courses'],
                     category='info'
                 )
+            if counts['failed'] > 0:
+                flash(
+                    "%s course files could not be read." % counts['failed'],
+                    category='error'
+                )
         else:
             flash(
                 "Invalid INSTALL_COURSE_FILE_PATH in your config",
@@ -261,58 +233,47 @@ def view_schools(id):
     # This should be an editable field on the template that modifies which
     # courses are shown via js.
     min_users = 1
+    page = request.args.get('page', 1, type=int)
+    per_page = current_app.config.get('SCHOOL_COURSES_PER_PAGE', 100)
 
     school = School.query.filter_by(id=id).first()
     # School license usually defaults to ''.
     school.license = school.license or None
 
-    # Keep them separated for organizational/display purposes
-    moodle_sites = g.db_session.query(Site).filter(and_(
-        Site.school_id == id,
-        Site.sitetype == 'moodle')).all()
-
-    drupal_sites = g.db_session.query(Site).filter(and_(
+    # Each of the school's sites along with its newest details
+    sites = g.db_session.query(Site, SiteDetail).outerjoin(
+        Site.latest_site_detail
+    ).filter(and_(
         Site.school_id == id,
-        Site.sitetype == 'drupal')).all()
-
-    if moodle_sites or drupal_sites:
-        moodle_sitedetails = []
-        for site in moodle_sites:
-            site_detail = SiteDetail.query.filter_by(site_id=site.id) \
-                .order_by(SiteDetail
-                          .timemodified
-                          .desc()) \
-                .first()
+        Site.sitetype.in_(['moodle', 'drupal']))).all()
 
+    # Keep them separated for organizational/display purposes
+    moodle_siteinfo = [(site, details) for site, details in sites
+                       if site.sitetype == 'moodle']
+    drupal_siteinfo = [(site, details) for site, details in sites
+                       if site.sitetype == 'drupal']
+
+    if moodle_siteinfo or drupal_siteinfo:
+        # Site id -> a page of its courses, and how many there are in all
+        site_courses = {}
+        for site, site_detail in moodle_siteinfo:
             if site_detail:
                 site_detail.adminlist = json.loads(site_detail.adminlist)
                 # Filter courses to display based on num of users.
-                if site_detail.courses:
-                    site_detail.courses = filter(
-                        lambda x: x['enrolled'] > min_users,
-                        json.loads(site_detail.courses)
-                    )
-            moodle_sitedetails.append(site_detail)
-
-        moodle_siteinfo = zip(moodle_sites, moodle_sitedetails)
-
-        drupal_sitedetails = []
-        for site in drupal_sites:
-            site_detail = SiteDetail.query.filter_by(site_id=site.id) \
-                .order_by(SiteDetail
-                          .timemodified
-                          .desc()) \
-                .first()
+                site_courses[site.id] = get_site_courses(
+                    site_detail.id, min_users, page, per_page
+                )
 
+        for site, site_detail in drupal_siteinfo:
             if site_detail:
                 site_detail.adminlist = json.loads(site_detail.adminlist)
-                drupal_sitedetails.append(site_detail)
-
-        drupal_siteinfo = zip(drupal_sites, drupal_sitedetails)
 
         return render_template("school.html", school=school,
                                moodle_siteinfo=moodle_siteinfo,
                                drupal_siteinfo=drupal_siteinfo,
+                               site_courses=site_courses,
+                               page=page,
+                               per_page=per_page,
                                user=current_user)
     else:
         return render_template("school_data_notfound.html", school=school,
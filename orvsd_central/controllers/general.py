@@ -8,6 +8,7 @@ from requests.exceptions import HTTPError
 from sqlalchemy.exc import IntegrityError
 
 from orvsd_central import constants
+from orvsd_central.cache import invalidate_user_cache
 from orvsd_central.forms import AddUser, LoginForm
 from orvsd_central.models import User
 from orvsd_central.util import (google, is_valid_email,
@@ -59,6 +60,8 @@ def register():
                 )
                 g.db_session.add(user)
                 g.db_session.commit()
+                # The id may be that of a deleted user still cached
+                invalidate_user_cache()
 
                 message = form.user.data + " has been added successfully!\n"
             except IntegrityError:
@@ -1,7 +1,7 @@
-from flask import Blueprint, g, render_template
+from flask import Blueprint, render_template
 from flask.ext.login import current_user, login_required
-from sqlalchemy.sql import func
-from orvsd_central.models import SiteDetail
+from orvsd_central.cache import cached
+from orvsd_central.snapshot import report_active_since
 
 import time
 
@@ -15,11 +15,16 @@ def index():
     Returns a rendered template for the index/report page.
     """
 
-    date_active_since = g.db_session.query(
-        func.max(SiteDetail.timemodified)
-    ).first()[0]
-    active_since = time.strftime("%b %d, %Y", date_active_since.timetuple())
-
     return render_template("report.html",
                            user=current_user,
-                           active_since=active_since)
+                           active_since=cached('active_since',
+                                               get_active_since))
+
+
+def get_active_since():
+    """
+    Returns the date of the most recent SiteDetail, for the report header.
+    """
+    date_active_since = report_active_since()
+    return time.strftime("%b %d, %Y", date_active_since.timetuple())
+
@@ -1,26 +1,112 @@
 import os
 
 from flask import current_app, g
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.exc import IntegrityError, ProgrammingError
 
 from orvsd_central.constants import USER_PERMS
 from orvsd_central.models import Model, User
 
+# Defaults for DATABASE_CONNECT_OPTIONS keys that are not set in the config.
+# pool_recycle stays below MySQL's default wait_timeout of 8 hours.
+DEFAULT_POOL_OPTIONS = {
+    'pool_size': 10,
+    'max_overflow': 20,
+    'pool_timeout': 30,
+    'pool_recycle': 3600,
+    'pool_pre_ping': True
+}
 
-def create_db_session():
-    # Get the db address from the current app
-    _db_address = current_app.config['SQLALCHEMY_DATABASE_URI']
+# Options that only apply to a QueuePool, sqlite uses a SingletonThreadPool
+# for in-memory databases which rejects them.
+QUEUE_POOL_OPTIONS = ['pool_size', 'max_overflow', 'pool_timeout']
+
+
+def ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """
+    Checks that a pooled connection is still alive before handing it out.
+    * A stale connection is discarded and the pool retries with a new one.
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("SELECT 1")
+    except Exception:
+        raise exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+
+def create_db_engine(db_address, options=None):
+    """
+    Creates a pooled engine for 'db_address'.
+
+    Args:
+        db_address (string): A valid SQLAlchemy database uri
+        options (dict): DATABASE_CONNECT_OPTIONS from the config, any missing
+            pool options are taken from DEFAULT_POOL_OPTIONS
+
+    Returns:
+        A SQLAlchemy engine
+    """
+    engine_options = dict(DEFAULT_POOL_OPTIONS)
+    engine_options.update(options or {})
+    pre_ping = engine_options.pop('pool_pre_ping')
+
+    if make_url(db_address).drivername.startswith('sqlite'):
+        for option in QUEUE_POOL_OPTIONS:
+            engine_options.pop(option, None)
+
+    engine = create_engine(db_address, convert_unicode=True, **engine_options)
+
+    if pre_ping:
+        event.listen(engine, 'checkout', ping_connection)
 
-    engine = create_engine(_db_address, convert_unicode=True)
-    db_session = scoped_session(sessionmaker(autocommit=False,
-                                             autoflush=False,
-                                             bind=engine))
+    return engine
+
+
+def get_engine():
+    """
+    Returns the engine shared by every request and task of the current app,
+    creating it on first use.
+    """
+    engine = current_app.extensions.get('db_engine')
+    if engine is None:
+        engine = create_db_engine(
+            current_app.config['SQLALCHEMY_DATABASE_URI'],
+            current_app.config.get('DATABASE_CONNECT_OPTIONS')
+        )
+        current_app.extensions['db_engine'] = engine
+    return engine
+
+
+def create_db_session():
+    """
+    Returns the current app's scoped session, bound to the shared engine.
+    * Sessions are thread local, g.db_session.remove() hands the connection
+      back to the pool.
+    """
+    db_session = current_app.extensions.get('db_session')
+    if db_session is None:
+        db_session = scoped_session(sessionmaker(autocommit=False,
+                                                 autoflush=False,
+                                                 bind=get_engine()))
+        current_app.extensions['db_session'] = db_session
     Model.query = db_session.query_property()
     return db_session
 
 
+def create_separate_session():
+    """
+    Returns a new session of its own, bound to the shared engine, for
+    bookkeeping that has to be committed whatever becomes of the current
+    session's transaction. The caller closes it.
+    """
+    return sessionmaker(autocommit=False, autoflush=False,
+                        bind=get_engine())()
+
+
 def create_admin_account(silent):
     """
     command 'create_admin'
@@ -0,0 +1,117 @@
+"""
+Exports of the usage report.
+
+The report is read straight from the sites and their SiteDetails, one row
+per site, and streamed in EXPORT_CHUNK_SIZE row chunks, each carrying on
+after the last site of the one before, see serialize. It can be narrowed to
+a district or a county.
+
+Without a date range each site is reported with its latest SiteDetail and,
+like the report page, every site of a school with one is listed. With a
+date range each site is reported with its newest SiteDetail gathered in the
+range, and only sites with one are listed.
+"""
+from flask import g
+from sqlalchemy import and_, exists
+from sqlalchemy.orm import aliased
+from sqlalchemy.sql import func
+
+from orvsd_central.models import (District, School, Site, SiteDetail,
+                                  SiteDetailCourse)
+from orvsd_central.serialize import iter_rows
+
+REPORT_COLUMNS = ['district', 'school', 'site', 'baseurl', 'totalusers',
+                  'activeusers', 'teachers', 'courses', 'admins']
+
+# Sites are reported by district, school and name, the chunks are keyed on
+# these. NULL names sort as empty ones.
+REPORT_ORDER = [func.coalesce(District.name, ''), District.id,
+                func.coalesce(School.name, ''), func.coalesce(Site.name, ''),
+                Site.id]
+
+
+def get_usage_report(dist_id=None, county=None, since=None, until=None):
+    """
+    Query of the usage report's rows, REPORT_COLUMNS and the SiteDetail's
+    id. It is unordered, iter_usage_report reads it in REPORT_ORDER.
+
+    Args:
+        dist_id (int): Only sites of this district
+        county (str): Only sites of schools in this county
+        since (datetime): Only SiteDetails gathered at or after this time
+        until (datetime): Only SiteDetails gathered before this time
+    """
+    if since is None and until is None:
+        # Sites of schools with at least one site that has reported details
+        reporting_site = aliased(Site)
+        active_school = exists().where(and_(
+            reporting_site.school_id == School.id,
+            reporting_site.latest_site_detail_id.isnot(None)
+        ))
+        detail_id = Site.latest_site_detail_id
+    else:
+        # The newest of each site's SiteDetails in the range
+        in_range = aliased(SiteDetail)
+        newest = g.db_session.query(in_range.id).filter(
+            in_range.site_id == Site.id
+        )
+        if since is not None:
+            newest = newest.filter(in_range.timemodified >= since)
+        if until is not None:
+            newest = newest.filter(in_range.timemodified < until)
+        detail_id = newest.order_by(
+            in_range.timemodified.desc(), in_range.id.desc()
+        ).limit(1).correlate(Site).as_scalar()
+        active_school = None
+
+    course_count = g.db_session.query(
+        func.count(SiteDetailCourse.id)
+    ).filter(
+        SiteDetailCourse.site_detail_id == SiteDetail.id
+    ).correlate(SiteDetail).as_scalar()
+
+    rows = g.db_session.query(
+        District.name,
+        School.name,
+        Site.name,
+        Site.baseurl,
+        SiteDetail.totalusers,
+        SiteDetail.activeusers,
+        SiteDetail.teachers,
+        course_count,
+        SiteDetail.adminusers,
+        SiteDetail.id
+    ).join(
+        School, School.district_id == District.id
+    ).join(
+        Site, Site.school_id == School.id
+    )
+
+    if active_school is not None:
+        rows = rows.outerjoin(
+            SiteDetail, SiteDetail.id == detail_id
+        ).filter(active_school)
+    else:
+        rows = rows.join(SiteDetail, SiteDetail.id == detail_id)
+
+    if dist_id is not None:
+        rows = rows.filter(District.id == dist_id)
+    if county is not None:
+        rows = rows.filter(School.county == county)
+
+    return rows
+
+
+def iter_usage_report(dist_id=None, county=None, since=None, until=None):
+    """
+    Generates the usage report, see get_usage_report, as a dict of
+    REPORT_COLUMNS per site. A site without a SiteDetail has None for its
+    counts.
+    """
+    query = get_usage_report(dist_id, county, since, until)
+    for row in iter_rows(query, REPORT_ORDER):
+        report = dict(zip(REPORT_COLUMNS, row))
+        if row[-1] is None:
+            # Counted for the missing SiteDetail of the outer join
+            report['courses'] = None
+        yield report
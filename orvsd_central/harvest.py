@@ -0,0 +1,412 @@
+"""
+Concurrent harvesting of siteinfo and tokens from moodle sites.
+
+Requests to the sites run on a pool of threads while everything that touches
+the database stays on the calling thread, where results are committed in
+batches.
+
+Each site's siteinfo harvests are scheduled by how often its siteinfo
+changes: the interval halves when it has changed and doubles when it has not,
+between HARVEST_MIN_INTERVAL and HARVEST_MAX_INTERVAL hours. Dev sites always
+wait the longest interval.
+
+Sites added in bulk are harvested by the harvest_new_sites celery task, on a
+worker rather than in the request that added them.
+"""
+from collections import defaultdict
+from datetime import datetime, timedelta
+from functools import partial
+import logging
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+import time
+
+from flask import current_app, g
+import requests
+from sqlalchemy import or_
+from sqlalchemy.orm import contains_eager, joinedload
+
+from orvsd_central.cache import report_changed
+from orvsd_central.database import create_db_session
+from orvsd_central.models import HarvestSchedule, Site
+from orvsd_central.util import (MoodleError, celery, fetch_siteinfo,
+                                fetch_token, get_site_url, moodle_timeout,
+                                store_siteinfo)
+
+# Failures after which the rest of a site's token requests are skipped
+UNREACHABLE = ['timeout', 'connection']
+
+
+class HarvestSummary(object):
+    """
+    Collects the outcome of a harvest for reporting at the end of a run.
+
+    succeeded : number of sites that answered without errors
+    skipped   : number of sites that were not requested
+    failures  : failure kind -> list of baseurls
+    timings   : list of (seconds, baseurl) for every site that answered
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.finished = None
+        self.succeeded = 0
+        self.skipped = 0
+        self.failures = defaultdict(list)
+        self.timings = []
+
+    def add_result(self, baseurl, elapsed, failures=()):
+        """
+        Records a site that answered, failures are the kinds of any errors.
+        """
+        self.timings.append((elapsed, baseurl))
+        if failures:
+            for kind in sorted(set(failures)):
+                self.failures[kind].append(baseurl)
+        else:
+            self.succeeded += 1
+
+    def add_unfinished(self, baseurl):
+        """
+        Records a site that had not answered by the deadline.
+        """
+        self.failures['deadline'].append(baseurl)
+
+    def finish(self):
+        self.finished = time.time()
+
+    def failed(self):
+        return len(set(baseurl for baseurls in self.failures.values()
+                       for baseurl in baseurls))
+
+    def sites_per_second(self):
+        elapsed = (self.finished or time.time()) - self.started
+        return len(self.timings) / elapsed if elapsed else 0.0
+
+    def slowest(self, count=5):
+        return sorted(self.timings, reverse=True)[:count]
+
+    def report(self, slowest=5):
+        """
+        Returns a printable summary of the harvest.
+        """
+        lines = [
+            "Harvested %d sites, %d failed, %d skipped (%.2f sites/s)" % (
+                self.succeeded,
+                self.failed(),
+                self.skipped,
+                self.sites_per_second()
+            )
+        ]
+
+        if self.failures:
+            lines.append("Failures:")
+            for kind, baseurls in sorted(self.failures.items()):
+                lines.append("\t%s (%d): %s" % (kind, len(baseurls),
+                                                ', '.join(sorted(baseurls))))
+
+        if self.timings:
+            lines.append("Slowest sites:")
+            for elapsed, baseurl in self.slowest(slowest):
+                lines.append("\t%.2fs %s" % (elapsed, baseurl))
+
+        return '\n'.join(lines)
+
+
+def get_harvest_sites(full=False, now=None):
+    """
+    Returns the sites a siteinfo harvest should request, with their schedules
+    loaded.
+
+    full -- Harvest every site, ignoring schedules
+    now  -- Sites whose next harvest is after this time are left out
+    """
+    if full:
+        return Site.query.options(joinedload(Site.harvest_schedule)).all()
+
+    now = now or datetime.now()
+    return g.db_session.query(Site).outerjoin(
+        Site.harvest_schedule
+    ).options(
+        contains_eager(Site.harvest_schedule)
+    ).filter(or_(
+        HarvestSchedule.next_harvest.is_(None),
+        HarvestSchedule.next_harvest <= now
+    )).all()
+
+
+def schedule_next_harvest(site, changed, now=None):
+    """
+    Records a harvest of the site and schedules its next one.
+
+    site    -- The harvested site
+    changed -- Whether the site's siteinfo differed from its last SiteDetail.
+               Failed harvests count as unchanged, so dead sites back off.
+    now     -- Time the harvest started, the next one is measured from it
+    """
+    now = now or datetime.now()
+    floor = current_app.config.get('HARVEST_MIN_INTERVAL', 6)
+    ceiling = current_app.config.get('HARVEST_MAX_INTERVAL', 168)
+
+    schedule = site.harvest_schedule
+    if schedule is None:
+        schedule = HarvestSchedule(interval=floor, harvests=0, changes=0)
+        site.harvest_schedule = schedule
+
+    schedule.harvests += 1
+    if changed:
+        schedule.changes += 1
+        schedule.last_changed = now
+
+    if site.dev:
+        schedule.interval = ceiling
+    elif changed:
+        schedule.interval = max(floor, (schedule.interval or floor) / 2.0)
+    else:
+        schedule.interval = min(ceiling, (schedule.interval or floor) * 2.0)
+
+    schedule.next_harvest = now + timedelta(hours=schedule.interval)
+
+
+def run_concurrently(func, jobs, workers, deadline):
+    """
+    Calls func(job) for every job on a pool of threads, yielding the results
+    on the calling thread as they complete.
+
+    Once 'deadline' seconds have passed no more results are yielded, the
+    caller can tell which jobs are missing from the results it has seen.
+    """
+    if not jobs:
+        return
+
+    pool = ThreadPool(min(workers, len(jobs)))
+    results = pool.imap_unordered(func, jobs)
+    ends_at = time.time() + deadline
+
+    try:
+        for _ in jobs:
+            yield results.next(timeout=max(ends_at - time.time(), 0))
+    except TimeoutError:
+        logging.error("Harvest deadline of %ss reached" % deadline)
+    finally:
+        # Workers still waiting on a site are abandoned, their requests are
+        # bounded by the timeout
+        pool.terminate()
+
+
+def _fetch_siteinfo(job, active_since, timeout):
+    """
+    Runs on a worker thread, returns (site_id, info, error, elapsed) where
+    exactly one of info and error is set.
+    """
+    site_id, baseurl, token = job
+    started = time.time()
+    try:
+        info = fetch_siteinfo(baseurl, token, active_since, timeout)
+        error = None
+    except MoodleError as e:
+        info = None
+        error = e
+    except Exception as e:
+        # Anything unexpected is still only one site's problem
+        info = None
+        error = MoodleError(type(e).__name__, str(e))
+    return site_id, info, error, time.time() - started
+
+
+def _fetch_tokens(job, services, username, password, timeout):
+    """
+    Runs on a worker thread, returns (site_id, tokens, errors, elapsed) where
+    tokens maps services to tokens and errors is a list of (service, error).
+
+    Every service of a site is requested over one keep-alive connection.
+    """
+    site_id, baseurl = job
+    site_url = get_site_url(baseurl)
+    session = requests.Session()
+    tokens = {}
+    errors = []
+    started = time.time()
+
+    try:
+        for service in services:
+            try:
+                tokens[service] = fetch_token(site_url, service, username,
+                                              password, timeout, session)
+            except MoodleError as e:
+                errors.append((service, e))
+                # No point waiting on the rest if the site is not there
+                if e.kind in UNREACHABLE:
+                    break
+            except Exception as e:
+                errors.append((service, MoodleError(type(e).__name__,
+                                                    str(e))))
+    finally:
+        session.close()
+
+    return site_id, tokens, errors, time.time() - started
+
+
+def harvest_siteinfo(sites, workers=None, timeout=None, deadline=None,
+                     batch_size=None):
+    """
+    Gathers siteinfo for many sites at once.
+
+    Args:
+        sites (list): Sites to harvest
+        workers (int): Number of concurrent requests, HARVEST_WORKERS
+        timeout: Seconds, or a (connect, read) tuple, for each request.
+            Defaults to moodle_timeout()
+        deadline (int): Seconds the whole harvest may take, HARVEST_DEADLINE.
+            Sites still outstanding are recorded as 'deadline' failures.
+        batch_size (int): SiteDetails per commit, HARVEST_BATCH_SIZE
+
+    Every requested site has its next harvest scheduled, see
+    schedule_next_harvest.
+
+    Returns:
+        HarvestSummary
+    """
+    config = current_app.config
+    workers = workers or config.get('HARVEST_WORKERS', 8)
+    timeout = timeout or moodle_timeout()
+    deadline = deadline or config.get('HARVEST_DEADLINE', 1800)
+    batch_size = batch_size or config.get('HARVEST_BATCH_SIZE', 50)
+
+    summary = HarvestSummary()
+    started = datetime.now()
+
+    active_since = config.get('MOODLE_ACTIVE_SINCE', None)
+    if not active_since:
+        logging.error(
+            'MOODLE_ACTIVE_SINCE not defined in configuration settings.'
+        )
+        summary.finish()
+        return summary
+
+    # Read everything the workers need up front, the ORM stays on this thread
+    outstanding = {}
+    jobs = []
+    for site in sites:
+        token = site.get_token('orvsd_siteinfo')
+        if not token or not site.baseurl:
+            summary.skipped += 1
+            continue
+        outstanding[site.id] = site
+        jobs.append((site.id, site.baseurl, token))
+
+    uncommitted = 0
+    fetch = partial(_fetch_siteinfo, active_since=active_since,
+                    timeout=timeout)
+
+    for site_id, info, error, elapsed in run_concurrently(fetch, jobs,
+                                                          workers, deadline):
+        site = outstanding.pop(site_id)
+
+        if error:
+            logging.error("%s: %s" % (site.name, error))
+            summary.add_result(site.baseurl, elapsed, [error.kind])
+            schedule_next_harvest(site, False, started)
+            continue
+
+        site_details, changed = store_siteinfo(site, info)
+        summary.add_result(site.baseurl, elapsed)
+        schedule_next_harvest(site, changed, started)
+
+        uncommitted += 1
+        if uncommitted >= batch_size:
+            g.db_session.commit()
+            uncommitted = 0
+
+    # Sites left over at the deadline stay due for the next run
+    for site in outstanding.values():
+        summary.add_unfinished(site.baseurl)
+
+    g.db_session.commit()
+    if summary.timings:
+        report_changed()
+    summary.finish()
+
+    return summary
+
+
+def harvest_tokens(sites, services=None, workers=None, timeout=None,
+                   deadline=None, batch_size=None):
+    """
+    Gathers tokens for every service of many sites at once. Takes the same
+    arguments as harvest_siteinfo, plus:
+
+    services (list): Services to get tokens for, MOODLE_SERVICES by default
+
+    Returns:
+        HarvestSummary
+    """
+    config = current_app.config
+    services = services or config['MOODLE_SERVICES']
+    workers = workers or config.get('HARVEST_WORKERS', 8)
+    timeout = timeout or moodle_timeout()
+    deadline = deadline or config.get('HARVEST_DEADLINE', 1800)
+    batch_size = batch_size or config.get('HARVEST_BATCH_SIZE', 50)
+
+    summary = HarvestSummary()
+
+    outstanding = {}
+    jobs = []
+    for site in sites:
+        if not site.baseurl or not services:
+            summary.skipped += 1
+            continue
+        outstanding[site.id] = site
+        jobs.append((site.id, site.baseurl))
+
+    uncommitted = 0
+    fetch = partial(_fetch_tokens, services=services,
+                    username=config['INSTALL_COURSE_USERNAME'],
+                    password=config['INSTALL_COURSE_PASS'],
+                    timeout=timeout)
+
+    for site_id, tokens, errors, elapsed in run_concurrently(fetch, jobs,
+                                                             workers,
+                                                             deadline):
+        site = outstanding.pop(site_id)
+
+        for service, error in errors:
+            logging.error("%s: %s: %s" % (site.name, service, error))
+
+        for service, token in tokens.items():
+            site.add_token(service, token)
+
+        summary.add_result(site.baseurl, elapsed,
+                           [error.kind for service, error in errors])
+
+        if tokens:
+            uncommitted += 1
+            if uncommitted >= batch_size:
+                g.db_session.commit()
+                uncommitted = 0
+
+    for site in outstanding.values():
+        summary.add_unfinished(site.baseurl)
+
+    g.db_session.commit()
+    summary.finish()
+
+    return summary
+
+
+@celery.task(name='tasks.harvest_new_sites')
+def harvest_new_sites(site_ids):
+    """
+    Gathers the tokens and then the siteinfo of newly added sites.
+
+    Args:
+        site_ids (list): The sites' ids
+
+    Returns:
+        int. The number of sites harvested
+    """
+    g.db_session = create_db_session()
+    sites = Site.query.filter(Site.id.in_(site_ids)).all()
+    harvest_tokens(sites)
+    harvest_siteinfo(sites)
+    return len(sites)
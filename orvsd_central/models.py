@@ -1,8 +1,9 @@
 import json
 import logging
 
-from sqlalchemy import (Boolean, Column, DateTime, Enum, Float, ForeignKey,
-                        Integer, SmallInteger, String, Text)
+from sqlalchemy import (BigInteger, Boolean, Column, DateTime, Enum, Float,
+                        ForeignKey, Index, Integer, SmallInteger, String,
+                        Text)
 from sqlalchemy.orm import backref, relationship
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -20,9 +21,14 @@ class SiteCourse(Model):
     course_id           : the course's id
     active              : state of the course on the site
     moodle_course_id    : The course id determined by moodle
+    celery_task_id      : id of the celery task installing the course
+    install_batch_id    : id of the celery group the install was part of
     """
 
     __tablename__ = 'sites_courses'
+    __table_args__ = (
+        Index('ix_sites_courses_site_id_course_id', 'site_id', 'course_id'),
+    )
 
     id = Column(Integer, primary_key=True)
     site_id = Column(
@@ -43,6 +49,8 @@ class SiteCourse(Model):
     )
     active = Column(Boolean, default=False)
     moodle_course_id = Column(Integer)
+    celery_task_id = Column(String(255), index=True)
+    install_batch_id = Column(String(255), index=True)
 
 
 class User(Model):
@@ -153,6 +161,9 @@ class School(Model):
     district    : The district with which the school is associated
     """
     __tablename__ = 'schools'
+    __table_args__ = (
+        Index('ix_schools_district_id', 'district_id'),
+    )
 
     id = Column(Integer, primary_key=True)
     district_id = Column(Integer,
@@ -198,8 +209,15 @@ class Site(Model):
     jenkins_cron_job : Last run of jenkins cron job, if there is one
     location         : What machine the site is on, or is it in the cloud
     moodle_tokens    : Moodle plugins - service -> token (json)
+    latest_site_detail_id : Points to the site's most recent SiteDetail, kept
+                          : up to date by util.gather_siteinfo()
     """
     __tablename__ = 'sites'
+    __table_args__ = (
+        Index('ix_sites_baseurl', 'baseurl'),
+        Index('ix_sites_school_id_sitetype', 'school_id', 'sitetype'),
+        Index('ix_sites_sitetype', 'sitetype'),
+    )
 
     id = Column(Integer, primary_key=True)
     school_id = Column(Integer, ForeignKey('schools.id',
@@ -213,8 +231,23 @@ class Site(Model):
     jenkins_cron_job = Column(DateTime)
     location = Column(String(255))
     moodle_tokens = Column(String(2048), default="{}")
+    latest_site_detail_id = Column(
+        Integer,
+        ForeignKey(
+            'site_details.id',
+            use_alter=True,
+            name='fk_sites_latest_site_detail_id'
+        )
+    )
 
-    site_details = relationship("SiteDetail", backref=backref('sites'))
+    site_details = relationship("SiteDetail",
+                                foreign_keys='SiteDetail.site_id',
+                                backref=backref('sites'))
+    # post_update lets the pointer be set in the same flush that inserts the
+    # SiteDetail it points to.
+    latest_site_detail = relationship("SiteDetail",
+                                      foreign_keys=[latest_site_detail_id],
+                                      post_update=True)
     courses = relationship("Course",
                            secondary='sites_courses',
                            backref='sites')
@@ -300,7 +333,7 @@ class SiteDetail(Model):
     siteinfo tables, except the date - a new record is added with each
     update. See siteinfo notes.
 
-    courses      : A list of courses
+    courses      : A list of courses as JSON, also stored in enrolments
     siteversion  : A moodle style version such as 2014121900
     siterelease  : Moodle version such as 2.7
     adminlist    : JSON object of current site admins
@@ -310,6 +343,10 @@ class SiteDetail(Model):
     timemodified : Date set by the time of the call to util.gather_siteinfo()
     """
     __tablename__ = 'site_details'
+    __table_args__ = (
+        Index('ix_site_details_site_id_timemodified',
+              'site_id', 'timemodified'),
+    )
 
     id = Column(Integer, primary_key=True)
     site_id = Column(Integer, ForeignKey('sites.id',
@@ -326,6 +363,10 @@ class SiteDetail(Model):
     totalcourses = Column(Integer)
     timemodified = Column(DateTime)
 
+    enrolments = relationship("SiteDetailCourse",
+                              cascade="all, delete-orphan",
+                              backref="site_detail")
+
     def __repr__(self):
         return ("<SiteDetail('%s','%s','%s','%s','%s',"
                 "'%s','%s','%s','%s','%s','%s')>" % (
@@ -357,6 +398,81 @@ class SiteDetail(Model):
                 'timemodified': self.timemodified}
 
 
+class SiteDetailCourse(Model):
+    """
+    A course listed in a SiteDetail's siteinfo, with its enrolment.
+    * The same entries as SiteDetail.courses, so they can be counted,
+    * filtered and paged in SQL.
+
+    site_detail_id : the SiteDetail's id
+    serial         : the course's serial
+    shortname      : the course's short name on the site
+    fullname       : the course's full name on the site
+    enrolled       : number of users enrolled in the course
+    """
+    __tablename__ = 'site_detail_courses'
+    __table_args__ = (
+        Index('ix_site_detail_courses_site_detail_enrolled',
+              'site_detail_id', 'enrolled'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    site_detail_id = Column(Integer,
+                            ForeignKey('site_details.id',
+                                       name='fk_site_detail_courses_'
+                                            'site_detail_id'),
+                            nullable=False)
+    serial = Column(String(255))
+    shortname = Column(String(255))
+    fullname = Column(String(255))
+    enrolled = Column(Integer)
+
+    def __repr__(self):
+        return "<SiteDetailCourse('%s','%s','%s')>" % \
+               (self.site_detail_id, self.shortname, self.enrolled)
+
+    def serialize(self):
+        return {'serial': self.serial,
+                'shortname': self.shortname,
+                'fullname': self.fullname,
+                'enrolled': self.enrolled}
+
+
+class HarvestSchedule(Model):
+    """
+    When a site's siteinfo is next gathered, adapted to how often it changes.
+    * Each site has at most one schedule, created by its first harvest.
+
+    site_id      : the site's id
+    interval     : hours between harvests of the site
+    next_harvest : the site is skipped by scheduled harvests until this time
+    harvests     : number of times the site has been harvested
+    changes      : number of harvests where the siteinfo had changed
+    last_changed : time of the last harvest where the siteinfo had changed
+    """
+    __tablename__ = 'harvest_schedules'
+
+    site_id = Column(Integer,
+                     ForeignKey('sites.id',
+                                use_alter=True,
+                                name='fk_harvest_schedules_site_id'),
+                     primary_key=True)
+    interval = Column(Float)
+    next_harvest = Column(DateTime, index=True)
+    harvests = Column(Integer, default=0)
+    changes = Column(Integer, default=0)
+    last_changed = Column(DateTime)
+
+    # The site_id is the key, so the schedule goes with its site
+    site = relationship("Site",
+                        backref=backref('harvest_schedule', uselist=False,
+                                        cascade='all, delete-orphan'))
+
+    def __repr__(self):
+        return "<HarvestSchedule('%s','%s','%s')>" % \
+               (self.site_id, self.interval, self.next_harvest)
+
+
 class Course(Model):
     """
     A Model representation of a Course.
@@ -377,6 +493,13 @@ class Course(Model):
     """
 
     __tablename__ = 'courses'
+    # MySQL can only index the start of TEXT columns
+    __table_args__ = (
+        Index('ix_courses_source_filename', 'source', 'filename',
+              mysql_length={'source': 64, 'filename': 255}),
+        Index('ix_courses_filename', 'filename', mysql_length=255),
+        Index('ix_courses_name', 'name', mysql_length=255),
+    )
 
     id = Column(Integer, primary_key=True)
     name = Column(Text)
@@ -417,3 +540,220 @@ class Course(Model):
             'updated': self.updated,
             'version': self.version
         }
+
+
+class CourseFile(Model):
+    """
+    The manifest of course backup files under INSTALL_COURSE_FILE_PATH, as of
+    the last course list update. Only files that were added or changed since
+    then are read again.
+
+    path      : Path of the file relative to INSTALL_COURSE_FILE_PATH
+    size      : Size of the file in bytes
+    mtime     : Modification time of the file in seconds since the epoch
+    course_id : The course read from the file, None if it could not be read
+    """
+    __tablename__ = 'course_files'
+    # Every course list update looks files up by path. MySQL can not index
+    # all of a String(1024), its first 255 characters tell them apart.
+    __table_args__ = (
+        Index('ix_course_files_path', 'path', mysql_length=255),
+    )
+
+    id = Column(Integer, primary_key=True)
+    path = Column(String(1024))
+    size = Column(BigInteger)
+    mtime = Column(Integer)
+    course_id = Column(Integer,
+                       ForeignKey('courses.id',
+                                  use_alter=True,
+                                  name='fk_course_files_course_id'))
+
+    course = relationship("Course")
+
+    def __repr__(self):
+        return "<CourseFile('%s','%s','%s','%s')>" % \
+               (self.path, self.size, self.mtime, self.course_id)
+
+
+class ReportSnapshot(Model):
+    """
+    The report as of the end of a harvest, with its global totals.
+    * Readers only use the newest complete snapshot, a few older ones are
+    * kept for comparison.
+
+    created      : when the snapshot was started
+    complete     : set once all of its rows are written
+    stale        : set when an edit changed what it was built from
+    active_since : time of the newest SiteDetail
+    The rest are the totals of get_active_counts.
+    """
+    __tablename__ = 'report_snapshots'
+
+    id = Column(Integer, primary_key=True)
+    created = Column(DateTime)
+    complete = Column(Boolean, default=False, index=True)
+    stale = Column(Boolean, default=False)
+    active_since = Column(DateTime)
+    districts = Column(Integer)
+    schools = Column(Integer)
+    sites = Column(Integer)
+    courses = Column(Integer)
+    admins = Column(Integer)
+    teachers = Column(Integer)
+    totalusers = Column(Integer)
+    activeusers = Column(Integer)
+
+    def __repr__(self):
+        return "<ReportSnapshot('%s','%s','%s')>" % \
+               (self.id, self.created, self.complete)
+
+
+class ReportSnapshotDistrict(Model):
+    """
+    An active district's totals in a ReportSnapshot.
+
+    snapshot_id : the snapshot's id
+    district_id : the district's id
+    name        : the district's name
+    shortname   : the district's shortname
+    schools     : number of active schools in the district
+    sites       : number of sites of those schools
+    The rest are totals over those sites' newest SiteDetails.
+    """
+    __tablename__ = 'report_snapshot_districts'
+    __table_args__ = (
+        Index('ix_report_snapshot_districts_snapshot_district',
+              'snapshot_id', 'district_id'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    snapshot_id = Column(Integer, ForeignKey('report_snapshots.id'))
+    district_id = Column(Integer)
+    name = Column(String(255))
+    shortname = Column(String(255))
+    schools = Column(Integer)
+    sites = Column(Integer)
+    admins = Column(Integer)
+    teachers = Column(Integer)
+    totalusers = Column(Integer)
+    activeusers = Column(Integer)
+
+
+class ReportSnapshotSite(Model):
+    """
+    A site of an active school in a ReportSnapshot, in report order.
+
+    snapshot_id : the snapshot's id
+    district_id : the site's district's id
+    school_id   : the site's school's id
+    site_id     : the site's id
+    The rest are copied from the district, school, site and the site's
+    newest SiteDetail, and are None if it has none. courses is the number
+    of courses on the site.
+    """
+    __tablename__ = 'report_snapshot_sites'
+    __table_args__ = (
+        Index('ix_report_snapshot_sites_snapshot_district',
+              'snapshot_id', 'district_id'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    snapshot_id = Column(Integer, ForeignKey('report_snapshots.id'))
+    district_id = Column(Integer)
+    district_name = Column(String(255))
+    district_shortname = Column(String(255))
+    school_id = Column(Integer)
+    school_name = Column(String(255))
+    site_id = Column(Integer)
+    site_name = Column(String(255))
+    baseurl = Column(String(255))
+    adminlist = Column(Text)
+    teachers = Column(Integer)
+    activeusers = Column(Integer)
+    totalusers = Column(Integer)
+    courses = Column(Integer)
+
+
+class InstallHostSlot(Model):
+    """
+    One of the install slots of a moodle host. An install holds a slot while
+    it posts to the host, so each host only has as many installs at once as
+    it has slots, whichever worker runs them.
+
+    host    : the site's host, or its location, see scheduler.get_install_host
+    slot    : number of the slot, from 0
+    task_id : celery task holding the slot, None when free
+    expires : the slot is free after this even if it was never released
+    """
+    __tablename__ = 'install_host_slots'
+
+    host = Column(String(255), primary_key=True)
+    slot = Column(Integer, primary_key=True, autoincrement=False)
+    task_id = Column(String(255))
+    expires = Column(DateTime)
+
+
+class InstallDeadLetter(Model):
+    """
+    A course install that was given up on, kept so it can be looked into and
+    queued again.
+
+    task_id   : the celery task's id
+    site_id   : the site the course was being installed to
+    course_id : the course, None if it had been deleted
+    host      : the host the install was limited by
+    attempts  : number of times the install was tried
+    error     : the last error
+    failed    : when the install was given up on
+    """
+    __tablename__ = 'install_dead_letters'
+
+    id = Column(Integer, primary_key=True)
+    task_id = Column(String(255), index=True)
+    # Letters go with their site or course, they can not be requeued
+    site_id = Column(Integer,
+                     ForeignKey('sites.id',
+                                use_alter=True,
+                                name='fk_install_dead_letters_site_id',
+                                ondelete='CASCADE'))
+    course_id = Column(Integer,
+                       ForeignKey('courses.id',
+                                  use_alter=True,
+                                  name='fk_install_dead_letters_course_id',
+                                  ondelete='CASCADE'))
+    host = Column(String(255))
+    attempts = Column(Integer)
+    error = Column(Text)
+    failed = Column(DateTime)
+
+    def __repr__(self):
+        return "<InstallDeadLetter('%s','%s','%s','%s')>" % \
+               (self.site_id, self.course_id, self.host, self.error)
+
+
+class InstallEvent(Model):
+    """
+    A change in the state of a course install, published by the worker
+    running it and streamed to the browser following its batch.
+
+    task_id : the install's celery task id
+    status  : STARTED, RETRY, SUCCESS or FAILURE
+    message : what happened, the error for RETRY and FAILURE
+    created : when it happened
+    """
+    __tablename__ = 'install_events'
+
+    id = Column(Integer, primary_key=True)
+    task_id = Column(String(255), index=True)
+    status = Column(String(32))
+    message = Column(Text)
+    created = Column(DateTime, index=True)
+
+    def serialize(self):
+        return {'id': self.id,
+                'task_id': self.task_id,
+                'status': self.status,
+                'message': self.message,
+                'created': self.created.isoformat()
+                if self.created else None}
@@ -0,0 +1,216 @@
+"""
+Live progress of course install batches.
+
+Workers publish an InstallEvent each time an install starts, is retried,
+succeeds or is given up on, in a session of its own committed at once. The
+events form an append only log with increasing ids, so following a batch is
+mostly an indexed query for the events after the last one seen. Browsers
+follow a batch as a Server-Sent Events stream, whose event ids let
+EventSource resume where it left off after a reconnect, or by long-polling
+when they have no EventSource.
+
+Ids are handed out before the events are committed, so one may commit after
+a later one has been read. Each poll also reads the latest event of every
+install that has not finished, and sends it if it was missed.
+
+A batch is done once each of its installs has a SUCCESS or FAILURE event.
+"""
+from datetime import datetime, timedelta
+import json
+import time
+
+from flask import current_app, g
+from sqlalchemy import func
+
+from orvsd_central.database import create_separate_session
+from orvsd_central.models import InstallEvent, SiteCourse
+
+FINISHED_STATES = ['SUCCESS', 'FAILURE']
+
+
+def publish_progress(task_id, status, message=None):
+    """
+    Records a change in an install's state, committed at once so followers
+    of its batch see it.
+    """
+    db_session = create_separate_session()
+    try:
+        db_session.add(InstallEvent(task_id=task_id,
+                                    status=status,
+                                    message=message,
+                                    created=datetime.now()))
+        db_session.commit()
+    finally:
+        db_session.close()
+
+
+def get_batch_events(batch_id, after=0):
+    """
+    Returns the events of a batch's installs after the event id 'after', in
+    the order they happened.
+    """
+    return InstallEvent.query.join(
+        SiteCourse, SiteCourse.celery_task_id == InstallEvent.task_id
+    ).filter(
+        SiteCourse.install_batch_id == batch_id,
+        InstallEvent.id > after
+    ).order_by(InstallEvent.id).all()
+
+
+def get_batch_tasks(batch_id):
+    """
+    Returns the task ids of a batch's installs.
+    """
+    return set(task_id for task_id, in g.db_session.query(
+        SiteCourse.celery_task_id
+    ).filter(
+        SiteCourse.install_batch_id == batch_id
+    ))
+
+
+def get_latest_events(task_ids, until):
+    """
+    Returns the latest event, up to the event id 'until', of each task.
+    """
+    if not task_ids:
+        return []
+
+    latest = g.db_session.query(
+        func.max(InstallEvent.id).label('id')
+    ).filter(
+        InstallEvent.task_id.in_(task_ids),
+        InstallEvent.id <= until
+    ).group_by(InstallEvent.task_id).subquery()
+    return InstallEvent.query.join(
+        latest, latest.c.id == InstallEvent.id
+    ).order_by(InstallEvent.id).all()
+
+
+def get_finished_tasks(batch_id, until):
+    """
+    Returns the ids of a batch's tasks that finished by the event id 'until'.
+    """
+    return set(task_id for task_id, in g.db_session.query(
+        InstallEvent.task_id
+    ).join(
+        SiteCourse, SiteCourse.celery_task_id == InstallEvent.task_id
+    ).filter(
+        SiteCourse.install_batch_id == batch_id,
+        InstallEvent.status.in_(FINISHED_STATES),
+        InstallEvent.id <= until
+    ))
+
+
+def follow_batch(batch_id, after=0, timeout=None):
+    """
+    Generates a batch's events as they are published, polling every
+    INSTALL_EVENTS_POLL seconds.
+
+    Args:
+        batch_id (str): The batch's id
+        after (int): Only events after this event id
+        timeout (int): Seconds to wait for more events, INSTALL_STREAM_TIMEOUT
+
+    Yields:
+        tuple. The new events, empty when a poll found none, the event id to
+        resume after and whether every install of the batch has finished.
+        Stops once they have or the timeout has passed.
+    """
+    poll = current_app.config.get('INSTALL_EVENTS_POLL', 1)
+    if timeout is None:
+        timeout = current_app.config.get('INSTALL_STREAM_TIMEOUT', 300)
+    deadline = time.time() + timeout
+
+    unfinished = get_batch_tasks(batch_id) - \
+        get_finished_tasks(batch_id, after)
+    # The latest event of each task the follower has
+    seen = dict((event.task_id, event.id)
+                for event in get_latest_events(unfinished, after))
+
+    while True:
+        events = get_batch_events(batch_id, after)
+        # Committed after events with higher ids had been read
+        missed = [event for event in get_latest_events(unfinished, after)
+                  if event.id > seen.get(event.task_id, 0)]
+        # Hold no connection between polls, and see other commits on the
+        # next one
+        g.db_session.close()
+
+        if events:
+            after = events[-1].id
+        events = missed + events
+        for event in events:
+            seen[event.task_id] = max(event.id, seen.get(event.task_id, 0))
+            if event.status in FINISHED_STATES:
+                unfinished.discard(event.task_id)
+        done = not unfinished
+        yield events, after, done
+
+        if done or time.time() >= deadline:
+            return
+        time.sleep(poll)
+
+
+def stream_batch(batch_id, after=0):
+    """
+    Generates a batch's events as a Server-Sent Events stream. Each event's
+    id is its InstallEvent id, and a 'done' event ends the stream once every
+    install has finished.
+
+    Streams last INSTALL_STREAM_TIMEOUT seconds, after which EventSource
+    reconnects and resumes from the last event id.
+    """
+    yield "retry: %d\n\n" % (
+        current_app.config.get('INSTALL_EVENTS_POLL', 1) * 1000
+    )
+
+    last_sent = time.time()
+    for events, after, done in follow_batch(batch_id, after):
+        for event in events:
+            # A missed event is resumed after like the others
+            yield "id: %d\nevent: progress\ndata: %s\n\n" % (
+                after, json.dumps(event.serialize())
+            )
+
+        if done:
+            yield "event: done\ndata: {}\n\n"
+        elif events:
+            last_sent = time.time()
+        elif time.time() - last_sent >= 15:
+            # Keeps proxies from dropping a quiet connection
+            yield ": keepalive\n\n"
+            last_sent = time.time()
+
+
+def wait_for_batch(batch_id, after=0, wait=None):
+    """
+    Long-polling version of stream_batch. Waits up to 'wait' seconds,
+    INSTALL_LONG_POLL_WAIT, for events after the event id 'after'.
+
+    Returns:
+        tuple. The events, empty if none came, the event id to wait after
+        next and whether every install of the batch has finished
+    """
+    if wait is None:
+        wait = current_app.config.get('INSTALL_LONG_POLL_WAIT', 25)
+
+    events, done = [], False
+    for events, after, done in follow_batch(batch_id, after, wait):
+        if events:
+            break
+    return events, after, done
+
+
+def prune_install_events(days=None):
+    """
+    Deletes the install events older than 'days', INSTALL_EVENTS_DAYS.
+
+    Returns:
+        int. The number of events deleted
+    """
+    days = days or current_app.config.get('INSTALL_EVENTS_DAYS', 7)
+    deleted = g.db_session.query(InstallEvent).filter(
+        InstallEvent.created < datetime.now() - timedelta(days=days)
+    ).delete(synchronize_session=False)
+    g.db_session.commit()
+    return deleted
@@ -0,0 +1,113 @@
+"""
+Thins out old site_details history.
+
+Every SiteDetail from the last RETENTION_FULL_DAYS days is kept. Older than
+that, each site keeps its newest SiteDetail of every day, and older than
+RETENTION_DAILY_DAYS its newest of every week. A site's latest SiteDetail is
+never removed.
+
+Sites are worked through one at a time and rows are deleted
+RETENTION_CHUNK_SIZE at a time, each chunk in its own transaction, so the
+table is never locked for long.
+"""
+from datetime import datetime, timedelta
+
+from flask import current_app, g
+
+from orvsd_central.models import Site, SiteDetail, SiteDetailCourse
+
+
+def retention_bucket(timemodified, daily_since):
+    """
+    Returns the period a SiteDetail represents: its day, or its week if it is
+    older than daily_since.
+    """
+    if timemodified >= daily_since:
+        return 'day', timemodified.date()
+    return 'week', timemodified.isocalendar()[:2]
+
+
+def get_expired_site_details(site_id, full_since, daily_since):
+    """
+    Generates the ids of a site's SiteDetails the policy does not keep: all
+    but the newest of each day or week before full_since.
+    """
+    rows = g.db_session.query(
+        SiteDetail.id, SiteDetail.timemodified
+    ).filter(
+        SiteDetail.site_id == site_id,
+        SiteDetail.timemodified < full_since
+    ).order_by(SiteDetail.timemodified.desc(), SiteDetail.id.desc())
+
+    seen = set()
+    for detail_id, timemodified in rows:
+        bucket = retention_bucket(timemodified, daily_since)
+        if bucket in seen:
+            yield detail_id
+        else:
+            seen.add(bucket)
+
+
+def delete_site_details(ids):
+    """
+    Deletes SiteDetails, and their course entries, by id in a transaction of
+    its own.
+    """
+    g.db_session.query(SiteDetailCourse).filter(
+        SiteDetailCourse.site_detail_id.in_(ids)
+    ).delete(synchronize_session=False)
+    g.db_session.query(SiteDetail).filter(
+        SiteDetail.id.in_(ids)
+    ).delete(synchronize_session=False)
+    g.db_session.commit()
+
+
+def prune_site_details(full_days=None, daily_days=None, chunk_size=None,
+                       dry_run=False, now=None):
+    """
+    Applies the retention policy to every site's SiteDetails.
+
+    Args:
+        full_days (int): Days every SiteDetail is kept, RETENTION_FULL_DAYS
+        daily_days (int): Days one SiteDetail per day is kept, after that one
+            per week, RETENTION_DAILY_DAYS
+        chunk_size (int): SiteDetails per delete, RETENTION_CHUNK_SIZE
+        dry_run (bool): Only count what would be deleted
+        now (datetime): Time the windows are measured back from
+
+    Returns:
+        dict. Number of 'sites' looked at and SiteDetails 'deleted'
+    """
+    config = current_app.config
+    full_days = full_days or config.get('RETENTION_FULL_DAYS', 30)
+    daily_days = max(daily_days or config.get('RETENTION_DAILY_DAYS', 180),
+                     full_days)
+    chunk_size = chunk_size or config.get('RETENTION_CHUNK_SIZE', 500)
+
+    now = now or datetime.now()
+    full_since = now - timedelta(days=full_days)
+    daily_since = now - timedelta(days=daily_days)
+
+    sites = g.db_session.query(Site.id, Site.latest_site_detail_id).all()
+
+    deleted = 0
+    pending = []
+    for site_id, latest_id in sites:
+        for detail_id in get_expired_site_details(site_id, full_since,
+                                                  daily_since):
+            if detail_id == latest_id:
+                continue
+            pending.append(detail_id)
+
+        while len(pending) >= chunk_size:
+            chunk, pending = pending[:chunk_size], pending[chunk_size:]
+            if not dry_run:
+                delete_site_details(chunk)
+            deleted += len(chunk)
+
+    if pending:
+        if not dry_run:
+            delete_site_details(pending)
+        deleted += len(pending)
+
+    return {'sites': len(sites), 'deleted': deleted}
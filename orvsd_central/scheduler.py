@@ -0,0 +1,167 @@
+"""
+Limits how hard course installs hit each moodle host.
+
+Every host has INSTALL_HOST_CONCURRENCY slots in the install_host_slots
+table. An install_course_to_site task takes a slot before posting to its
+site and gives it back afterwards, so no matter how many workers there are,
+only that many installs run against one host at a time while other hosts
+carry on. A task that finds every slot taken waits INSTALL_SLOT_WAIT seconds
+and tries again. Slots also expire, in case a worker dies holding one.
+
+Hosts are the sites' baseurl hosts, or their location (the machine they run
+on) when INSTALL_HOST_KEY is 'location'.
+
+Installs that fail with a timeout, a dropped connection or a 5xx/429 answer
+are retried with exponential backoff, INSTALL_MAX_RETRIES times. After that,
+or after any other error, they are recorded in install_dead_letters.
+
+Slots and dead letters are written in sessions of their own and committed at
+once, apart from whatever the task's session is doing.
+"""
+from datetime import datetime, timedelta
+import logging
+import random
+import urlparse
+
+from flask import current_app
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import IntegrityError
+
+from orvsd_central.database import create_separate_session
+from orvsd_central.models import InstallDeadLetter, InstallHostSlot
+
+# HTTP statuses worth trying again later
+TRANSIENT_STATUSES = [429, 500, 502, 503, 504]
+
+
+class InstallError(Exception):
+    """
+    A failed install. Transient errors are retried, others dead-lettered.
+    """
+
+    def __init__(self, message, transient=False):
+        Exception.__init__(self, message)
+        self.transient = transient
+
+
+def get_install_host(site):
+    """
+    Returns the key the site's installs are limited by.
+    """
+    if (current_app.config.get('INSTALL_HOST_KEY', 'baseurl') == 'location'
+            and site.location):
+        return site.location
+
+    baseurl = site.baseurl or ''
+    if '//' not in baseurl:
+        baseurl = '//' + baseurl
+    return urlparse.urlparse(baseurl).hostname or site.baseurl
+
+
+def install_timeout():
+    """
+    The (connect, read) timeout for an install request. Installs restore a
+    whole course, so they get INSTALL_READ_TIMEOUT rather than
+    MOODLE_READ_TIMEOUT.
+    """
+    return (current_app.config.get('MOODLE_CONNECT_TIMEOUT', 5),
+            current_app.config.get('INSTALL_READ_TIMEOUT', 600))
+
+
+def retry_countdown(attempt):
+    """
+    Seconds before retry number 'attempt' (from 0), doubling each time from
+    INSTALL_RETRY_BACKOFF, with jitter so retries to one host spread out.
+    """
+    base = current_app.config.get('INSTALL_RETRY_BACKOFF', 30)
+    return base * (2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+def slot_wait():
+    """
+    Seconds a task waits before trying again for a slot of a busy host.
+    """
+    return current_app.config.get('INSTALL_SLOT_WAIT', 15) * \
+        random.uniform(0.5, 1.5)
+
+
+def acquire_slot(host, task_id):
+    """
+    Takes a free slot of the host for the task.
+
+    Returns:
+        int. The slot, or None if all of the host's slots are taken
+    """
+    db_session = create_separate_session()
+    limit = current_app.config.get('INSTALL_HOST_CONCURRENCY', 2)
+    now = datetime.now()
+    # Held for no longer than the request may take
+    expires = now + timedelta(seconds=sum(install_timeout()) + 60)
+    table = InstallHostSlot.__table__
+
+    try:
+        existing = set(slot for slot, in db_session.query(
+            InstallHostSlot.slot
+        ).filter(InstallHostSlot.host == host))
+        for slot in range(limit):
+            if slot not in existing:
+                try:
+                    db_session.execute(table.insert(), {'host': host,
+                                                        'slot': slot})
+                    db_session.commit()
+                except IntegrityError:
+                    # Another worker created it first
+                    db_session.rollback()
+
+        for slot in range(limit):
+            # Only one worker's UPDATE can match a free slot
+            taken = db_session.execute(table.update().where(and_(
+                table.c.host == host,
+                table.c.slot == slot,
+                or_(table.c.task_id.is_(None), table.c.expires < now)
+            )).values(task_id=task_id, expires=expires))
+            db_session.commit()
+            if taken.rowcount == 1:
+                return slot
+    finally:
+        db_session.close()
+
+    return None
+
+
+def release_slot(host, slot, task_id):
+    """
+    Gives back a slot, unless it expired and was taken by another task.
+    """
+    db_session = create_separate_session()
+    table = InstallHostSlot.__table__
+    try:
+        db_session.execute(table.update().where(and_(
+            table.c.host == host,
+            table.c.slot == slot,
+            table.c.task_id == task_id
+        )).values(task_id=None, expires=None))
+        db_session.commit()
+    finally:
+        db_session.close()
+
+
+def dead_letter(task_id, site_id, course_id, host, attempts, error):
+    """
+    Records an install that is not going to be retried.
+    """
+    logging.error("Giving up installing course %s to %s after %d attempts: "
+                  "%s" % (course_id, host, attempts, error))
+
+    db_session = create_separate_session()
+    try:
+        db_session.add(InstallDeadLetter(task_id=task_id,
+                                         site_id=site_id,
+                                         course_id=course_id,
+                                         host=host,
+                                         attempts=attempts,
+                                         error=str(error),
+                                         failed=datetime.now()))
+        db_session.commit()
+    finally:
+        db_session.close()
@@ -0,0 +1,243 @@
+"""
+Serialising models for the api, straight from their columns.
+
+Objects are read as plain rows of the columns asked for rather than as
+model instances, and turned into dicts named after the columns, the same
+fields as the models' serialize() with masked columns masked. Dates are
+written as ISO 8601.
+
+Large collections are streamed: rows are read EXPORT_CHUNK_SIZE at a time
+and written out as they come, as one JSON array, as NDJSON, a JSON object per
+line, or as CSV. Each chunk is a query of its own that carries on after the
+last row of the one before, in the order of a unique key, so neither the
+database driver nor the web worker ever holds more than a chunk.
+"""
+from cStringIO import StringIO
+import csv
+from datetime import date, datetime
+import json
+
+from flask import Response, current_app, g, stream_with_context
+from sqlalchemy import and_, or_
+
+from orvsd_central.models import Site, SiteDetail
+from orvsd_central.util import MASKED_COLUMNS, get_object_fields
+
+FORMATS = {'json': 'application/json',
+           'ndjson': 'application/x-ndjson',
+           'csv': 'text/csv'}
+
+
+class JSONEncoder(json.JSONEncoder):
+    """
+    Encodes dates and datetimes as ISO 8601 strings.
+    """
+
+    def default(self, value):
+        if isinstance(value, (date, datetime)):
+            return value.isoformat()
+        return json.JSONEncoder.default(self, value)
+
+
+def dumps(value):
+    """
+    Returns 'value' as JSON, with dates as ISO 8601.
+    """
+    return json.dumps(value, cls=JSONEncoder)
+
+
+def get_fields(obj, fields=None):
+    """
+    Returns the fields of 'obj' to serialise: 'fields', or all of them if
+    None, always with the id first. Raises ValueError for unknown fields.
+    """
+    public = get_object_fields(obj)
+    fields = fields or public
+    unknown = set(fields) - set(public)
+    if unknown:
+        raise ValueError("Unknown fields %s" % ", ".join(sorted(unknown)))
+    return ['id'] + [name for name in fields if name != 'id']
+
+
+def select_columns(obj, fields):
+    """
+    Returns the columns to query for 'fields', masked columns are not read.
+    """
+    columns = obj.__table__.columns
+    return [columns[name] for name in fields if name not in MASKED_COLUMNS]
+
+
+def row_to_dict(fields, row):
+    """
+    Builds the dict of an object from the row select_columns(obj, fields)
+    read for it.
+    """
+    values = iter(row)
+    return dict((name, MASKED_COLUMNS[name] if name in MASKED_COLUMNS
+                 else next(values))
+                for name in fields)
+
+
+def get_objects(obj, ids, fields=None):
+    """
+    Gets many objects of a model by id, in one query reading only the
+    requested columns.
+
+    obj    -- The model, see util.get_obj_by_category
+    ids    -- IDs of the objects
+    fields -- Fields of each object, all of them if None. The id is always
+              included
+
+    Returns:
+        list. The objects found, in id order, as dicts of 'fields'. Raises
+        ValueError for unknown fields.
+    """
+    fields = get_fields(obj, fields)
+    if not ids:
+        return []
+    rows = g.db_session.query(*select_columns(obj, fields)).filter(
+        obj.id.in_(ids)
+    ).order_by(obj.id)
+    return [row_to_dict(fields, row) for row in rows]
+
+
+def after_keys(keys, values):
+    """
+    Returns the condition for rows after those with 'values' of 'keys', in
+    the order of the keys.
+    """
+    return or_(*[
+        and_(*([key == value for key, value in zip(keys[:i], values[:i])] +
+               [keys[i] > values[i]]))
+        for i in range(len(keys))
+    ])
+
+
+def iter_rows(query, keys, chunk_size=None):
+    """
+    Generates a query's rows ordered by 'keys', read EXPORT_CHUNK_SIZE at a
+    time. The keys must identify a row and may not be NULL.
+    """
+    chunk_size = chunk_size or current_app.config.get('EXPORT_CHUNK_SIZE',
+                                                      500)
+    count = len(keys)
+    # Read along with each row, so the next chunk can start after it
+    query = query.add_columns(*[
+        key.label('key_%d' % i) for i, key in enumerate(keys)
+    ]).order_by(*keys)
+
+    last = None
+    while True:
+        chunk = query
+        if last is not None:
+            chunk = chunk.filter(after_keys(keys, last))
+        rows = chunk.limit(chunk_size).all()
+        for row in rows:
+            yield tuple(row)[:-count]
+        if len(rows) < chunk_size:
+            return
+        last = tuple(rows[-1])[-count:]
+
+
+def iter_objects(obj, fields=None):
+    """
+    Generates every object of a model, in id order, as dicts of 'fields'.
+    """
+    fields = get_fields(obj, fields)
+    query = g.db_session.query(*select_columns(obj, fields))
+    for row in iter_rows(query, [obj.id]):
+        yield row_to_dict(fields, row)
+
+
+def iter_sites_with_details(fields=None, detail_fields=None):
+    """
+    Generates every site, in id order, as a dict of 'fields' with its latest
+    SiteDetail as a dict of 'detail_fields' under 'latest_details', None if
+    it has none. Both are read by one query.
+    """
+    fields = get_fields(Site, fields)
+    detail_fields = get_fields(SiteDetail, detail_fields)
+    site_columns = select_columns(Site, fields)
+    query = g.db_session.query(
+        *(site_columns + select_columns(SiteDetail, detail_fields))
+    ).outerjoin(
+        SiteDetail, SiteDetail.id == Site.latest_site_detail_id
+    )
+
+    split = len(site_columns)
+    for row in iter_rows(query, [Site.id]):
+        site = row_to_dict(fields, row[:split])
+        # The id is always read, it is None without a SiteDetail
+        details = row_to_dict(detail_fields, row[split:])
+        site['latest_details'] = details if details['id'] is not None \
+            else None
+        yield site
+
+
+def json_array(items):
+    """
+    Generates a JSON array of 'items' in pieces, one item at a time.
+    """
+    yield '['
+    first = True
+    for item in items:
+        yield (dumps(item) if first else ',\n' + dumps(item))
+        first = False
+    yield ']\n'
+
+
+def ndjson(items):
+    """
+    Generates 'items' as NDJSON, one line of JSON per item.
+    """
+    for item in items:
+        yield dumps(item) + '\n'
+
+
+def csv_value(value):
+    """
+    Returns 'value' as written to a CSV cell, UTF-8 encoded.
+    """
+    if value is None:
+        return ''
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def csv_rows(items, columns):
+    """
+    Generates 'items' as CSV, a header row of 'columns' and then a row of
+    those keys of each item.
+    """
+    buf = StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(columns)
+    for item in items:
+        writer.writerow([csv_value(item[column]) for column in columns])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    # Only the header when there are no items
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def stream_response(items, fmt='json', columns=None):
+    """
+    Returns a response streaming 'items' as a JSON array, as NDJSON if 'fmt'
+    is 'ndjson' or as CSV of 'columns' if it is 'csv'. Raises ValueError for
+    other formats, or CSV without columns.
+    """
+    if fmt not in FORMATS or (fmt == 'csv' and not columns):
+        raise ValueError("Unknown format %s" % fmt)
+
+    if fmt == 'csv':
+        chunks = csv_rows(items, columns)
+    elif fmt == 'ndjson':
+        chunks = ndjson(items)
+    else:
+        chunks = json_array(items)
+    return Response(stream_with_context(chunks), mimetype=FORMATS[fmt])
@@ -0,0 +1,272 @@
+"""
+Precomputed report snapshots.
+
+At the end of each gather_siteinfo run the whole report is written out as a
+ReportSnapshot: one row per site of every active school, one row of totals
+per active district and the global totals. Reading the report is then a scan
+of one snapshot's rows instead of a walk through site_details.
+
+A snapshot's rows are written while it is incomplete and readers only look
+at the newest complete snapshot, so marking it complete swaps the whole
+report at once. The last REPORT_SNAPSHOTS_KEPT snapshots are kept.
+
+Edits of the sites, their details or the courses mark every snapshot stale,
+see cache.report_changed. Until the first snapshot is built, and from an
+edit until the next one is, the report is computed from site_details.
+"""
+from collections import OrderedDict
+from datetime import datetime
+from itertools import groupby
+from flask import current_app, g
+from sqlalchemy.sql import func
+
+from orvsd_central.cache import invalidate_report_cache
+from orvsd_central.models import (District, ReportSnapshot,
+                                  ReportSnapshotDistrict, ReportSnapshotSite,
+                                  School, Site, SiteDetail)
+from orvsd_central.util import (get_active_counts, get_district_report,
+                                get_report_sites, get_schools)
+
+# Site rows per INSERT while building a snapshot
+SNAPSHOT_BATCH_SIZE = 500
+
+COUNT_FIELDS = ['districts', 'schools', 'sites', 'courses', 'admins',
+                'teachers', 'totalusers', 'activeusers']
+TOTAL_FIELDS = ['admins', 'teachers', 'totalusers', 'activeusers']
+
+
+def build_report_snapshot(keep=None):
+    """
+    Writes a new snapshot of the report, makes it the current one and drops
+    all but the newest 'keep' snapshots.
+
+    Args:
+        keep (int): Snapshots to keep, REPORT_SNAPSHOTS_KEPT
+
+    Returns:
+        ReportSnapshot
+    """
+    keep = keep or current_app.config.get('REPORT_SNAPSHOTS_KEPT', 5)
+
+    snapshot = ReportSnapshot(
+        created=datetime.now(),
+        complete=False,
+        active_since=g.db_session.query(
+            func.max(SiteDetail.timemodified)
+        ).scalar(),
+        **get_active_counts()
+    )
+    g.db_session.add(snapshot)
+    g.db_session.commit()
+
+    districts = OrderedDict()
+    rows = []
+    for district, school, site, details, courses in get_report_sites():
+        row = {
+            'snapshot_id': snapshot.id,
+            'district_id': district.id,
+            'district_name': district.name,
+            'district_shortname': district.shortname,
+            'school_id': school.id,
+            'school_name': school.name,
+            'site_id': site.id,
+            'site_name': site.name,
+            'baseurl': site.baseurl,
+            'adminlist': None,
+            'teachers': None,
+            'activeusers': None,
+            'totalusers': None,
+            'courses': None
+        }
+        if details:
+            row.update({
+                'adminlist': details.adminlist,
+                'teachers': details.teachers,
+                'activeusers': details.activeusers,
+                'totalusers': details.totalusers,
+                'courses': courses or 0
+            })
+        rows.append(row)
+
+        totals = districts.get(district.id)
+        if totals is None:
+            totals = districts[district.id] = dict(
+                [('snapshot_id', snapshot.id),
+                 ('district_id', district.id),
+                 ('name', district.name),
+                 ('shortname', district.shortname),
+                 ('schools', set()),
+                 ('sites', 0)] +
+                [(field, 0) for field in TOTAL_FIELDS]
+            )
+        totals['schools'].add(school.id)
+        totals['sites'] += 1
+        if details:
+            totals['admins'] += details.adminusers or 0
+            totals['teachers'] += details.teachers or 0
+            totals['totalusers'] += details.totalusers or 0
+            totals['activeusers'] += details.activeusers or 0
+
+        if len(rows) >= SNAPSHOT_BATCH_SIZE:
+            g.db_session.execute(ReportSnapshotSite.__table__.insert(), rows)
+            rows = []
+
+    if rows:
+        g.db_session.execute(ReportSnapshotSite.__table__.insert(), rows)
+
+    for totals in districts.values():
+        totals['schools'] = len(totals['schools'])
+    if districts:
+        g.db_session.execute(ReportSnapshotDistrict.__table__.insert(),
+                             list(districts.values()))
+
+    # The swap, readers move to this snapshot in one commit
+    snapshot.complete = True
+    g.db_session.commit()
+
+    prune_report_snapshots(snapshot, keep)
+    invalidate_report_cache()
+
+    return snapshot
+
+
+def prune_report_snapshots(current, keep):
+    """
+    Deletes all but the newest 'keep' complete snapshots, and any incomplete
+    snapshot older than 'current' left by a build that failed.
+    """
+    kept = [snapshot_id for snapshot_id, in g.db_session.query(
+        ReportSnapshot.id
+    ).filter(
+        ReportSnapshot.complete == True
+    ).order_by(ReportSnapshot.id.desc()).limit(keep)]
+
+    old = [snapshot_id for snapshot_id, in g.db_session.query(
+        ReportSnapshot.id
+    ).filter(
+        ReportSnapshot.id <= current.id,
+        ~ReportSnapshot.id.in_(kept)
+    )]
+
+    if old:
+        for table in [ReportSnapshotSite, ReportSnapshotDistrict]:
+            g.db_session.query(table).filter(
+                table.snapshot_id.in_(old)
+            ).delete(synchronize_session=False)
+        g.db_session.query(ReportSnapshot).filter(
+            ReportSnapshot.id.in_(old)
+        ).delete(synchronize_session=False)
+        g.db_session.commit()
+
+
+def get_report_snapshot():
+    """
+    Returns the current, newest complete, ReportSnapshot or None if there is
+    none or it is stale.
+    """
+    return ReportSnapshot.query.filter(
+        ReportSnapshot.complete == True,
+        ReportSnapshot.stale == False
+    ).order_by(ReportSnapshot.id.desc()).first()
+
+
+def _site_report(row):
+    """
+    The snapshot version of util.get_site_report.
+    """
+    site_info = {'sitename': row.site_name,
+                 'schoolname': row.school_name,
+                 'schoolid': row.school_id,
+                 'baseurl': row.baseurl}
+    # Only sites with a SiteDetail have a course count
+    if row.courses is not None:
+        site_info['admin'] = row.adminlist
+        site_info['teachers'] = row.teachers
+        site_info['activeusers'] = row.activeusers
+        site_info['totalusers'] = row.totalusers
+        site_info['courses'] = row.courses
+    return site_info
+
+
+def report_counts():
+    """
+    The report's global totals, see util.get_active_counts.
+    """
+    snapshot = get_report_snapshot()
+    if snapshot is None:
+        return get_active_counts()
+    return dict((field, getattr(snapshot, field)) for field in COUNT_FIELDS)
+
+
+def report_active_since():
+    """
+    Time of the newest SiteDetail the report is built from.
+    """
+    snapshot = get_report_snapshot()
+    if snapshot is None:
+        return g.db_session.query(func.max(SiteDetail.timemodified)).scalar()
+    return snapshot.active_since
+
+
+def report_active_districts():
+    """
+    Returns (name, shortname, id) of every active district.
+    """
+    snapshot = get_report_snapshot()
+    if snapshot is None:
+        return g.db_session.query(
+            District.name,
+            District.shortname,
+            District.id
+        ).join(School).join(Site).join(Site.latest_site_detail).distinct(
+        ).all()
+
+    return g.db_session.query(
+        ReportSnapshotDistrict.name,
+        ReportSnapshotDistrict.shortname,
+        ReportSnapshotDistrict.district_id
+    ).filter(
+        ReportSnapshotDistrict.snapshot_id == snapshot.id
+    ).order_by(ReportSnapshotDistrict.id).all()
+
+
+def report_schools(dist_id):
+    """
+    The report entries of a district's sites, see util.get_schools.
+    """
+    snapshot = get_report_snapshot()
+    if snapshot is None:
+        return get_schools(dist_id, True)
+
+    rows = ReportSnapshotSite.query.filter(
+        ReportSnapshotSite.snapshot_id == snapshot.id,
+        ReportSnapshotSite.district_id == dist_id
+    )
+    return dict((str(row.site_id), _site_report(row)) for row in rows)
+
+
+def report_districts():
+    """
+    Generates the report for every active district, see
+    util.get_district_report.
+    """
+    snapshot = get_report_snapshot()
+    if snapshot is None:
+        for district in get_district_report():
+            yield district
+        return
+
+    # Rows were written in report order
+    rows = ReportSnapshotSite.query.filter(
+        ReportSnapshotSite.snapshot_id == snapshot.id
+    ).order_by(ReportSnapshotSite.id)
+
+    for _, district_rows in groupby(rows, key=lambda row: row.district_id):
+        district_rows = list(district_rows)
+        yield {
+            'id': district_rows[0].district_id,
+            'name': district_rows[0].district_name,
+            'shortname': district_rows[0].district_shortname,
+            'sites': dict((str(row.site_id), _site_report(row))
+                          for row in district_rows)
+        }
@@ -2,9 +2,17 @@ $(function() {
     // Update the list of sites to install courses to on a change.
     $('#site').change(function() {
         $("#selected-names").empty();
-        $('#site option:selected').each(function() {
-            $.get('/1/get_site_by/' + $(this).val(), function(data) {
-                $("#selected-names").append("Name: <i>" + data.name + "</i></br>");
+        var ids = $('#site option:selected').map(function() {
+            return $(this).val();
+        }).get();
+        if (ids.length === 0) {
+            return;
+        }
+        // Every selected site's name in one request
+        $.get('/1/sites', {ids: ids.join(','), fields: 'name'}, function(data) {
+            $(data.objects).each(function(i, site) {
+                $("#selected-names").append($("<span></span>").text("Name: ")
+                    .append($("<i></i>").text(site.name)).append("</br>"));
             });
         });
     });
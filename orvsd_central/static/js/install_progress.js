@@ -0,0 +1,47 @@
+$(function() {
+    // Follow the progress of a batch of installs, over one connection.
+    var table = $('#install-progress');
+    if (!table.length) {
+        return;
+    }
+    var batch_id = table.data('batch-id');
+    var url = '/1/installs/' + batch_id;
+
+    if (window.EventSource) {
+        var source = new EventSource(url + '/stream');
+        source.addEventListener('progress', function(e) {
+            show_progress(JSON.parse(e.data));
+        });
+        source.addEventListener('done', function() {
+            source.close();
+        });
+    } else {
+        long_poll(url + '/events', 0);
+    }
+});
+
+function long_poll(url, after) {
+    /*
+    Waits for the events after 'after', then for the ones after those, until
+    every install has finished.
+    */
+    $.getJSON(url, {after: after}).done(function(data) {
+        $(data.events).each(function(i, event) {
+            show_progress(event);
+        });
+        if (!data.done) {
+            long_poll(url, data.next);
+        }
+    }).fail(function() {
+        setTimeout(function() { long_poll(url, after); }, 5000);
+    });
+}
+
+function show_progress(event) {
+    /*
+    Shows an install's new status in its row.
+    */
+    var row = $('#install-progress tr[data-task-id="' + event.task_id + '"]');
+    row.find('.status').text(event.status);
+    row.find('.message').text(event.message || '');
+}
@@ -1,34 +1,32 @@
 $(document).on("ready", function() {
-    // Move the selected school to the selected district.
+    // Move the selected schools to the selected district, in one request.
     $("#update").on("click", function() {
-        var url = "/1/schools/";
-
-        migrate_success = "";
-        migrate_fail = "";
+        var district_id = $("#districts option:selected").val();
+        var operations = [];
 
         $("#schools option:selected").each(function() {
-            var school = $(this);
-
-            $.ajax({
-                // Using a GET to verify the existance of the school
-                type: "GET",
-                url: url + school.val(),
-                dataType: "json",
-                success: function(data, textStatus, jqXHR) {
-                    // Update the district id for the school
-                    data.district_id = $("#districts option:selected").val();
+            operations.push({op: "update",
+                             id: $(this).val(),
+                             data: {district_id: district_id}});
+        });
+        if (operations.length === 0) {
+            return;
+        }
 
-                    // POST the fixed data
-                    $.ajax({
-                        type: "POST",
-                        url: url + school.val() + "/update",
-                        data: data,
-                        success: function(data, textStatus, jqXHR) {
-                            school.remove();
-                        },
-                    });
-                },
-            });
+        $.ajax({
+            type: "POST",
+            url: "/1/schools/bulk",
+            data: JSON.stringify(operations),
+            contentType: "application/json",
+            dataType: "json",
+            success: function(data, textStatus, jqXHR) {
+                // Only the schools that were moved leave the list
+                $(data.results).each(function(i, result) {
+                    if (result.status === "ok") {
+                        $("#schools option[value='" + result.id + "']").remove();
+                    }
+                });
+            },
         });
     });
 });
@@ -1,76 +1,93 @@
 $(function() {
-    // Get active districts
-    // Data is [(dist_name, dist_shortname, dist_id), ...]
-    $.get("/1/districts/active", function(data) {
-        // Sort based on name for alphabetical display
-        data.category.sort(function(a, b) {
-            if (a[0] > b[0])
-                return 1;
-            if (a[0] < b[0])
-                return -1;
-            return 0;
+    // Get the report for every active district in one request. The response
+    // is streamed with one district per line, sorted by name:
+    // {id, name, shortname, sites: {site_id: {sitename, ...}, ...}}
+    // Districts are drawn as soon as their line has arrived.
+    var xhr = new XMLHttpRequest();
+    var received = 0;
+    var loading = true;
+
+    function render_districts(done) {
+        var text = xhr.responseText;
+        // Only parse complete lines until the response has finished
+        var end = done ? text.length : text.lastIndexOf("\n") + 1;
+        var lines = text.substring(received, end).split("\n");
+        received = end;
+
+        $.each(lines, function(i, line) {
+            if (!line) {
+                return;
+            }
+            // Remove 'Loading...'
+            if (loading) {
+                $("#report_tables").html("");
+                loading = false;
+            }
+            append_district(JSON.parse(line));
         });
 
-        // Remove 'Loading...'
-        $("#report_tables").html("");
+        if (done && loading) {
+            $("#report_tables").html("");
+        }
+        filter_districts();
+    }
 
-        // For each district
-        $.each(data.category, function(id, value) {
-            // Apend a row for the district name and the district table
-            $("#report_tables").append(
-                "<div class=\"row\" data-district=\""+value[0]+"\">\
-                    <h4>"+value[0]+"</h4>\
-                </div>\
-                <div class=\"row\" id=\""+value[1]+"\" data-district=\""+value[0]+"\">\
-                    Loading...\
-                </div>"
-            );
+    xhr.onprogress = function() {
+        render_districts(false);
+    };
+    xhr.onload = function() {
+        render_districts(true);
+    };
+    xhr.open("GET", "/1/report/districts?stream=1");
+    xhr.send();
+
+    // Apend a row for the district name and the district table
+    function append_district(district) {
+        var table = "<table class=\"table table-condensed table-responsive table-bordered table-hover table-striped\">";
+        table += "<tr>\
+            <th>Site</th>\
+            <th>School</th>\
+            <th>Admin(s)</th>\
+            <th>Total Users</th>\
+            <th>Active Users</th>\
+            <th>Teachers</th>\
+            <th>Courses</th>\
+        </tr>";
+        /*    <th>Actions</th>\
+        </tr>";*/
+        var tdata = district.sites;
+        for (var school in tdata) {
+            table += "<tr>\
+            <td><a href=\"http://" + tdata[school].baseurl + "\">" + tdata[school].sitename + "</a></td>\
+            <td><a href=\"/schools/" + tdata[school].schoolid + "/view\">" + tdata[school].schoolname + "</a></td>\
+            <td>";
+            var json = JSON.parse(tdata[school].admin);
+            for (var k in json) {
+                table += json[k].firstname + " " + json[k].lastname + " - " + json[k].email + "<br/>";
+            }
+            table += "</td>\
+            <td>"+tdata[school].totalusers+"</td>\
+            <td>"+tdata[school].activeusers+"</td>\
+            <td>"+tdata[school].teachers+"</td>\
+            <td>"+tdata[school].courses+"</td>";//\
+            /*<td>\
+                <a>Add Course</a><br />\
+                <a>Add User</a><br />\
+                <a>Edit</a>\
+            </td></tr>";*/
+        }
+        table += "</table>";
+
+        $("#report_tables").append(
+            "<div class=\"row\" data-district=\""+district.name+"\">\
+                <h4>"+district.name+"</h4>\
+            </div>\
+            <div class=\"row\" id=\""+district.shortname+"\" data-district=\""+district.name+"\">\
+                "+table+"\
+            </div>"
+        );
+    }
 
-            // Get the active details for the district to be displayed
-            // then generate table data from the returned
-            $.get(
-                "/1/report/get_active_schools",
-                // value[2] is the district id
-                {distid: value[2]},
-                function(tdata) {
-                    var table = "<table class=\"table table-condensed table-responsive table-bordered table-hover table-striped\">";
-                    table += "<tr>\
-                        <th>Site</th>\
-                        <th>School</th>\
-                        <th>Admin(s)</th>\
-                        <th>Total Users</th>\
-                        <th>Active Users</th>\
-                        <th>Teachers</th>\
-                        <th>Courses</th>\
-                    </tr>";
-                    /*    <th>Actions</th>\
-                    </tr>";*/
-                    for (var school in tdata) {
-                        table += "<tr>\
-                        <td><a href=\"http://" + tdata[school].baseurl + "\">" + tdata[school].sitename + "</a></td>\
-                        <td><a href=\"/schools/" + tdata[school].schoolid + "/view\">" + tdata[school].schoolname + "</a></td>\
-                        <td>";
-                        var json = JSON.parse(tdata[school].admin);
-                        for (var k in json) {
-                            table += json[k].firstname + " " + json[k].lastname + " - " + json[k].email + "<br/>";
-                        }
-                        table += "</td>\
-                        <td>"+tdata[school].totalusers+"</td>\
-                        <td>"+tdata[school].activeusers+"</td>\
-                        <td>"+tdata[school].teachers+"</td>\
-                        <td>"+tdata[school].courses+"</td>";//\
-                        /*<td>\
-                            <a>Add Course</a><br />\
-                            <a>Add User</a><br />\
-                            <a>Edit</a>\
-                        </td></tr>";*/
-                    }
-                    table += "</table>";
-                    $("#"+value[1]).html(table);
-                }
-            );
-        });
-    });
     //
     // Get the top of the reort page stats
     $.get("/1/report/stats", function(data) {
@@ -86,8 +103,11 @@ $(function() {
     });
 
     // Filter districts when input is changed
-    $("#filter").on('input propertychange paste', function() {
-        var keyword = $(this).val().toLowerCase();
+    $("#filter").on('input propertychange paste', filter_districts);
+
+    // Districts still arriving are filtered as they are drawn
+    function filter_districts() {
+        var keyword = $("#filter").val().toLowerCase();
         $("#report_tables > div[data-district]").filter(function() {
             if ($(this).data('district').toLowerCase().indexOf(keyword) > -1) {
                 $(this).show();
@@ -95,5 +115,5 @@ $(function() {
                 $(this).hide();
             }
         });
-    });
+    }
 });
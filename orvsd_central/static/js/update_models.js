@@ -4,17 +4,27 @@ $(function() {
     var category = window.location.pathname.split("/")[1];
     var base_url = "/1/" + category;
     var pairs;
+    // Passed back to get the page after the last one loaded, null once
+    // every page has been.
+    var next_page = null;
+    var search_timer;
 
-    // Set the current form element keys, and generate the form
-    // off the first selected object.
-    var object_list_length = $("#object_list option").length;
-    if (object_list_length > 0) {
-        var $selected = $("#object_list option:selected");
-        pairs = display_obj($selected, category);
-    }
-    else {
-        pairs = display_blank_obj(category);
-    }
+    // Load the first page, and generate the form off its first object.
+    load_objects(true);
+
+    // Load the next page into the list.
+    $("#more").on("click", function() {
+        load_objects(false);
+    });
+
+    // Start over from the first page when the search or sort changes.
+    $("#search").on("input", function() {
+        clearTimeout(search_timer);
+        search_timer = setTimeout(function() { load_objects(true); }, 300);
+    });
+    $("#search_field, #sort, #order").on("change", function() {
+        load_objects(true);
+    });
 
     // Change which object we display when the selected option changes.
     $("#object_list").on("change", function() {
@@ -104,7 +114,7 @@ $(function() {
                         next = $("#object_list option:selected");
                     }
 
-                    object_list_length = $("#object_list option").length;
+                    var object_list_length = $("#object_list option").length;
                     if (object_list_length > 0) {
                         pairs = display_obj(next, category);
                     }
@@ -124,6 +134,45 @@ $(function() {
         }
     });
 
+    // Load a page of objects into the list, the first one if 'reset' is
+    // true, else the one after those already loaded.
+    function load_objects(reset) {
+        var params = {
+            sort: $("#sort").val(),
+            order: $("#order").val()
+        };
+        if ($("#search").val()) {
+            params.q = $("#search").val();
+            params.field = $("#search_field").val();
+        }
+        if (!reset) {
+            params.after = next_page;
+        }
+        $.getJSON(base_url + "/list", params).done(function(resp) {
+            if (reset) {
+                $("#object_list").empty();
+            }
+            $(resp.objects).each(function(i, obj) {
+                $("#object_list").append($("<option></option>")
+                                 .attr("value", obj.id)
+                                 .addClass("object")
+                                 .text(obj[resp.identifier]));
+            });
+            next_page = resp.next;
+            $("#more").toggle(next_page !== null);
+
+            if (reset) {
+                if ($("#object_list option").length > 0) {
+                    pairs = display_obj($("#object_list option:selected"),
+                                        category);
+                }
+                else {
+                    pairs = display_blank_obj(category);
+                }
+            }
+        });
+    }
+
     // Display an object for a given category, and return that object's keys.
     function display_obj(obj, category) {
         var url = base_url + "/" + obj.val();
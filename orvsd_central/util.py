@@ -1,27 +1,42 @@
 """
 Utility class containing useful methods not tied to specific models or views
 """
-from bs4 import BeautifulSoup as Soup
 import json
 import logging
 import os
 import re
+import urlparse
 import zipfile
 from datetime import datetime
 from functools import wraps
 from getpass import getpass
+from itertools import groupby
 
-from celery import Celery
+from celery import Celery, group
+from celery.backends.database.models import Task as TaskMeta
+from celery.signals import worker_process_init
 from flask import current_app, flash, g, redirect, render_template
 from flask.ext.login import LoginManager, current_user
 from flask.ext.oauth import OAuth
+from lxml import etree
 import requests
-from requests.exceptions import ConnectionError
+from requests.exceptions import ConnectionError, RequestException, Timeout
+from sqlalchemy import (BigInteger, Boolean, DateTime, Float, Integer, String,
+                        and_, case, or_)
+from sqlalchemy.orm import aliased
+from sqlalchemy.sql import exists, func
 
 from orvsd_central import constants
-from orvsd_central.database import create_db_session
-from orvsd_central.models import (District, School, Site, SiteDetail,
-                                  Course, User)
+from orvsd_central.cache import get_user_cache, report_changed
+from orvsd_central.database import create_db_session, get_engine
+from orvsd_central.models import (District, InstallDeadLetter, School,
+                                  Site, SiteCourse, SiteDetail,
+                                  SiteDetailCourse, Course, User)
+from orvsd_central.progress import publish_progress
+from orvsd_central.scheduler import (TRANSIENT_STATUSES, InstallError,
+                                     acquire_slot, dead_letter,
+                                     get_install_host, install_timeout,
+                                     release_slot, retry_countdown, slot_wait)
 
 # Set up a google oath object for user authentication.
 google = OAuth().remote_app(
@@ -39,12 +54,27 @@ google = OAuth().remote_app(
     consumer_key=current_app.config['GOOGLE_CLIENT_ID'],
     consumer_secret=current_app.config['GOOGLE_CLIENT_SECRET'])
 
+# SiteDetail columns compared to tell whether a site's siteinfo has changed
+SITEINFO_FIELDS = ['courses', 'siteversion', 'siterelease', 'adminlist',
+                   'totalusers', 'adminusers', 'teachers', 'activeusers',
+                   'totalcourses']
+
+# Fields read from a course backup's moodle_backup.xml
+BACKUP_FIELDS = ['original_course_fullname', 'original_course_shortname',
+                 'original_course_id', 'moodle_release']
+
+# Columns the api never serves, and those it only serves masked, as in the
+# models' serialize()
+HIDDEN_COLUMNS = ['latest_site_detail_id']
+MASKED_COLUMNS = {'password': '********'}
+
 # Initialize the login manager for Flask-Login.
 login_manager = LoginManager()
 login_manager.setup_app(current_app)
 
 
 def init_celery():
+    app = current_app._get_current_object()
     celery = Celery(current_app.import_name,
                     broker=current_app.config['CELERY_BROKER_URL'])
     celery.conf.update(current_app.config)
@@ -55,9 +85,24 @@ def init_celery():
 
         def __call__(self, *args, **kwargs):
             with current_app.app_context():
+                if self.request_stack.top is not None:
+                    # Run by a worker, which pushed the task's request.
+                    # TaskBase.__call__ would hide it behind an empty one,
+                    # losing the task's id and retries.
+                    return self.run(*args, **kwargs)
                 return TaskBase.__call__(self, *args, **kwargs)
 
     celery.Task = ContextTask
+
+    @worker_process_init.connect(weak=False)
+    def dispose_db_engine(**kwargs):
+        """
+        Forked workers inherit the parent's pooled connections, drop them so
+        each worker process checks out its own.
+        """
+        with app.app_context():
+            get_engine().dispose()
+
     return celery
 
 celery = init_celery()
@@ -90,12 +135,100 @@ def page_not_found(e):
     return render_template('404.html', user=current_user), 404
 
 
+def read_backup_information(backup_path, fields=BACKUP_FIELDS):
+    """
+    Reads fields from the <information> section of a course backup's
+    moodle_backup.xml.
+
+    The manifest is parsed as a stream straight out of the zip file, and
+    parsing stops once every field has been seen, so nothing is written to
+    disk and only the start of the manifest is read.
+
+    Args:
+        backup_path (string): Full path to the backup zip file
+        fields (list): Tags inside <information> to read
+
+    Returns:
+        dict. Tag -> text for each field
+
+    Raises:
+        ValueError if any of the fields is missing
+    """
+    found = {}
+    wanted = set(fields)
+
+    with zipfile.ZipFile(backup_path) as backup:
+        manifest = backup.open("moodle_backup.xml")
+        try:
+            for event, elem in etree.iterparse(manifest, events=('end',)):
+                parent = elem.getparent()
+                if (elem.tag in wanted and parent is not None and
+                        parent.tag == 'information'):
+                    found[elem.tag] = elem.text
+                    wanted.discard(elem.tag)
+                    if not wanted:
+                        break
+
+                # Drop what has been parsed to keep memory use flat
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del parent[0]
+        finally:
+            manifest.close()
+
+    if wanted:
+        raise ValueError("moodle_backup.xml has no %s" %
+                         ', '.join(sorted(wanted)))
+
+    return found
+
+
+def next_course_serial():
+    """
+    Returns the serial for the next new course. Serials count up from 1000.
+    """
+    serial = g.db_session.query(func.max(Course.serial)).scalar()
+    return max(serial + 1, 1000) if serial is not None else 1000
+
+
+def new_course_from_backup(info, source, file_path, serial):
+    """
+    Builds, but does not add, a Course from a backup's moodle_backup.xml.
+
+    Args:
+        info (dict): The backup's information, see read_backup_information
+        source (string): FLVS/NROC/other course types, may have slashes
+        file_path (string): Path of the backup relative to source
+        serial (int): Serial for the course, see next_course_serial
+
+    Returns:
+        Course
+    """
+    _version_re = re.findall(r'_v(\d)_', file_path)
+
+    # Regex will only be a list if it has a value in it
+    version = _version_re[0] if list(_version_re) else None
+
+    return Course(
+        name=info['original_course_fullname'],
+        filename=file_path,
+        license=None,
+        moodle_course_id=info['original_course_id'],
+        moodle_version=info['moodle_release'],
+        serial=serial,
+        shortname=info['original_course_shortname'],
+        source=source.replace('/', ''),
+        updated=datetime.now(),
+        version=version
+    )
+
+
 def create_course_from_moodle_backup(base_path, source, file_path):
     """
     This creates a Course object from a backup xml file for FLVS/NROC courses.
 
-    We do this by extracting the zip file containing the xml, pulling the
-    required data from moodle.xml, and then creating our Course object.
+    We do this by reading moodle_backup.xml from the zip file, pulling the
+    required data from it, and then creating our Course object.
 
     The full file path format looks something like this:
         base_path          |   source  |          file_path
@@ -110,49 +243,28 @@ def create_course_from_moodle_backup(base_path, source, file_path):
                     "flvs_osl_2912/backup_algebra2.xml" is a valid file_path.
 
     Returns:
-        Nothing
+        The Course matching the backup, created if none existed
     """
-    # Needed to delete extracted xml once operation is done
-    project_folder = current_app.config["PROJECT_PATH"]
-
-    # Unzip the file to get the manifest (All course backups are zip files)
-    zip = zipfile.ZipFile(base_path + source + file_path)
-    xmlfile = file(zip.extract("moodle_backup.xml"), "r")
-    xml = Soup(xmlfile.read(), "lxml")
-    info = xml.moodle_backup.information
+    # All course backups are zip files
+    info = read_backup_information(base_path + source + file_path)
 
     course = Course.query.filter_by(
-        name=info.original_course_fullname.string) or \
+        name=info['original_course_fullname']).first() or \
         Course.query.filter_by(
-            name=info.original_course_shortname.string)
+            name=info['original_course_shortname']).first()
 
     if not course:
-        _version_re = re.findall(r'_v(\d)_', file_path)
-
-        # Regex will only be a list if it has a value in it
-        version = _version_re[0] if list(_version_re) else None
-
         # Create a course since one is unable to be found with that name.
-        new_course = Course(
-            name=info.original_course_fullname.string,
-            filename=file_path,
-            license=None,
-            moodle_course_id=info.original_course_id.string,
-            moodle_version=info.moodle_release.string,
-            serial=1000 + len(Course.query.all()),
-            shortname=info.original_course_shortname.string,
-            source=source.replace('/', ''),
-            updated=datetime.now(),
-            version=version
-        )
+        new_course = new_course_from_backup(info, source, file_path,
+                                            next_course_serial())
         g.db_session.add(new_course)
 
         # Until the session is committed, the new_course does not yet have
         # an id.
         g.db_session.commit()
+        course = new_course
 
-    # Get rid of moodle_backup.xml
-    os.remove(os.path.join(project_folder, "moodle_backup.xml"))
+    return course
 
 
 def district_details(schools, active):
@@ -174,25 +286,180 @@ def district_details(schools, active):
     user_count = 0
 
     # Only look at counts if the schools are in the 'active' category.
-    if active:
-        for school in schools:
-            sites = Site.query.filter_by(school_id=school.id).all()
-            for site in sites:
-                details = SiteDetail.query.filter_by(site_id=site.id) \
-                                          .order_by(SiteDetail
-                                                    .timemodified
-                                                    .desc()) \
-                                          .first()
-                if details:
-                    admin_count += details.adminusers or 0
-                    teacher_count += details.teachers or 0
-                    user_count += details.totalusers or 0
+    school_ids = [school.id for school in schools]
+    if active and school_ids:
+        totals = g.db_session.query(
+            func.sum(SiteDetail.adminusers),
+            func.sum(SiteDetail.teachers),
+            func.sum(SiteDetail.totalusers)
+        ).select_from(Site).join(Site.latest_site_detail).filter(
+            Site.school_id.in_(school_ids)
+        ).first()
+
+        admin_count = int(totals[0] or 0)
+        teacher_count = int(totals[1] or 0)
+        user_count = int(totals[2] or 0)
 
     return {'admins': admin_count,
             'teachers': teacher_count,
             'users': user_count}
 
 
+class MoodleError(Exception):
+    """
+    Raised when a moodle site can not be reached or returns an error.
+
+    kind : short name for the failure, used to group failures in harvest
+           summaries ('timeout', 'connection', 'http 403', 'moodle error', ...)
+    """
+
+    def __init__(self, kind, message):
+        Exception.__init__(self, message)
+        self.kind = kind
+
+
+def moodle_timeout():
+    """
+    The (connect, read) timeout in seconds for requests made to moodle sites,
+    from MOODLE_CONNECT_TIMEOUT and MOODLE_READ_TIMEOUT.
+    """
+    return (current_app.config.get('MOODLE_CONNECT_TIMEOUT', 5),
+            current_app.config.get('MOODLE_READ_TIMEOUT', 60))
+
+
+def get_site_url(baseurl):
+    """
+    Prepends the protocol to a site's baseurl if necessary.
+    """
+    return ("http://%s" % baseurl
+            if not baseurl.startswith("http") else baseurl)
+
+
+def fetch_siteinfo(baseurl, siteinfo_token, active_since, timeout=None):
+    """
+    Requests siteinfo from the orvsd_siteinfo webservice of a moodle site.
+
+    This does not touch the database or the app, so it is safe to call from
+    worker threads.
+
+    Args:
+        baseurl (string): The site's baseurl, with or without a protocol
+        siteinfo_token (string): The site's orvsd_siteinfo token
+        active_since (int): Days a user may be idle and still count as active
+        timeout: Seconds, or a (connect, read) tuple, passed to requests
+
+    Returns:
+        dict. The decoded siteinfo
+
+    Raises:
+        MoodleError if the site could not be reached or returned an error
+    """
+    # Make the request
+    try:
+        req = requests.post(
+            url="%s/webservice/rest/server.php" % get_site_url(baseurl),
+            data={
+                'wstoken': siteinfo_token,
+                'wsfunction': 'local_orvsd_siteinfo_siteinfo',
+                'moodlewsrestformat': 'json',
+                'datetime': str(active_since)
+            },
+            timeout=timeout
+        )
+    except Timeout:
+        raise MoodleError('timeout', "Timed out waiting for the site")
+    except ConnectionError:
+        raise MoodleError('connection', "Unable to connect to the site")
+
+    try:
+        gathered_info = req.json()
+    except ValueError:
+        # REST may be disabled
+        if req.status_code == 403:
+            raise MoodleError(
+                'http 403', "403 Returned, is the REST service enabled?"
+            )
+        # Response given by the site
+        raise MoodleError(
+            'http %s' % req.status_code,
+            "did not receive json: '%s'" % req.text
+        )
+
+    # Check for errors from moodle
+    if gathered_info.get('error', None):
+        raise MoodleError('moodle error', gathered_info['error'])
+    elif gathered_info.get('exception', None):
+        raise MoodleError('moodle exception', gathered_info['exception'])
+
+    return gathered_info
+
+
+def parse_site_courses(courses):
+    """
+    Returns the list of course dicts in siteinfo's courses, which is JSON
+    text. Anything that is not a list of courses counts as no courses.
+    """
+    if isinstance(courses, basestring):
+        try:
+            courses = json.loads(courses) if courses else []
+        except ValueError:
+            return []
+    if not isinstance(courses, list):
+        return []
+    return [course for course in courses if isinstance(course, dict)]
+
+
+def get_site_enrolments(courses):
+    """
+    Builds the SiteDetailCourse entries for siteinfo's courses.
+    """
+    return [SiteDetailCourse(serial=course.get('serial'),
+                             shortname=course.get('shortname'),
+                             fullname=course.get('fullname'),
+                             enrolled=course.get('enrolled'))
+            for course in parse_site_courses(courses)]
+
+
+def store_siteinfo(site, gathered_info):
+    """
+    Records fetched siteinfo as the site's latest SiteDetail. The caller is
+    responsible for committing.
+
+    Returns:
+        tuple. The site's latest SiteDetail and whether the siteinfo changed
+    """
+    # handle the adminlist
+    adminlist = json.dumps(gathered_info.get('adminlist', ''))
+
+    site_details = SiteDetail(
+        site_id=site.id,
+        courses=gathered_info.get('courses', ''),
+        siteversion=gathered_info.get('siteversion', ''),
+        siterelease=gathered_info.get('siterelease', ''),
+        adminlist=adminlist,
+        totalusers=gathered_info.get('totalusers', 0),
+        adminusers=gathered_info.get('adminusers', 0),
+        teachers=gathered_info.get('teachers', 0),
+        activeusers=gathered_info.get('activeusers', 0),
+        totalcourses=gathered_info.get('totalcourses', 0),
+        timemodified=datetime.now()
+    )
+
+    # Compared for the harvest schedule, see harvest.schedule_next_harvest
+    previous = site.latest_site_detail
+    changed = not previous or any(
+        getattr(previous, field) != getattr(site_details, field)
+        for field in SITEINFO_FIELDS
+    )
+
+    site_details.enrolments = get_site_enrolments(site_details.courses)
+    g.db_session.add(site_details)
+    # Move the site's snapshot pointer in the same transaction
+    site.latest_site_detail = site_details
+
+    return site_details, changed
+
+
 def gather_siteinfo(site):
     """
     Using the siteinfo webservice plugin for moodle, gather the siteinfo data
@@ -207,74 +474,74 @@ def gather_siteinfo(site):
     # If we have the siteinfo token, lets grab the data
     siteinfo_token = site.get_token('orvsd_siteinfo')
     if siteinfo_token:
-        site_url = ("http://%s" % site.baseurl
-                    if not site.baseurl.startswith("http") else site.baseurl)
-
         active_since = current_app.config.get('MOODLE_ACTIVE_SINCE', None)
         if not active_since:
             err = 'MOODLE_ACTIVE_SINCE not defined in configuration settings.'
             logging.error(err)
             return
 
-        # Make the request
-        req = requests.post(
-            url="%s/webservice/rest/server.php" % site_url,
-            data={
-                'wstoken': siteinfo_token,
-                'wsfunction': 'local_orvsd_siteinfo_siteinfo',
-                'moodlewsrestformat': 'json',
-                'datetime': str(active_since)
-            }
-        )
-
         try:
-            # Add this data to the site details table
-            gathered_info = req.json()
-
-            # Check for errors from moodle
-            if gathered_info.get('error', None):
-                logging.error(
-                    "%s: %s" % (site.name, gathered_info['error'])
-                )
-                return
-            elif gathered_info.get('exception', None):
-                logging.error(
-                    "%s: %s" % (site.name, gathered_info['exception'])
-                )
-                return
-        except ValueError:
-            # REST may be disabled
-            if req.status_code == 403:
-                logging.error(
-                    "%s: 403 Returned, is the REST service enabled?" %
-                    site.name
-                )
-            # Response given by the site
-            logging.error(
-                "%s: did not receive json: '%s'" %
-                (site.name, req.text)
-            )
+            gathered_info = fetch_siteinfo(site.baseurl, siteinfo_token,
+                                           active_since, moodle_timeout())
+        except MoodleError as e:
+            logging.error("%s: %s" % (site.name, e))
             return
 
-        # handle the adminlist
-        adminlist = json.dumps(gathered_info.get('adminlist', ''))
-
-        site_details = SiteDetail(
-            site_id=site.id,
-            courses=gathered_info.get('courses', ''),
-            siteversion=gathered_info.get('siteversion', ''),
-            siterelease=gathered_info.get('siterelease', ''),
-            adminlist=adminlist,
-            totalusers=gathered_info.get('totalusers', 0),
-            adminusers=gathered_info.get('adminusers', 0),
-            teachers=gathered_info.get('teachers', 0),
-            activeusers=gathered_info.get('activeusers', 0),
-            totalcourses=gathered_info.get('totalcourses', 0),
-            timemodified=datetime.now()
+        store_siteinfo(site, gathered_info)
+        g.db_session.commit()
+        report_changed()
+
+
+def fetch_token(site_url, service, username, password, timeout=None,
+                session=None):
+    """
+    Requests a token for a webservice from a moodle site's login/token.php.
+
+    This does not touch the database or the app, so it is safe to call from
+    worker threads.
+
+    Args:
+        site_url (string): The site's url, including the protocol
+        service (string): Shortname of the service to get a token for
+        username, password (string): The moodle account to log in as
+        timeout: Seconds, or a (connect, read) tuple, passed to requests
+        session (requests.Session): Reuse a keep-alive connection to the site
+
+    Returns:
+        string. The token
+
+    Raises:
+        MoodleError if the site could not be reached or returned an error
+    """
+    try:
+        resp = (session or requests).post(
+            "%s/login/token.php" % site_url,
+            data={
+                'username': username,
+                'password': password,
+                'service': service
+            },
+            timeout=timeout
+        )
+    except Timeout:
+        raise MoodleError('timeout', "Timed out waiting for the site")
+    except ConnectionError:
+        raise MoodleError('connection', "Unable to connect to the site")
+
+    # Try and decode the json, if we did not receive json, we need to
+    # return the string (resp.text) back to the user as an error
+    try:
+        returned = resp.json()
+    except ValueError:
+        raise MoodleError(
+            'http %s' % resp.status_code,
+            "Unable to parse JSON: %s" % resp.text
         )
 
-        g.db_session.add(site_details)
-        g.db_session.commit()
+    if 'error' in returned:
+        raise MoodleError('moodle error', returned['error'])
+
+    return returned['token']
 
 
 def gather_tokens(site, services=[]):
@@ -300,56 +567,32 @@ def gather_tokens(site, services=[]):
         return
 
     # For the request, prepend the protocol if necessary
-    site_url = ("http://%s" % site.baseurl
-                if not site.baseurl.startswith("http") else site.baseurl)
+    site_url = get_site_url(site.baseurl)
+    session = requests.Session()
 
     # For each service, gather a token
     for service in services:
         try:
             # Using the siteurl and the account information stored in the
             # config, request a token for the given service
-            resp_data = {
-                'username': current_app.config['INSTALL_COURSE_USERNAME'],
-                'password': current_app.config['INSTALL_COURSE_PASS'],
-                'service': service
-            }
-            resp = requests.post(
-                "%s/login/token.php" % site_url,
-                data=resp_data
+            token = fetch_token(
+                site_url, service,
+                current_app.config['INSTALL_COURSE_USERNAME'],
+                current_app.config['INSTALL_COURSE_PASS'],
+                moodle_timeout(), session
             )
-        except ConnectionError:
-            logging.error("%s: Unable to connect to the site" % site.name)
+        except MoodleError as e:
+            logging.error("%s: %s" % (site.name, e))
             continue
 
-        # Try and decode the json, if we did not receive json, we need to
-        # return the string (resp.text) back to the user as an error
-        try:
-            returned = resp.json()
-            # Check for an error log and continue
-            if 'error' in returned:
-                logging.error("%s:  %s" % (
-                    site.name,
-                    returned['error']
-                ))
-                continue
-            else:
-                current_tokens = site.get_moodle_tokens()
-                # Assign the service the retreived token
-                current_tokens[service] = returned['token']
-                # dump the json string and store it for the site
-                site.moodle_tokens = json.dumps(current_tokens)
-                # Commit the change to the database
-                g.db_session.commit()
-                logging.info(
-                    "Added '%s':'%s' to %s" %
-                    (service, returned['token'], site_url)
-                )
-        except ValueError:
-            # Unable to parse JSON, log the problem
-            logging.warning(
-                "Unable to parse JSON for %s: %s" %
-                (site_url, resp.text)
-            )
+        # Assign the service the retreived token
+        site.add_token(service, token)
+        logging.info("Added '%s':'%s' to %s" % (service, token, site_url))
+
+    session.close()
+
+    # Commit all of the site's new tokens at once
+    g.db_session.commit()
 
 
 def get_course_folders(base_path):
@@ -399,6 +642,127 @@ def get_obj_identifier(category):
     return categories.get(category.lower())
 
 
+def get_object_fields(obj):
+    """
+    Returns the names of a model's fields the api serves, those of its
+    serialize().
+    """
+    return [name for name in obj.__table__.columns.keys()
+            if name not in HIDDEN_COLUMNS]
+
+
+def column_value(column, value):
+    """
+    Converts a value from a request to the type of 'column', for comparing
+    against it. Raises ValueError if it can not be.
+    """
+    if value is None:
+        return None
+    if isinstance(column.type, (Integer, BigInteger)):
+        return int(value)
+    if isinstance(column.type, Float):
+        return float(value)
+    if isinstance(column.type, Boolean):
+        return value in [True, 1, 'true', '1']
+    if isinstance(column.type, DateTime):
+        return datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+    return value
+
+
+def get_object_page(obj, identifier, search=None, field=None, sort=None,
+                    descending=False, after=None, limit=100):
+    """
+    Gets a page of a model's objects, reading only their id, identifier and
+    sort column. Pages are keyed on the sort column and id, pass the 'after'
+    the previous page returned to get the next.
+
+    obj        -- The model, see get_obj_by_category
+    identifier -- Column users know the objects by, see get_obj_identifier
+    search     -- Only objects whose 'field' contains this, or equals it
+                  for non text columns
+    field      -- Column searched, the identifier if None
+    sort       -- Column the objects are ordered by, the identifier if None
+    descending -- Order from the largest value
+    after      -- (sort value, id) of the last object of the previous page
+    limit      -- Objects per page
+
+    Returns:
+        tuple. The page as dicts, and the 'after' of the next page, None if
+        this is the last. Raises ValueError for unknown columns or values of
+        the wrong type.
+    """
+    columns = obj.__table__.columns
+    field = field or identifier
+    sort = sort or identifier
+    # Masked columns may not be probed by searching or sorting either
+    allowed = set(get_object_fields(obj)) - set(MASKED_COLUMNS)
+    if field not in allowed or sort not in allowed:
+        raise ValueError("Unknown column")
+    sort_column = columns[sort]
+
+    names = ['id']
+    for name in [identifier, sort]:
+        if name not in names:
+            names.append(name)
+    page = g.db_session.query(*[columns[name] for name in names])
+
+    if search:
+        search_column = columns[field]
+        if isinstance(search_column.type, String):
+            for char in ['\\', '%', '_']:
+                search = search.replace(char, '\\' + char)
+            page = page.filter(search_column.like('%' + search + '%',
+                                                  escape='\\'))
+        else:
+            page = page.filter(search_column == column_value(search_column,
+                                                             search))
+
+    if after:
+        value, last_id = column_value(sort_column, after[0]), int(after[1])
+        # NULLs come first in ascending order, last in descending
+        if descending:
+            if value is None:
+                page = page.filter(sort_column.is_(None),
+                                   obj.id < last_id)
+            else:
+                page = page.filter(or_(
+                    sort_column < value,
+                    and_(sort_column == value, obj.id < last_id),
+                    sort_column.is_(None)
+                ))
+        elif value is None:
+            page = page.filter(or_(
+                and_(sort_column.is_(None), obj.id > last_id),
+                sort_column.isnot(None)
+            ))
+        else:
+            page = page.filter(or_(
+                sort_column > value,
+                and_(sort_column == value, obj.id > last_id)
+            ))
+
+    if descending:
+        page = page.order_by(sort_column.desc(), obj.id.desc())
+    else:
+        page = page.order_by(sort_column, obj.id)
+
+    # One extra row tells whether there is a next page
+    rows = page.limit(limit + 1).all()
+
+    objects = []
+    for row in rows[:limit]:
+        values = dict(zip(names, row))
+        for name, value in values.items():
+            if isinstance(value, datetime):
+                values[name] = value.isoformat()
+        objects.append(values)
+
+    next_after = None
+    if len(rows) > limit:
+        next_after = [objects[-1][sort], objects[-1]['id']]
+    return objects, next_after
+
+
 # /base_path/source/path is the format of the parsed directories.
 def get_path_and_source(base_path, file_path):
     """
@@ -424,61 +788,155 @@ def get_active_counts():
     """
     Get the active counts of all the things - schools, sites, districts, users,
     admins, and teachers
+
+    The user counts are summed over each active site's newest SiteDetail and
+    schools and districts are counted by unique name, all in one statement.
     """
 
-    # Dictionary being returned of all count data
-    active_counts = {
-        'districts': 0,
-        'schools': 0,
-        'sites': 0,
+    totals = g.db_session.query(
+        func.sum(SiteDetail.adminusers),
+        func.sum(SiteDetail.teachers),
+        func.sum(SiteDetail.totalusers),
+        func.sum(SiteDetail.activeusers),
+        func.count(Site.id),
+        func.count(School.name.distinct()),
+        func.count(District.name.distinct())
+    ).select_from(Site).join(Site.latest_site_detail).outerjoin(
+        School, Site.school_id == School.id
+    ).outerjoin(
+        District, School.district_id == District.id
+    ).one()
+
+    # MySQL returns SUM() as a Decimal, which jsonify can not handle
+    admins, teachers, totalusers, activeusers, sites, schools, districts = [
+        int(total or 0) for total in totals
+    ]
+
+    return {
+        'districts': districts,
+        'schools': schools,
+        'sites': sites,
         'courses': Course.query.count(),
-        'admins': 0,
-        'teachers': 0,
-        'totalusers': 0,
-        'activeusers': 0
+        'admins': admins,
+        'teachers': teachers,
+        'totalusers': totalusers,
+        'activeusers': activeusers
     }
 
-    # Starting from the perspective of sites
-    sites = Site.query.join(SiteDetail).distinct().all()
 
-    # When looking for districts and schools, record unique names and count
-    # those at the end
-    active_schools = set()
-    active_districts = set()
+def get_report_sites(dist_id=None):
+    """
+    Query of (District, School, Site, SiteDetail, course count) rows for
+    every site of the active schools, ordered by district, school and site
+    name.
+
+    An active school has at least one site with a SiteDetail. Sites of active
+    schools are included even without details, their SiteDetail is None.
 
-    # For each site, check if there is a SiteDetail associated. If there is,
-    # that means the site is active and we want all the details about users.
-    for site in sites:
-        sd = SiteDetail.query.filter(
-            SiteDetail.site_id == site.id
-        ).order_by(
-            SiteDetail.timemodified.desc()
-        ).first()
+    dist_id -- Optional ID of a district to narrow the search down with
+    """
+
+    # Schools with at least one site that has reported details, checked
+    # per school through the sites' school_id index
+    reporting_site = aliased(Site)
+    active_school = exists().where(and_(
+        reporting_site.school_id == School.id,
+        reporting_site.latest_site_detail_id.isnot(None)
+    ))
+
+    # Counted from the index for each row, not from the courses JSON
+    course_count = g.db_session.query(
+        func.count(SiteDetailCourse.id)
+    ).filter(
+        SiteDetailCourse.site_detail_id == SiteDetail.id
+    ).correlate(SiteDetail).as_scalar()
+
+    # Every site of the active schools, with its newest details
+    sites = g.db_session.query(
+        District, School, Site, SiteDetail, course_count
+    ).join(
+        School, School.district_id == District.id
+    ).join(
+        Site, Site.school_id == School.id
+    ).outerjoin(Site.latest_site_detail).filter(active_school)
+
+    if dist_id is not None:
+        sites = sites.filter(District.id == dist_id)
+
+    return sites.order_by(District.name, District.id, School.name, Site.name)
+
+
+def get_site_report(school, site, details, courses=0):
+    """
+    Builds the report entry for a site, as shown in the district tables.
+
+    courses -- Number of courses in the site's details
+    """
+    site_info = {'sitename': site.name,
+                 'schoolname': school.name,
+                 'schoolid': school.id,
+                 'baseurl': site.baseurl}
+    if details:
+        site_info['admin'] = details.adminlist
+        site_info['teachers'] = details.teachers
+        site_info['activeusers'] = details.activeusers
+        site_info['totalusers'] = details.totalusers
+        site_info['courses'] = courses or 0
+    return site_info
+
+
+def get_site_courses(site_detail_id, min_enrolled=None, page=1,
+                     per_page=None):
+    """
+    Gets a page of the courses in a SiteDetail, ordered by short name.
+
+    site_detail_id -- ID of the SiteDetail
+    min_enrolled   -- Only courses with more users enrolled than this
+    page           -- Page number, starting at 1
+    per_page       -- Courses per page, all of them if None
+
+    Returns:
+        tuple. The page's SiteDetailCourses and the number of courses on
+        every page
+    """
+    courses = SiteDetailCourse.query.filter(
+        SiteDetailCourse.site_detail_id == site_detail_id
+    )
+    if min_enrolled is not None:
+        courses = courses.filter(SiteDetailCourse.enrolled > min_enrolled)
+
+    total = courses.count()
+    courses = courses.order_by(SiteDetailCourse.shortname,
+                               SiteDetailCourse.id)
+    if per_page:
+        courses = courses.offset((max(page, 1) - 1) * per_page).limit(
+            per_page
+        )
 
-        if sd:
-            # Grab all the details about the users
-            active_counts['admins'] += sd.adminusers
-            active_counts['teachers'] += sd.teachers
-            active_counts['totalusers'] += sd.totalusers
-            active_counts['activeusers'] += sd.activeusers
-            active_counts['sites'] += 1
+    return courses.all(), total
 
-            # Add the school and district names to their respective sets for
-            # later counting
-            school = School.query.filter(School.id == site.school_id).first()
-            if school:
-                active_schools.add(school.name)
-                district = District.query.filter(
-                    District.id == school.district_id
-                ).first()
-                if district:
-                    active_districts.add(district.name)
 
-    # Count all the unique schools and districts
-    active_counts['districts'] = len(active_districts)
-    active_counts['schools'] = len(active_schools)
+def get_district_report():
+    """
+    Generates the report for every active district, in name order, from a
+    single query.
 
-    return active_counts
+    Yields:
+        dict. The district's id, name and shortname, and 'sites' which maps
+        site ids to their get_site_report() entry.
+    """
+    rows = get_report_sites()
+    for district, district_rows in groupby(rows, key=lambda row: row[0]):
+        yield {
+            'id': district.id,
+            'name': district.name,
+            'shortname': district.shortname,
+            'sites': dict(
+                (str(site.id), get_site_report(school, site, details,
+                                               courses))
+                for _, school, site, details, courses in district_rows
+            )
+        }
 
 
 def get_schools(dist_id, active):
@@ -492,47 +950,79 @@ def get_schools(dist_id, active):
     active  -- Status of schools to find
     """
 
-    # Get all schools in the district with dist_id
-    schools = School.query.filter_by(district_id=dist_id)
-    active_schools = schools.join(Site).join(SiteDetail).distinct()
-
     # Dict to return for the report
     district_info = {}
 
-    for school in active_schools:
-        # Get the sites associated with the school
-        sites = Site.query.filter_by(school_id=school.id).distinct()
-
-        for site in sites:
-            details = SiteDetail.query.filter_by(site_id=site.id).order_by(
-                SiteDetail.timemodified.desc()
-            ).first()
-
-            district_info[str(site.id)] = {}
-            district_info[str(site.id)]['sitename'] = site.name
-            district_info[str(site.id)]['schoolname'] = school.name
-            district_info[str(site.id)]['schoolid'] = school.id
-            district_info[str(site.id)]['baseurl'] = site.baseurl
-            if details:
-                district_info[str(site.id)]['admin'] = details.adminlist
-                district_info[str(site.id)]['teachers'] = details.teachers
-                district_info[str(site.id)]['activeusers'] = details.activeusers
-                district_info[str(site.id)]['totalusers'] = details.totalusers
-                district_info[str(site.id)]['courses'] = (
-                    len(json.loads(details.courses)) if details.courses else 0
-                )
+    for _, school, site, details, courses in get_report_sites(dist_id):
+        district_info[str(site.id)] = get_site_report(school, site, details,
+                                                      courses)
 
     return district_info
 
 
-@celery.task(name='tasks.install_course')
-def install_course_to_site(course_id, install_url):
+def refresh_latest_site_detail(site_id):
+    """
+    Points a site back at its newest SiteDetail. gather_siteinfo keeps the
+    pointer current on its own, this is for details edited or removed by hand.
+
+    site_id -- ID of the site whose pointer needs updating
+    """
+    latest = g.db_session.query(SiteDetail.id).filter(
+        SiteDetail.site_id == site_id
+    ).order_by(SiteDetail.timemodified.desc()).first()
+
+    g.db_session.query(Site).filter(Site.id == site_id).update(
+        {'latest_site_detail_id': latest[0] if latest else None},
+        synchronize_session=False
+    )
+
+
+def install_failed(self, exc, task_id, args, kwargs, einfo):
+    """
+    Handles an install that raised instead of returning: it is dead-lettered
+    and its FAILURE published, so its batch still finishes.
+    """
+    with current_app.app_context():
+        course_id = args[0] if args else kwargs.get('course_id')
+        install_url = args[1] if len(args) > 1 else kwargs.get('install_url')
+        host = kwargs.get('host') or urlparse.urlparse(
+            install_url or ''
+        ).hostname
+        dead_letter(task_id, kwargs.get('site_id'), course_id, host,
+                    kwargs.get('attempt', 0) + 1, exc)
+        publish_progress(task_id, 'FAILURE', str(exc))
+
+
+@celery.task(name='tasks.install_course', bind=True, max_retries=None,
+             on_failure=install_failed)
+def install_course_to_site(self, course_id, install_url, site_id=None,
+                           host=None, attempt=0):
     """
     Installs 'course' to 'site'.
+
+    The install waits for a free slot of the site's host, see scheduler, and
+    is retried with backoff if it fails in a way that may pass. Installs that
+    are given up on are recorded as InstallDeadLetters.
+
+    Args:
+        course_id (int): Course to install
+        install_url (str): The site's install webservice, see get_install_url
+        site_id (int): The site, recorded with dead letters
+        host (str): Host the install is limited by, see get_install_host
+        attempt (int): Number of earlier failed attempts
     """
+    if host is None:
+        host = urlparse.urlparse(install_url).hostname
+
     # To get the file path we need the text input, the lowercase of
     # source, and the filename
     course = Course.query.filter_by(id=course_id).first()
+    if course is None:
+        # Deleted since the install was queued, there is nothing to retry
+        error = InstallError("No course %s" % course_id)
+        dead_letter(self.request.id, site_id, None, host, attempt + 1, error)
+        publish_progress(self.request.id, 'FAILURE', str(error))
+        return "%s\n\nFailed: %s\n\n\n" % (course_id, error)
 
     fp = os.path.join(current_app.config['INSTALL_COURSE_FILE_PATH'],
                       course.source)
@@ -550,9 +1040,262 @@ def install_course_to_site(course_id, install_url):
             'email': current_app.config['INSTALL_COURSE_EMAIL'],
             'pass': current_app.config['INSTALL_COURSE_PASS']}
 
-    resp = requests.post(install_url, data=data, timeout=None)
+    slot = acquire_slot(host, self.request.id)
+    if slot is None:
+        # The host is busy with other installs, this is not a failure
+        raise self.retry(countdown=slot_wait())
+
+    try:
+        publish_progress(self.request.id, 'STARTED',
+                         "Installing %s" % course.shortname)
+        resp = requests.post(install_url, data=data,
+                             timeout=install_timeout())
+        if resp.status_code in TRANSIENT_STATUSES:
+            raise InstallError("HTTP %d" % resp.status_code, transient=True)
+        if resp.status_code != 200:
+            raise InstallError("HTTP %d" % resp.status_code)
+    except Timeout:
+        error = InstallError("Timed out", transient=True)
+    except ConnectionError as e:
+        error = InstallError("Could not connect: %s" % e, transient=True)
+    except RequestException as e:
+        # A bad URL, too many redirects, a broken response...
+        error = InstallError("Request failed: %s" % e)
+    except InstallError as e:
+        error = e
+    else:
+        publish_progress(self.request.id, 'SUCCESS',
+                         "Installed %s" % course.shortname)
+        return "%s\n\n%s\n\n\n" % (course.shortname, resp.text)
+    finally:
+        release_slot(host, slot, self.request.id)
+
+    if (error.transient and
+            attempt < current_app.config.get('INSTALL_MAX_RETRIES', 5)):
+        kwargs = dict(self.request.kwargs or {}, site_id=site_id, host=host,
+                      attempt=attempt + 1)
+        publish_progress(self.request.id, 'RETRY', str(error))
+        raise self.retry(kwargs=kwargs, countdown=retry_countdown(attempt))
+
+    dead_letter(self.request.id, site_id, course_id, host, attempt + 1, error)
+    publish_progress(self.request.id, 'FAILURE', str(error))
+    return "%s\n\nFailed: %s\n\n\n" % (course.shortname, error)
+
+
+def get_install_url(site):
+    """
+    Returns the URL of a site's course install webservice, or None if the
+    site has no orvsd_installcourse token.
+    """
+    token = site.get_token('orvsd_installcourse')
+    if not token:
+        return None
+
+    install_url = ("http://%s/webservice/rest/server.php?" +
+                   "wstoken=%s&wsfunction=%s") % (
+        site.baseurl,
+        token,
+        current_app.config['INSTALL_COURSE_WS_FUNCTION'])
+    return str(install_url.encode('utf-8'))
+
+
+def queue_course_installs(sites, courses):
+    """
+    Installs every course on every site as a single celery group, and
+    records a SiteCourse for each install in one transaction.
+
+    Args:
+        sites (list): Sites to install to
+        courses (list): Courses to install
+
+    Returns:
+        tuple. The group's id, None if nothing was queued, and the sites
+        skipped for having no install token
+    """
+    installs = []
+    skipped = []
+    for site in sites:
+        install_url = get_install_url(site)
+        if install_url is None:
+            skipped.append(site)
+            continue
+        host = get_install_host(site)
+        installs.extend((site.id, course.id, install_url, host)
+                        for course in courses)
+
+    return queue_installs(installs), skipped
+
+
+def queue_installs(installs):
+    """
+    Queues installs as a single celery group and records a SiteCourse for
+    each in one transaction.
+
+    Args:
+        installs (list): (site id, course id, install url, host) of each
+            install
+
+    Returns:
+        str. The group's id, None if there was nothing to queue
+    """
+    if not installs:
+        return None
+
+    batch = group(
+        install_course_to_site.s(course_id, install_url, site_id=site_id,
+                                 host=host)
+        for site_id, course_id, install_url, host in installs
+    ).apply_async()
+    # Kept in the result backend so the batch can be looked up by its id
+    batch.save()
+
+    g.db_session.execute(SiteCourse.__table__.insert(), [
+        {'site_id': site_id,
+         'course_id': course_id,
+         'celery_task_id': result.id,
+         'install_batch_id': batch.id}
+        for (site_id, course_id, _, _), result in zip(installs,
+                                                       batch.results)
+    ])
+    g.db_session.commit()
+
+    return batch.id
+
+
+def requeue_dead_installs(host=None):
+    """
+    Queues the installs that were given up on again, as one batch, and
+    removes their InstallDeadLetters. Installs to sites that have since lost
+    their install token, or of courses that no longer exist, stay
+    dead-lettered.
+
+    Args:
+        host (str): Only requeue installs to this host
+
+    Returns:
+        tuple. The batch's id, None if nothing was queued, and the number of
+        installs queued
+    """
+    letters = InstallDeadLetter.query
+    if host:
+        letters = letters.filter(InstallDeadLetter.host == host)
+    letters = letters.all()
+
+    site_ids = set(letter.site_id for letter in letters)
+    sites = dict((site.id, site) for site in
+                 Site.query.filter(Site.id.in_(site_ids))) if site_ids else {}
+
+    installs = []
+    requeued = []
+    for letter in letters:
+        site = sites.get(letter.site_id)
+        install_url = get_install_url(site) if site else None
+        if install_url is None or letter.course_id is None:
+            continue
+        installs.append((site.id, letter.course_id, install_url,
+                         get_install_host(site)))
+        requeued.append(letter.id)
 
-    return "%s\n\n%s\n\n\n" % (course.shortname, resp.text)
+    if requeued:
+        g.db_session.query(InstallDeadLetter).filter(
+            InstallDeadLetter.id.in_(requeued)
+        ).delete(synchronize_session=False)
+
+    return queue_installs(installs), len(installs)
+
+
+def get_install_tasks(statuses=None, since=None, until=None, site_id=None,
+                      course_id=None, after=None, limit=100):
+    """
+    Gets a page of course installs and the state of their celery tasks,
+    newest first. Pages are keyed on the SiteCourse id, pass the 'after' the
+    previous page returned to get the next.
+
+    statuses  -- Only tasks in one of these states. Tasks without a result
+                 yet are 'PENDING', installs given up on 'FAILURE'
+    since     -- Only tasks done at or after this datetime
+    until     -- Only tasks done before this datetime
+    site_id   -- Only installs to this site
+    course_id -- Only installs of this course
+    after     -- Only installs older than this SiteCourse id
+    limit     -- Installs per page
+
+    Returns:
+        tuple. The page's installs as dicts, and the 'after' of the next page,
+        None if this is the last
+    """
+    # Given up on installs are failures, though their task succeeded in
+    # recording them, see get_task_statuses
+    status = case([(InstallDeadLetter.id.isnot(None), 'FAILURE')],
+                  else_=func.coalesce(TaskMeta.status, 'PENDING'))
+    tasks = g.db_session.query(
+        SiteCourse.id,
+        SiteCourse.site_id,
+        SiteCourse.course_id,
+        SiteCourse.celery_task_id,
+        SiteCourse.install_batch_id,
+        status,
+        TaskMeta.date_done,
+        InstallDeadLetter.error
+    ).outerjoin(
+        TaskMeta, TaskMeta.task_id == SiteCourse.celery_task_id
+    ).outerjoin(
+        InstallDeadLetter,
+        InstallDeadLetter.task_id == SiteCourse.celery_task_id
+    ).filter(SiteCourse.celery_task_id.isnot(None))
+
+    if statuses:
+        tasks = tasks.filter(status.in_(statuses))
+    if since:
+        tasks = tasks.filter(TaskMeta.date_done >= since)
+    if until:
+        tasks = tasks.filter(TaskMeta.date_done < until)
+    if site_id:
+        tasks = tasks.filter(SiteCourse.site_id == site_id)
+    if course_id:
+        tasks = tasks.filter(SiteCourse.course_id == course_id)
+    if after:
+        tasks = tasks.filter(SiteCourse.id < after)
+
+    # One extra row tells whether there is a next page
+    rows = tasks.order_by(SiteCourse.id.desc()).limit(limit + 1).all()
+
+    page = [{'id': row[0],
+             'site_id': row[1],
+             'course_id': row[2],
+             'task_id': row[3],
+             'batch_id': row[4],
+             'status': row[5],
+             'date_done': row[6].isoformat() if row[6] else None,
+             'error': row[7]}
+            for row in rows[:limit]]
+    return page, (page[-1]['id'] if len(rows) > limit else None)
+
+
+def get_task_statuses(task_ids):
+    """
+    Looks up the states of many celery tasks in one query.
+
+    Installs given up on are 'FAILURE', though the task itself succeeded in
+    recording them. Tasks without a result yet are 'PENDING', like celery's
+    AsyncResult.status.
+
+    Returns:
+        dict. Each task id's status
+    """
+    statuses = dict((task_id, 'PENDING') for task_id in task_ids)
+    if not statuses:
+        return statuses
+
+    rows = g.db_session.query(
+        TaskMeta.task_id, TaskMeta.status, InstallDeadLetter.id
+    ).outerjoin(
+        InstallDeadLetter, InstallDeadLetter.task_id == TaskMeta.task_id
+    ).filter(TaskMeta.task_id.in_(list(statuses)))
+
+    for task_id, status, dead_letter_id in rows:
+        statuses[task_id] = 'FAILURE' if dead_letter_id else status
+    return statuses
 
 
 @login_manager.user_loader
@@ -560,8 +1303,22 @@ def load_user(userid):
     """
     Loads a user via a user_id.
     * This is needed for Flask-Login.
+
+    Users are cached for USER_CACHE_TIMEOUT seconds, so most requests are
+    authenticated without a query. The cache holds a copy outside of any
+    session and each request is given its own, merged into g.db_session.
     """
-    return User.query.filter_by(id=userid).first()
+    cache = get_user_cache()
+    key = "user:%s" % userid
+    user = cache.get(key)
+    if user is None:
+        user = User.query.filter_by(id=userid).first()
+        if user is None:
+            return None
+        g.db_session.expunge(user)
+        cache.set(key, user)
+    # No query, the cached copy's loaded columns are copied over
+    return g.db_session.merge(user, load=False)
 
 
 def string_to_type(string):
@@ -0,0 +1,151 @@
+"""
+Tests for bulk changes through the api
+"""
+import json
+
+from flask import g
+
+from base import db_context, TestBase
+
+
+class BulkTest(TestBase):
+
+    def setUp(self):
+        super(BulkTest, self).setUp({'BULK_CHUNK_SIZE': 2})
+
+    def post(self, url, operations):
+        resp = self.app.test_client().post(
+            url, data=json.dumps(operations), content_type='application/json'
+        )
+        return resp.status_code, json.loads(resp.data)
+
+    @db_context
+    def test_schools_moved_in_one_request(self):
+        from orvsd_central.models import District, School
+
+        unknown = District(name='z No district found')
+        district = District(name='Bend')
+        g.db_session.add_all([unknown, district])
+        g.db_session.commit()
+        schools = [School(name='School %d' % i, district_id=unknown.id)
+                   for i in range(5)]
+        g.db_session.add_all(schools)
+        g.db_session.commit()
+        ids = [school.id for school in schools]
+
+        operations = [{'op': 'update', 'id': str(school_id),
+                       'data': {'district_id': str(district.id)}}
+                      for school_id in ids[:4]]
+        operations += [
+            {'op': 'update', 'id': 999, 'data': {'district_id': 1}},
+            {'op': 'update', 'id': ids[4], 'data': {'nope': 1}},
+            {'op': 'delete', 'id': ids[4]},
+            {'op': 'add', 'data': {'name': 'New School',
+                                   'district_id': district.id}},
+            {'op': 'move'}
+        ]
+        status, resp = self.post('/1/schools/bulk', operations)
+
+        self.assertEqual(status, 200)
+        self.assertTrue(resp['committed'])
+        self.assertEqual([result['status'] for result in resp['results']],
+                         ['ok'] * 4 + ['error', 'error', 'ok', 'ok',
+                                       'error'])
+        self.assertEqual(resp['results'][4]['message'], 'No such object')
+        self.assertEqual(resp['results'][5]['message'], 'Unknown column nope')
+
+        g.db_session.expire_all()
+        self.assertEqual(
+            sorted(school.name for school in
+                   School.query.filter_by(district_id=district.id)),
+            ['New School', 'School 0', 'School 1', 'School 2', 'School 3']
+        )
+        self.assertEqual(School.query.get(ids[4]), None)
+        new_school = School.query.filter_by(name='New School').one()
+        self.assertEqual(resp['results'][7]['id'], new_school.id)
+
+    @db_context
+    def test_nothing_committed_when_a_chunk_fails(self):
+        from orvsd_central.models import User
+
+        g.db_session.add(User('admin', 'admin@example.com', 'pass', 3))
+        g.db_session.commit()
+
+        status, resp = self.post('/1/users/bulk', {'operations': [
+            {'op': 'add', 'data': {'name': 'helpdesk',
+                                   'email': 'help@example.com',
+                                   'password': 'pass', 'role': 1}},
+            # Names are unique
+            {'op': 'add', 'data': {'name': 'admin',
+                                   'email': 'other@example.com',
+                                   'password': 'pass', 'role': 1}}
+        ]})
+        self.assertEqual(status, 409)
+        self.assertFalse(resp['committed'])
+        self.assertTrue(resp['error'])
+        self.assertEqual(User.query.count(), 1)
+
+        resp = self.app.test_client().post(
+            '/1/users/bulk', data=json.dumps({'operations': 'add'}),
+            content_type='application/json'
+        )
+        self.assertEqual(resp.status_code, 400)
+
+    @db_context
+    def test_site_details_keep_latest_pointer(self):
+        from datetime import datetime, timedelta
+        from orvsd_central.models import Site, SiteDetail
+
+        site = Site(name='Site', baseurl='site.example.com')
+        g.db_session.add(site)
+        g.db_session.commit()
+        now = datetime(2014, 12, 17, 12)
+        details = [SiteDetail(site_id=site.id, courses='[]',
+                              timemodified=now - timedelta(days=days))
+                   for days in range(3)]
+        g.db_session.add_all(details)
+        g.db_session.commit()
+        site.latest_site_detail = details[0]
+        g.db_session.commit()
+        ids = [detail.id for detail in details]
+
+        status, resp = self.post('/1/sitedetails/bulk', [
+            {'op': 'delete', 'id': ids[0]},
+            {'op': 'update', 'id': ids[2],
+             'data': {'timemodified': now.isoformat()}}
+        ])
+        self.assertTrue(resp['committed'])
+
+        g.db_session.expire_all()
+        self.assertEqual(Site.query.get(site.id).latest_site_detail_id,
+                         ids[2])
+
+    @db_context
+    def test_added_sites_harvested_by_a_task(self):
+        from orvsd_central import bulk
+        from orvsd_central.models import District
+
+        queued = []
+
+        class Recorder(object):
+            def delay(self, site_ids):
+                queued.append(site_ids)
+
+        harvest_new_sites = bulk.harvest_new_sites
+        bulk.harvest_new_sites = Recorder()
+        try:
+            status, resp = self.post('/1/sites/bulk', [
+                {'op': 'add', 'data': {'name': 'Site %d' % i,
+                                       'baseurl': '127.0.0.1:9'}}
+                for i in range(3)
+            ])
+            self.post('/1/districts/bulk', [
+                {'op': 'add', 'data': {'name': 'Bend'}}
+            ])
+        finally:
+            bulk.harvest_new_sites = harvest_new_sites
+
+        self.assertTrue(resp['committed'])
+        self.assertEqual(queued, [[result['id']
+                                   for result in resp['results']]])
+        self.assertEqual(District.query.count(), 1)
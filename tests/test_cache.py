@@ -0,0 +1,209 @@
+"""
+Tests for the report cache
+"""
+import shutil
+import tempfile
+
+from flask import g
+
+from base import db_context, TestBase
+
+
+class LRUCacheTest(TestBase):
+
+    def test_least_recently_used_dropped(self):
+        from orvsd_central.cache import LRUCache
+
+        cache = LRUCache(threshold=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')),
+                         (1, None, 3))
+
+
+class ReportCacheTest(TestBase):
+
+    def add_course(self, name):
+        from orvsd_central.models import Course
+
+        g.db_session.add(Course(name=name))
+        g.db_session.commit()
+
+    @db_context
+    def test_stats_cached_until_edit(self):
+        client = self.app.test_client()
+        self.add_course('Algebra')
+
+        response = client.get('/1/report/stats')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers.get('ETag'))
+        self.assertTrue(response.headers.get('Last-Modified'))
+
+        # Not written through the api, so the cached stats are served
+        self.add_course('Biology')
+        self.assertEqual(client.get('/1/report/stats').data, response.data)
+
+        revalidated = client.get(
+            '/1/report/stats',
+            headers={'If-None-Match': response.headers['ETag']}
+        )
+        self.assertEqual(revalidated.status_code, 304)
+
+        client.post('/1/districts/object/add',
+                    data={'name': 'Lane', 'shortname': 'lane',
+                          'state_id': '3', 'base_path': ''})
+
+        changed = client.get(
+            '/1/report/stats',
+            headers={'If-None-Match': response.headers['ETag']}
+        )
+        self.assertEqual(changed.status_code, 200)
+        self.assertIn('"courses": 2', changed.data)
+        self.assertNotEqual(changed.headers['ETag'], response.headers['ETag'])
+
+    @db_context
+    def test_district_report_cached(self):
+        from datetime import datetime
+        import json
+        from orvsd_central.models import District, School, Site, SiteDetail
+
+        district = District(name='Lane', shortname='lane')
+        g.db_session.add(district)
+        g.db_session.commit()
+        school = School(district_id=district.id, name='Lane High')
+        g.db_session.add(school)
+        g.db_session.commit()
+        site = Site(school_id=school.id, name='Lane', baseurl='lane.org')
+        g.db_session.add(site)
+        g.db_session.commit()
+        site.latest_site_detail = SiteDetail(site_id=site.id,
+                                             timemodified=datetime.now())
+        g.db_session.commit()
+
+        client = self.app.test_client()
+        streamed = client.get('/1/report/districts?stream=1').data
+
+        # Not written through the api, the cached report is served
+        g.db_session.execute(Site.__table__.update().values(name='Renamed'))
+        g.db_session.commit()
+        self.assertEqual(client.get('/1/report/districts?stream=1').data,
+                         streamed)
+        self.assertEqual(
+            json.loads(client.get('/1/report/districts').data)['districts'],
+            [json.loads(streamed)]
+        )
+
+    @db_context
+    def test_harvest_in_another_process_seen(self):
+        from datetime import datetime
+        from orvsd_central.cache import LRUCache, cached, get_cache
+        from orvsd_central.models import SiteDetail
+        from orvsd_central.snapshot import build_report_snapshot
+
+        calls = []
+        compute = lambda: calls.append(1) or len(calls)
+        web_cache = get_cache()
+
+        self.assertEqual(cached('count', compute), 1)
+        self.assertEqual(cached('count', compute), 1)
+
+        g.db_session.add(SiteDetail(timemodified=datetime.now()))
+        g.db_session.commit()
+        self.assertEqual(cached('count', compute), 2)
+
+        # gather_siteinfo run from cron invalidates its own cache only
+        self.app.extensions['report_cache'] = LRUCache()
+        build_report_snapshot()
+        self.app.extensions['report_cache'] = web_cache
+        self.assertEqual(cached('count', compute), 3)
+
+    @db_context
+    def test_invalidation_shared_through_file_cache(self):
+        from orvsd_central.cache import (cached, create_cache,
+                                         invalidate_report_cache)
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            config = {'REPORT_CACHE': 'file', 'REPORT_CACHE_DIR': cache_dir}
+            self.app.extensions['report_cache'] = create_cache(config)
+
+            calls = []
+            compute = lambda: calls.append(1) or len(calls)
+
+            self.assertEqual(cached('count', compute), 1)
+            self.assertEqual(cached('count', compute), 1)
+
+            # Another process sharing the directory invalidates
+            other = create_cache(config)
+            other.set('report:generation', 0.0)
+            self.assertEqual(cached('count', compute), 2)
+
+            invalidate_report_cache()
+            self.assertEqual(cached('count', compute), 3)
+        finally:
+            shutil.rmtree(cache_dir)
+
+
+class UserCacheTest(TestBase):
+
+    def add_user(self):
+        from orvsd_central.models import User
+
+        user = User('helpdesk', 'helpdesk@example.com', 'secret', 2)
+        g.db_session.add(user)
+        g.db_session.commit()
+        return user.id
+
+    def set_role(self, user_id, role):
+        from orvsd_central.models import User
+
+        # Behind the cache's back
+        g.db_session.execute(User.__table__.update().where(
+            User.id == user_id
+        ).values(role=role))
+        g.db_session.commit()
+
+    @db_context
+    def test_user_cached_until_edit(self):
+        import json
+        from orvsd_central.util import load_user
+
+        user_id = self.add_user()
+        client = self.app.test_client()
+
+        self.assertEqual(load_user(user_id).role, 2)
+        self.set_role(user_id, 3)
+        self.assertEqual(load_user(user_id).role, 2)
+
+        client.post('/1/users/bulk', data=json.dumps([
+            {'op': 'update', 'id': user_id, 'data': {'role': 1}}
+        ]), content_type='application/json')
+        self.assertEqual(load_user(user_id).role, 1)
+
+        client.post('/1/users/%d/delete' % user_id, data={'id': user_id})
+        self.assertEqual(load_user(user_id), None)
+
+    @db_context
+    def test_cached_copy_not_changed_by_requests(self):
+        from orvsd_central.util import load_user
+
+        user_id = self.add_user()
+        user = load_user(user_id)
+        user.role = -1
+        g.db_session.rollback()
+
+        self.assertEqual(load_user(user_id).role, 2)
+
+    @db_context
+    def test_disabled(self):
+        from orvsd_central.util import load_user
+
+        self.app.config['USER_CACHE_TIMEOUT'] = 0
+        user_id = self.add_user()
+
+        self.assertEqual(load_user(user_id).role, 2)
+        self.set_role(user_id, 3)
+        self.assertEqual(load_user(user_id).role, 3)
@@ -0,0 +1,134 @@
+"""
+Tests for the incremental course list update
+"""
+import os
+import shutil
+import tempfile
+import zipfile
+
+from flask import g
+
+from base import db_context, TestBase
+
+
+class CourseListTest(TestBase):
+
+    def setUp(self):
+        # INSTALL_COURSE_FILE_PATH must end with a /
+        self.base_path = tempfile.mkdtemp() + '/'
+        os.mkdir(os.path.join(self.base_path, 'flvs'))
+        super(CourseListTest, self).setUp()
+
+    def tearDown(self):
+        shutil.rmtree(self.base_path)
+
+    def write(self, path, data='backup'):
+        with open(os.path.join(self.base_path, path), 'w') as f:
+            f.write(data)
+
+    def write_backup(self, path, name):
+        manifest = (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<moodle_backup><information>'
+            '<name>%(name)s.mbz</name>'
+            '<moodle_release>2.7 (Build: 20140512)</moodle_release>'
+            '<original_course_id>42</original_course_id>'
+            '<original_course_fullname>%(name)s</original_course_fullname>'
+            '<original_course_shortname>%(name)s</original_course_shortname>'
+            '</information><details/></moodle_backup>'
+        ) % {'name': name}
+
+        with zipfile.ZipFile(os.path.join(self.base_path, path), 'w') as f:
+            f.writestr('moodle_backup.xml', manifest)
+
+    @db_context
+    def test_only_new_and_changed_files_are_read(self):
+        from orvsd_central.catalog import update_course_list
+        from orvsd_central.models import Course, CourseFile
+
+        course = Course(name='Algebra', source='flvs',
+                        filename='backup_algebra.mbz')
+        g.db_session.add(course)
+        g.db_session.commit()
+
+        self.write('flvs/backup_algebra.mbz')
+        self.write('flvs/not_a_zip.mbz')
+
+        counts = update_course_list(self.base_path)
+        self.assertEqual((counts['added'], counts['failed']), (2, 1))
+
+        entry = CourseFile.query.filter_by(
+            path='flvs/backup_algebra.mbz'
+        ).first()
+        self.assertEqual(entry.course_id, course.id)
+
+        # Nothing has changed, so nothing is read
+        counts = update_course_list(self.base_path)
+        self.assertEqual(
+            (counts['added'], counts['changed'], counts['failed']), (0, 0, 0)
+        )
+
+        os.remove(os.path.join(self.base_path, 'flvs/not_a_zip.mbz'))
+        self.write('flvs/backup_algebra.mbz', 'a longer backup')
+
+        counts = update_course_list(self.base_path)
+        self.assertEqual((counts['changed'], counts['removed']), (1, 1))
+        self.assertEqual(CourseFile.query.count(), 1)
+        # The changed file could not be read, it stays linked to its course
+        self.assertEqual(entry.course_id, course.id)
+
+    @db_context
+    def test_course_created_from_backup(self):
+        from orvsd_central.catalog import update_course_list
+        from orvsd_central.models import Course
+
+        self.write_backup('flvs/backup_geometry_v2_.mbz', 'Geometry')
+
+        counts = update_course_list(self.base_path)
+        self.assertEqual(counts['courses'], 1)
+
+        course = Course.query.first()
+        self.assertEqual(
+            (course.name, course.source, course.filename,
+             course.moodle_course_id, course.moodle_version),
+            ('Geometry', 'flvs', 'backup_geometry_v2_.mbz', 42,
+             '2.7 (Build: 20140512)')
+        )
+        # Nothing is extracted next to the backup or the working directory
+        self.assertFalse(os.path.exists('moodle_backup.xml'))
+        self.assertEqual(os.listdir(os.path.join(self.base_path, 'flvs')),
+                         ['backup_geometry_v2_.mbz'])
+
+    @db_context
+    def test_backups_read_in_processes(self):
+        from orvsd_central.catalog import update_course_list
+        from orvsd_central.models import Course, CourseFile
+
+        g.db_session.add(Course(name='Algebra', serial=1004))
+        g.db_session.commit()
+
+        for name in ['Biology', 'Chemistry', 'Physics']:
+            self.write_backup('flvs/backup_%s.mbz' % name.lower(), name)
+        # A second copy of a course in the same drop is not a new course
+        self.write_backup('flvs/backup_physics_2.mbz', 'Physics')
+        self.write('flvs/not_a_zip.mbz')
+
+        progress = []
+        counts = update_course_list(self.base_path, workers=2, batch_size=2,
+                                    progress=lambda *p: progress.append(p))
+
+        self.assertEqual((counts['added'], counts['failed'],
+                          counts['courses']), (5, 1, 3))
+        self.assertEqual(progress[-1], (5, 5))
+        self.assertEqual(
+            [(c.name, c.serial) for c in
+             Course.query.filter(Course.source == 'flvs').order_by(Course.id)],
+            [('Biology', 1005), ('Chemistry', 1006), ('Physics', 1007)]
+        )
+
+        physics = Course.query.filter_by(name='Physics').one()
+        self.assertEqual(
+            sorted(entry.path for entry in
+                   CourseFile.query.filter_by(course_id=physics.id)),
+            ['flvs/backup_physics.mbz', 'flvs/backup_physics_2.mbz']
+        )
@@ -0,0 +1,27 @@
+"""
+Tests for the shared engine and session in orvsd_central.database
+"""
+from flask import g
+
+from base import db_context, TestBase
+
+
+class SharedEngineTest(TestBase):
+
+    @db_context
+    def test_session_is_shared(self):
+        from orvsd_central.database import create_db_session, get_engine
+
+        db_session = create_db_session()
+
+        self.assertIs(db_session, g.db_session)
+        self.assertIs(db_session.get_bind(), get_engine())
+
+    @db_context
+    def test_sqlite_skips_queue_pool_options(self):
+        from orvsd_central.database import create_db_engine
+
+        # sqlite would raise a TypeError if QueuePool options were passed on
+        engine = create_db_engine('sqlite:///:memory:', {'pool_size': 5})
+
+        self.assertEqual(engine.execute("SELECT 1").scalar(), 1)
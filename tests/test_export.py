@@ -0,0 +1,70 @@
+"""
+Tests for streamed exports
+"""
+from datetime import datetime
+import json
+
+from flask import g
+
+from base import db_context, TestBase
+
+
+class ExportTest(TestBase):
+
+    def setUp(self):
+        super(ExportTest, self).setUp({'EXPORT_CHUNK_SIZE': 2})
+
+    def add_sites(self):
+        from orvsd_central.models import Site, SiteDetail
+
+        sites = [Site(name='Site %d' % i, baseurl='site%d.example.com' % i,
+                      moodle_tokens='{}') for i in range(5)]
+        g.db_session.add_all(sites)
+        g.db_session.commit()
+        for site in sites[:3]:
+            for day in [1, 2]:
+                details = SiteDetail(site_id=site.id, totalusers=day,
+                                     timemodified=datetime(2014, 12, day))
+                g.db_session.add(details)
+                site.latest_site_detail = details
+        g.db_session.commit()
+        return sites
+
+    @db_context
+    def test_sites_streamed_with_latest_details(self):
+        sites = self.add_sites()
+        client = self.app.test_client()
+
+        resp = client.get('/1/sites/export?format=ndjson&details=1'
+                          '&fields=name&detail_fields=totalusers,timemodified')
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        lines = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(lines[0], {
+            'id': sites[0].id,
+            'name': 'Site 0',
+            'latest_details': {'id': sites[0].latest_site_detail_id,
+                               'totalusers': 2,
+                               'timemodified': '2014-12-02T00:00:00'}
+        })
+        self.assertEqual(lines[4]['latest_details'], None)
+
+        resp = client.get('/1/sites/export')
+        self.assertEqual(resp.mimetype, 'application/json')
+        self.assertEqual(json.loads(resp.data),
+                         [site.serialize() for site in sites])
+
+        for url in ['/1/sites/export?format=xml',
+                    '/1/sites/export?fields=nope',
+                    '/1/sites/export?details=1&detail_fields=nope']:
+            self.assertEqual(client.get(url).status_code, 400)
+
+    @db_context
+    def test_passwords_stay_masked(self):
+        from orvsd_central.models import User
+
+        g.db_session.add(User('admin', 'admin@example.com', 'secret', 3))
+        g.db_session.commit()
+
+        resp = self.app.test_client().get('/1/users/export')
+        self.assertEqual(json.loads(resp.data)[0]['password'], '********')
@@ -0,0 +1,153 @@
+"""
+Tests for the concurrent siteinfo harvester
+"""
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import json
+import threading
+from urlparse import parse_qs
+
+from flask import g
+
+from base import db_context, TestBase
+
+
+class MoodleHandler(BaseHTTPRequestHandler):
+    """
+    Answers token requests with the service's name as the token and every
+    other request with the same siteinfo.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        data = parse_qs(
+            self.rfile.read(int(self.headers.getheader('content-length')))
+        )
+        if self.path.endswith('token.php'):
+            body = json.dumps({'token': data['service'][0]})
+        else:
+            body = json.dumps({'siterelease': '2.7', 'totalusers': 5,
+                               'adminusers': 1, 'teachers': 2,
+                               'activeusers': 3, 'totalcourses': 0,
+                               'courses': '[]', 'adminlist': []})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class HarvestTest(TestBase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), MoodleHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        super(HarvestTest, self).setUp()
+
+    def tearDown(self):
+        self.server.shutdown()
+
+    @db_context
+    def test_harvest_stores_details_and_groups_failures(self):
+        from orvsd_central.harvest import harvest_siteinfo
+        from orvsd_central.models import Site
+
+        tokens = json.dumps({'orvsd_siteinfo': 'token'})
+        up = Site(name='Up', moodle_tokens=tokens,
+                  baseurl='127.0.0.1:%d' % self.server.server_port)
+        # Nothing listens on port 1
+        down = Site(name='Down', baseurl='127.0.0.1:1', moodle_tokens=tokens)
+        untokened = Site(name='No token', baseurl='example.com')
+        g.db_session.add_all([up, down, untokened])
+        g.db_session.commit()
+
+        summary = harvest_siteinfo([up, down, untokened], workers=2,
+                                   timeout=(2, 2), deadline=10)
+
+        self.assertEqual(summary.succeeded, 1)
+        self.assertEqual(summary.skipped, 1)
+        self.assertEqual(dict(summary.failures),
+                         {'connection': ['127.0.0.1:1']})
+        self.assertEqual(up.latest_site_detail.totalusers, 5)
+        self.assertIsNone(down.latest_site_detail)
+
+    @db_context
+    def test_harvest_tokens_for_every_service(self):
+        from orvsd_central.harvest import harvest_tokens
+        from orvsd_central.models import Site
+
+        site = Site(name='Up',
+                    baseurl='127.0.0.1:%d' % self.server.server_port)
+        g.db_session.add(site)
+        g.db_session.commit()
+
+        summary = harvest_tokens([site], services=['one', 'two'], workers=2,
+                                 timeout=(2, 2), deadline=10)
+
+        self.assertEqual(summary.succeeded, 1)
+        self.assertEqual(site.get_moodle_tokens(), {'one': 'one',
+                                                    'two': 'two'})
+
+    @db_context
+    def test_new_sites_harvested_by_task(self):
+        from orvsd_central.harvest import harvest_new_sites
+        from orvsd_central.models import Site
+
+        site = Site(name='Up',
+                    baseurl='127.0.0.1:%d' % self.server.server_port)
+        g.db_session.add(site)
+        g.db_session.commit()
+        self.app.config['MOODLE_SERVICES'] = ['orvsd_siteinfo']
+
+        result = harvest_new_sites.apply(args=([site.id],))
+
+        self.assertEqual(result.result, 1)
+        site = Site.query.get(site.id)
+        self.assertEqual(site.get_token('orvsd_siteinfo'), 'orvsd_siteinfo')
+        self.assertEqual(site.latest_site_detail.totalusers, 5)
+
+    @db_context
+    def test_schedule_backs_off_unchanged_sites(self):
+        from orvsd_central.harvest import get_harvest_sites, harvest_siteinfo
+        from orvsd_central.models import SiteDetail, Site
+
+        site = Site(name='Up', moodle_tokens='{"orvsd_siteinfo": "token"}',
+                    baseurl='127.0.0.1:%d' % self.server.server_port)
+        g.db_session.add(site)
+        g.db_session.commit()
+
+        for _ in range(2):
+            harvest_siteinfo([site], timeout=(2, 2), deadline=10)
+
+        schedule = site.harvest_schedule
+        # The second harvest returned the same siteinfo as the first, it is
+        # still recorded with the time it was gathered
+        self.assertEqual(SiteDetail.query.count(), 2)
+        self.assertEqual((schedule.harvests, schedule.changes), (2, 1))
+        self.assertEqual(schedule.interval,
+                         2 * self.app.config.get('HARVEST_MIN_INTERVAL', 6))
+
+        self.assertEqual(get_harvest_sites(), [])
+        self.assertEqual(get_harvest_sites(full=True), [site])
+
+    @db_context
+    def test_harvested_site_deleted(self):
+        from orvsd_central.harvest import harvest_siteinfo
+        from orvsd_central.models import HarvestSchedule, Site
+
+        site = Site(name='Up', moodle_tokens='{"orvsd_siteinfo": "token"}',
+                    baseurl='127.0.0.1:%d' % self.server.server_port)
+        g.db_session.add(site)
+        g.db_session.commit()
+        harvest_siteinfo([site], timeout=(2, 2), deadline=10)
+        site_id = site.id
+
+        resp = self.app.test_client().post('/1/sites/%d/delete' % site_id,
+                                           data={'id': site_id})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(Site.query.get(site_id), None)
+        self.assertEqual(HarvestSchedule.query.count(), 0)
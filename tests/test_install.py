@@ -0,0 +1,151 @@
+"""
+Tests for batched course installs
+"""
+from flask import g
+
+from base import db_context, TestBase
+
+
+class InstallBatchTest(TestBase):
+
+    @db_context
+    def test_installs_queued_as_one_batch(self):
+        from orvsd_central.models import (Course, InstallDeadLetter,
+                                          InstallEvent, Site, SiteCourse)
+        from orvsd_central.util import celery, queue_course_installs
+
+        sites = []
+        for i in range(3):
+            # Nothing listens on the discard port, installs fail at once
+            site = Site(name='Site %d' % i, baseurl='127.0.0.1:9',
+                        moodle_tokens='{}')
+            if i:
+                site.add_token('orvsd_installcourse', 'token')
+            g.db_session.add(site)
+            sites.append(site)
+        courses = [Course(name='Algebra', source='flvs'),
+                   Course(name='Biology', source='flvs')]
+        g.db_session.add_all(courses)
+        g.db_session.commit()
+
+        expected = sorted((site.id, course.id) for site in sites[1:]
+                          for course in courses)
+
+        # Run the tasks in place of a worker
+        celery.conf.CELERY_ALWAYS_EAGER = True
+        # Eager tasks can not be retried, fail the installs at once
+        self.app.config['INSTALL_MAX_RETRIES'] = 0
+        try:
+            batch_id, skipped = queue_course_installs(sites, courses)
+        finally:
+            celery.conf.CELERY_ALWAYS_EAGER = False
+
+        self.assertTrue(batch_id)
+        self.assertEqual(skipped, [sites[0]])
+
+        installs = SiteCourse.query.all()
+        self.assertEqual(
+            sorted((install.site_id, install.course_id)
+                   for install in installs),
+            expected
+        )
+        self.assertEqual(
+            set(install.install_batch_id for install in installs),
+            set([batch_id])
+        )
+        self.assertEqual(len(set(install.celery_task_id
+                                 for install in installs)), 4)
+
+        # Every install failed to connect and was given up on
+        letters = InstallDeadLetter.query.all()
+        self.assertEqual(
+            sorted((letter.task_id, letter.attempts) for letter in letters),
+            sorted((install.celery_task_id, 1) for install in installs)
+        )
+        self.assertEqual(set(letter.host for letter in letters),
+                         set(['127.0.0.1']))
+
+        # Each install's progress was published
+        self.assertEqual(
+            sorted((event.task_id, event.status)
+                   for event in InstallEvent.query),
+            sorted((install.celery_task_id, status) for install in installs
+                   for status in ['STARTED', 'FAILURE'])
+        )
+
+    @db_context
+    def test_other_failures_dead_lettered(self):
+        from orvsd_central.models import Course, InstallDeadLetter
+        from orvsd_central.util import install_course_to_site
+
+        course = Course(name='Algebra', source='flvs')
+        g.db_session.add(course)
+        g.db_session.commit()
+
+        # Not a URL requests can post to, and a course deleted since
+        for course_id, url in [(course.id, 'nowhere'),
+                               (course.id + 1, 'http://127.0.0.1:9/')]:
+            result = install_course_to_site.apply(
+                args=(course_id, url), kwargs={'host': '127.0.0.1'}
+            )
+            self.assertTrue(result.successful())
+            self.assertIn('Failed', result.result)
+
+        self.assertEqual(
+            sorted((letter.course_id, letter.error.split(':')[0])
+                   for letter in InstallDeadLetter.query),
+            [(None, 'No course %d' % (course.id + 1)),
+             (course.id, 'Request failed')]
+        )
+
+    @db_context
+    def test_slot_released_when_publishing_fails(self):
+        from orvsd_central import util
+        from orvsd_central.models import Course, InstallHostSlot
+
+        course = Course(name='Algebra', source='flvs')
+        g.db_session.add(course)
+        g.db_session.commit()
+
+        publish_progress = util.publish_progress
+
+        def failing_publish(task_id, status, message=None):
+            if status == 'STARTED':
+                raise RuntimeError("No events table")
+            publish_progress(task_id, status, message)
+
+        util.publish_progress = failing_publish
+        try:
+            result = util.install_course_to_site.apply(
+                args=(course.id, 'http://127.0.0.1:9/'),
+                kwargs={'host': '127.0.0.1'}
+            )
+        finally:
+            util.publish_progress = publish_progress
+
+        self.assertTrue(result.failed())
+        self.assertEqual(InstallHostSlot.query.filter(
+            InstallHostSlot.task_id.isnot(None)
+        ).count(), 0)
+
+    @db_context
+    def test_batch_finishes_when_install_raises(self):
+        from orvsd_central.models import Course, InstallDeadLetter, Site
+        from orvsd_central.util import celery, queue_course_installs
+
+        site = Site(name='Site', baseurl='127.0.0.1:9', moodle_tokens='{}')
+        site.add_token('orvsd_installcourse', 'token')
+        # Without a source the backup's path can not be built
+        course = Course(name='Algebra')
+        g.db_session.add_all([site, course])
+        g.db_session.commit()
+
+        celery.conf.CELERY_ALWAYS_EAGER = True
+        try:
+            batch_id, skipped = queue_course_installs([site], [course])
+        finally:
+            celery.conf.CELERY_ALWAYS_EAGER = False
+
+        self.assertEqual(InstallDeadLetter.query.count(), 1)
+        resp = self.app.test_client().get('/1/installs/%s/stream' % batch_id)
+        self.assertIn('event: done', resp.data)
@@ -0,0 +1,98 @@
+"""
+Tests for the Site.latest_site_detail snapshot pointer
+"""
+from datetime import datetime, timedelta
+
+from flask import g
+
+from base import db_context, TestBase
+
+
+class LatestSiteDetailTest(TestBase):
+
+    def add_fixtures(self):
+        from orvsd_central.models import District, School, Site, SiteDetail
+
+        district = District(name='Test District', shortname='td')
+        g.db_session.add(district)
+        g.db_session.commit()
+
+        school = School(district_id=district.id, name='Test School')
+        g.db_session.add(school)
+        g.db_session.commit()
+
+        site = Site(school_id=school.id, name='Test Site', sitetype='moodle',
+                    baseurl='test.example.com')
+        g.db_session.add(site)
+        g.db_session.commit()
+
+        now = datetime.now()
+        for days_ago, users in [(2, 10), (1, 20)]:
+            details = SiteDetail(site_id=site.id, courses='[]', adminlist='[]',
+                                 totalusers=users, adminusers=1, teachers=2,
+                                 activeusers=users / 2,
+                                 timemodified=now - timedelta(days=days_ago))
+            g.db_session.add(details)
+            site.latest_site_detail = details
+            g.db_session.commit()
+
+        return district, school, site
+
+    @db_context
+    def test_pointer_follows_newest_details(self):
+        district, school, site = self.add_fixtures()
+
+        self.assertEqual(site.latest_site_detail.totalusers, 20)
+
+    @db_context
+    def test_get_schools_uses_latest_details(self):
+        from orvsd_central.util import get_schools
+
+        district, school, site = self.add_fixtures()
+        schools = get_schools(district.id, True)
+
+        self.assertEqual(schools.keys(), [str(site.id)])
+        self.assertEqual(schools[str(site.id)]['totalusers'], 20)
+
+    @db_context
+    def test_delete_moves_pointer_back(self):
+        from orvsd_central.models import Site
+
+        district, school, site = self.add_fixtures()
+        latest_id = site.latest_site_detail_id
+
+        resp = self.app.test_client().post(
+            '/1/sitedetails/%d/delete' % latest_id, data={'id': latest_id}
+        )
+        self.assertEqual(resp.status_code, 200)
+
+        g.db_session.expire_all()
+        site = Site.query.filter_by(id=site.id).first()
+        self.assertEqual(site.latest_site_detail.totalusers, 10)
+
+    @db_context
+    def test_active_counts_sum_latest_details(self):
+        from orvsd_central.util import get_active_counts
+
+        self.add_fixtures()
+        counts = get_active_counts()
+
+        self.assertEqual(counts, {'districts': 1, 'schools': 1, 'sites': 1,
+                                  'courses': 0, 'admins': 1, 'teachers': 2,
+                                  'totalusers': 20, 'activeusers': 10})
+
+    @db_context
+    def test_district_report_streams_each_district(self):
+        import json
+
+        district, school, site = self.add_fixtures()
+        client = self.app.test_client()
+
+        report = json.loads(client.get('/1/report/districts').data)
+        lines = client.get('/1/report/districts?stream=1').data.splitlines()
+
+        self.assertEqual(len(report['districts']), 1)
+        self.assertEqual([json.loads(line) for line in lines],
+                         report['districts'])
+        self.assertEqual(report['districts'][0]['sites'][str(site.id)]
+                         ['totalusers'], 20)
@@ -0,0 +1,63 @@
+"""
+Tests for fetching many objects and only some of their fields
+"""
+import json
+
+from flask import g
+
+from base import db_context, TestBase
+
+
+class MultiGetTest(TestBase):
+
+    @db_context
+    def test_sites_by_ids_and_fields(self):
+        from orvsd_central.models import Site
+
+        sites = [Site(name='Site %d' % i, baseurl='site%d.example.com' % i,
+                      moodle_tokens='{}') for i in range(4)]
+        g.db_session.add_all(sites)
+        g.db_session.commit()
+        client = self.app.test_client()
+
+        resp = json.loads(client.get(
+            '/1/sites?ids=%d,%d&ids=%d&fields=name,baseurl' %
+            (sites[2].id, sites[0].id, sites[3].id)
+        ).data)
+        self.assertEqual(resp['objects'], [
+            {'id': sites[i].id, 'name': 'Site %d' % i,
+             'baseurl': 'site%d.example.com' % i} for i in [0, 2, 3]
+        ])
+
+        # Without ?fields= objects are as serialize() has them
+        resp = json.loads(client.get('/1/sites?ids=%d' % sites[1].id).data)
+        self.assertEqual(resp['objects'], [sites[1].serialize()])
+
+        resp = json.loads(client.get(
+            '/1/sites/%d?fields=name' % sites[1].id
+        ).data)
+        self.assertEqual(resp, {'id': sites[1].id, 'name': 'Site 1'})
+
+        for url in ['/1/sites', '/1/sites?ids=x',
+                    '/1/sites?ids=1&fields=latest_site_detail_id',
+                    '/1/sites/1?fields=nope']:
+            self.assertEqual(client.get(url).status_code, 400)
+
+    @db_context
+    def test_passwords_stay_masked(self):
+        from orvsd_central.models import User
+
+        user = User('admin', 'admin@example.com', 'secret', 3)
+        g.db_session.add(user)
+        g.db_session.commit()
+        client = self.app.test_client()
+
+        resp = json.loads(client.get(
+            '/1/users?ids=%d&fields=name,password' % user.id
+        ).data)
+        self.assertEqual(resp['objects'], [{'id': user.id, 'name': 'admin',
+                                            'password': '********'}])
+
+        self.assertEqual(
+            client.get('/1/users/list?q=x&field=password').status_code, 400
+        )
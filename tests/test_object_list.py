@@ -0,0 +1,106 @@
+"""
+Tests for the paged object listing behind the update pages
+"""
+from datetime import datetime, timedelta
+import json
+
+from flask import g
+
+from base import db_context, TestBase
+
+
+class ObjectListTest(TestBase):
+
+    def get_all(self, url):
+        """
+        Follows 'next' through every page, returning the pages' objects.
+        """
+        client = self.app.test_client()
+        pages = []
+        after = None
+        while True:
+            page_url = url + ('&after=%s' % after if after else '')
+            resp = json.loads(client.get(page_url).data)
+            pages.append(resp['objects'])
+            after = resp['next']
+            if after is None:
+                return pages
+
+    @db_context
+    def test_pages_sorted_and_searched(self):
+        from orvsd_central.models import District
+
+        for i, name in enumerate(['Bend', 'Astoria', 'Coos Bay', 'Burns',
+                                  'Albany', 'Bandon', None]):
+            g.db_session.add(District(name=name, shortname='d%d' % i,
+                                      state_id=i % 3))
+        g.db_session.commit()
+
+        pages = self.get_all('/1/districts/list?limit=2')
+        self.assertEqual([len(page) for page in pages], [2, 2, 2, 1])
+        self.assertEqual(
+            [obj['name'] for page in pages for obj in page],
+            [None, 'Albany', 'Astoria', 'Bandon', 'Bend', 'Burns',
+             'Coos Bay']
+        )
+        self.assertEqual(sorted(pages[0][1].keys()), ['id', 'name'])
+
+        # Paging on from a NULL
+        pages = self.get_all('/1/districts/list?limit=1&order=desc')
+        self.assertEqual(
+            [obj['name'] for page in pages for obj in page],
+            ['Coos Bay', 'Burns', 'Bend', 'Bandon', 'Astoria', 'Albany', None]
+        )
+        pages = self.get_all('/1/districts/list?limit=1')
+        self.assertEqual(pages[1][0]['name'], 'Albany')
+
+        # Ties in the sort column are broken by id
+        pages = self.get_all(
+            '/1/districts/list?limit=2&sort=state_id&order=desc'
+        )
+        self.assertEqual(
+            [(obj['state_id'], obj['name']) for page in pages
+             for obj in page],
+            [(2, 'Bandon'), (2, 'Coos Bay'), (1, 'Albany'), (1, 'Astoria'),
+             (0, None), (0, 'Burns'), (0, 'Bend')]
+        )
+
+        pages = self.get_all('/1/districts/list?limit=1&q=b')
+        self.assertEqual([obj['name'] for page in pages for obj in page],
+                         ['Albany', 'Bandon', 'Bend', 'Burns', 'Coos Bay'])
+
+        pages = self.get_all('/1/districts/list?q=2&field=state_id')
+        self.assertEqual([obj['name'] for obj in pages[0]],
+                         ['Bandon', 'Coos Bay'])
+
+        client = self.app.test_client()
+        self.assertEqual(
+            client.get('/1/districts/list?sort=nope').status_code, 400
+        )
+        self.assertEqual(
+            client.get('/1/districts/list?q=x&field=state_id').status_code,
+            400
+        )
+
+    @db_context
+    def test_site_details_paged_by_time(self):
+        from orvsd_central.models import SiteDetail
+
+        now = datetime(2014, 12, 17, 12)
+        for hours in range(5):
+            g.db_session.add(SiteDetail(
+                site_id=1, adminlist='admin' * 1000,
+                timemodified=now - timedelta(hours=hours)
+            ))
+        g.db_session.commit()
+
+        pages = self.get_all(
+            '/1/sitedetails/list?limit=2&sort=timemodified&order=desc'
+        )
+        self.assertEqual(
+            [obj['timemodified'] for page in pages for obj in page],
+            [(now - timedelta(hours=hours)).isoformat()
+             for hours in range(5)]
+        )
+        # Only the listed columns are read
+        self.assertFalse('adminlist' in pages[0][0])
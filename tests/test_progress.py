@@ -0,0 +1,133 @@
+"""
+Tests for following the progress of install batches
+"""
+import json
+
+from flask import g
+
+from base import db_context, TestBase
+
+
+class ProgressTest(TestBase):
+
+    def setUp(self):
+        super(ProgressTest, self).setUp({'INSTALL_EVENTS_POLL': 0.01,
+                                         'INSTALL_STREAM_TIMEOUT': 0.05})
+
+    def add_batch(self):
+        from orvsd_central.models import SiteCourse
+        from orvsd_central.progress import publish_progress
+
+        for i in range(2):
+            g.db_session.add(SiteCourse(site_id=1, course_id=i,
+                                        celery_task_id='task%d' % i,
+                                        install_batch_id='batch'))
+        g.db_session.add(SiteCourse(site_id=1, course_id=3,
+                                    celery_task_id='other',
+                                    install_batch_id='other'))
+        g.db_session.commit()
+
+        publish_progress('task0', 'STARTED')
+        publish_progress('other', 'STARTED')
+        publish_progress('task1', 'STARTED')
+        publish_progress('task0', 'SUCCESS')
+
+    @db_context
+    def test_long_poll(self):
+        from orvsd_central.progress import publish_progress
+
+        self.add_batch()
+        client = self.app.test_client()
+
+        resp = json.loads(client.get('/1/installs/batch/events').data)
+        self.assertEqual(
+            [(event['task_id'], event['status']) for event in resp['events']],
+            [('task0', 'STARTED'), ('task1', 'STARTED'),
+             ('task0', 'SUCCESS')]
+        )
+        self.assertFalse(resp['done'])
+
+        # Nothing new, the wait runs out
+        after = resp['next']
+        resp = json.loads(client.get(
+            '/1/installs/batch/events?after=%d&wait=0' % after
+        ).data)
+        self.assertEqual((resp['events'], resp['next']), ([], after))
+
+        publish_progress('task1', 'FAILURE', 'HTTP 404')
+        resp = json.loads(client.get(
+            '/1/installs/batch/events?after=%d' % after
+        ).data)
+        self.assertEqual([event['message'] for event in resp['events']],
+                         ['HTTP 404'])
+        self.assertTrue(resp['done'])
+
+    @db_context
+    def test_stream(self):
+        from orvsd_central.progress import publish_progress
+
+        self.add_batch()
+        client = self.app.test_client()
+
+        # Ends at INSTALL_STREAM_TIMEOUT, the batch is unfinished
+        resp = client.get('/1/installs/batch/stream')
+        self.assertEqual(resp.mimetype, 'text/event-stream')
+        self.assertEqual(resp.data.count('event: progress'), 3)
+        self.assertFalse('event: done' in resp.data)
+
+        publish_progress('task1', 'SUCCESS')
+        last_id = resp.data.split('id: ')[-1].split('\n')[0]
+        resp = client.get('/1/installs/batch/stream',
+                          headers={'Last-Event-ID': last_id})
+        self.assertEqual(resp.data.count('event: progress'), 1)
+        self.assertTrue('"status": "SUCCESS"' in resp.data)
+        self.assertTrue(resp.data.endswith('event: done\ndata: {}\n\n'))
+
+    @db_context
+    def test_events_committed_late_are_sent(self):
+        from orvsd_central.models import InstallEvent, SiteCourse
+        from orvsd_central.progress import follow_batch, publish_progress
+
+        self.add_batch()
+        g.db_session.add(SiteCourse(site_id=1, course_id=2,
+                                    celery_task_id='task2',
+                                    install_batch_id='batch'))
+        g.db_session.commit()
+        publish_progress('task2', 'STARTED')
+
+        batch = follow_batch('batch', 0, 10)
+        events, after, done = next(batch)
+        self.assertEqual(len(events), 4)
+
+        g.db_session.add(InstallEvent(id=after + 10, task_id='task2',
+                                      status='RETRY'))
+        g.db_session.commit()
+        events, after, done = next(batch)
+        self.assertEqual([event.status for event in events], ['RETRY'])
+
+        # Its id was handed out before the RETRY's
+        g.db_session.add(InstallEvent(id=after - 1, task_id='task1',
+                                      status='FAILURE'))
+        g.db_session.commit()
+        events, resume_after, done = next(batch)
+        self.assertEqual([(event.task_id, event.status) for event in events],
+                         [('task1', 'FAILURE')])
+        self.assertEqual(resume_after, after)
+        self.assertFalse(done)
+
+        events, after, done = next(batch)
+        self.assertEqual(events, [])
+
+    @db_context
+    def test_published_apart_from_the_session(self):
+        from orvsd_central.models import InstallEvent, SiteCourse
+        from orvsd_central.progress import publish_progress
+
+        g.db_session.add(SiteCourse(site_id=1, course_id=1,
+                                    celery_task_id='task0',
+                                    install_batch_id='batch'))
+        publish_progress('task0', 'STARTED')
+        g.db_session.rollback()
+
+        self.assertEqual(SiteCourse.query.count(), 0)
+        self.assertEqual(InstallEvent.query.count(), 1)
@@ -0,0 +1,128 @@
+"""
+Query plan regression tests
+
+Runs EXPLAIN QUERY PLAN on the hot lookups against SQLite and fails when one
+of them scans a whole table, which is what happens when the index it relies
+on goes missing.
+"""
+import re
+
+from flask import g
+from sqlalchemy import and_
+
+from base import db_context, TestBase
+
+# "SCAN sites", or "SCAN TABLE sites" on older SQLite, optionally through an
+# index when every row is still visited
+FULL_SCAN = re.compile(r'^SCAN (TABLE )?\w+( AS \w+)?( USING .*INDEX.*)?$')
+
+
+class QueryPlanTest(TestBase):
+
+    def query_plan(self, query):
+        """
+        Returns the detail lines of SQLite's plan for a Query.
+        """
+        compiled = query.with_labels().statement.compile(
+            dialect=g.db_session.bind.dialect
+        )
+        params = [compiled.params[name] for name in compiled.positiontup]
+
+        cursor = g.db_session.connection().connection.cursor()
+        cursor.execute("EXPLAIN QUERY PLAN " + unicode(compiled), params)
+        return [row[-1] for row in cursor.fetchall()]
+
+    def assertNoFullScan(self, query):
+        plan = self.query_plan(query)
+        scans = [line for line in plan if FULL_SCAN.match(line)]
+        self.assertFalse(scans, "Full table scan in:\n%s" % '\n'.join(plan))
+
+    @db_context
+    def test_site_details_by_site(self):
+        from orvsd_central.models import SiteDetail
+
+        # util.refresh_latest_site_detail and retention
+        self.assertNoFullScan(g.db_session.query(SiteDetail.id).filter(
+            SiteDetail.site_id == 1
+        ).order_by(SiteDetail.timemodified.desc()))
+
+    @db_context
+    def test_site_by_baseurl(self):
+        from orvsd_central.models import Site, SiteDetail
+
+        # api.get_site_by_url
+        self.assertNoFullScan(g.db_session.query(Site, SiteDetail).outerjoin(
+            Site.latest_site_detail
+        ).filter(Site.baseurl == 'test.example.com'))
+
+    @db_context
+    def test_sites_of_school(self):
+        from orvsd_central.models import Site, SiteDetail
+
+        # category.view_schools
+        self.assertNoFullScan(g.db_session.query(Site, SiteDetail).outerjoin(
+            Site.latest_site_detail
+        ).filter(and_(
+            Site.school_id == 1,
+            Site.sitetype.in_(['moodle', 'drupal'])
+        )))
+
+    @db_context
+    def test_sites_by_type(self):
+        from orvsd_central.models import Site, SiteDetail
+
+        # category.install_course
+        self.assertNoFullScan(g.db_session.query(Site).join(
+            Site.latest_site_detail
+        ).filter(and_(
+            Site.sitetype == 'moodle',
+            SiteDetail.siterelease.like('2%')
+        )))
+
+    @db_context
+    def test_schools_of_district(self):
+        from orvsd_central.models import School
+
+        # category.migrate
+        self.assertNoFullScan(School.query.filter_by(district_id=1))
+
+    @db_context
+    def test_report_sites_of_district(self):
+        from orvsd_central.util import get_report_sites
+
+        self.assertNoFullScan(get_report_sites(1))
+
+    @db_context
+    def test_courses_by_source_and_file(self):
+        from orvsd_central.models import Course
+
+        # api.get_course_list
+        self.assertNoFullScan(Course.query.filter(Course.source == 'flvs'))
+        # catalog.get_courses_by_file
+        self.assertNoFullScan(Course.query.filter(
+            Course.filename.in_(['backup_algebra.mbz', 'backup_biology.mbz'])
+        ))
+        # catalog.get_courses_by_name
+        self.assertNoFullScan(Course.query.filter(
+            Course.name.in_(['Algebra', 'Biology'])
+        ))
+
+    @db_context
+    def test_site_courses(self):
+        from orvsd_central.models import SiteCourse, SiteDetailCourse
+
+        self.assertNoFullScan(SiteCourse.query.filter_by(site_id=1,
+                                                         course_id=1))
+        # util.get_site_courses
+        self.assertNoFullScan(SiteDetailCourse.query.filter(
+            SiteDetailCourse.site_detail_id == 1,
+            SiteDetailCourse.enrolled > 1
+        ))
+
+    @db_context
+    def test_course_file_by_path(self):
+        from orvsd_central.models import CourseFile
+
+        self.assertNoFullScan(CourseFile.query.filter(
+            CourseFile.path == 'flvs/algebra.mbz'
+        ))
@@ -0,0 +1,129 @@
+"""
+Tests for the usage report exports
+"""
+from datetime import datetime
+import json
+
+from flask import g
+
+from base import db_context, TestBase
+
+
+class ReportExportTest(TestBase):
+
+    def setUp(self):
+        super(ReportExportTest, self).setUp({'EXPORT_CHUNK_SIZE': 2})
+
+    def add_site(self, district, name, county, days=()):
+        from orvsd_central.models import School, Site, SiteDetail
+
+        school = School(district_id=district.id, name=name + ' School',
+                        county=county)
+        g.db_session.add(school)
+        g.db_session.commit()
+
+        site = Site(school_id=school.id, name=name, sitetype='moodle',
+                    baseurl=name.lower() + '.example.com')
+        g.db_session.add(site)
+        g.db_session.commit()
+
+        for day in days:
+            details = SiteDetail(site_id=site.id, courses='[]',
+                                 adminlist='[]', totalusers=day * 10,
+                                 adminusers=1, teachers=2, activeusers=day,
+                                 timemodified=datetime(2014, 12, day))
+            g.db_session.add(details)
+            site.latest_site_detail = details
+            g.db_session.commit()
+        return site
+
+    def add_fixtures(self):
+        from orvsd_central.models import District, Site, SiteDetailCourse
+
+        lane = District(name='Lane', shortname='lane')
+        benton = District(name='Benton', shortname='benton')
+        g.db_session.add_all([lane, benton])
+        g.db_session.commit()
+
+        eugene = self.add_site(lane, 'Eugene', 'Lane', [1, 5])
+        self.add_site(lane, 'Eugene Dev', 'Lane')
+        # Same school as Eugene, no details of its own
+        g.db_session.add(Site(school_id=eugene.school_id, name='Eugene Old',
+                              baseurl='old.example.com'))
+        self.add_site(benton, 'Corvallis', 'Benton', [3])
+        g.db_session.add(SiteDetailCourse(
+            site_detail_id=eugene.latest_site_detail_id,
+            shortname='Math', enrolled=5
+        ))
+        g.db_session.commit()
+        return lane, benton
+
+    @db_context
+    def test_report_rows(self):
+        from orvsd_central.export import iter_usage_report
+
+        lane, benton = self.add_fixtures()
+
+        rows = list(iter_usage_report())
+        self.assertEqual([row['site'] for row in rows],
+                         ['Corvallis', 'Eugene', 'Eugene Old'])
+        self.assertEqual(rows[1], {
+            'district': 'Lane', 'school': 'Eugene School', 'site': 'Eugene',
+            'baseurl': 'eugene.example.com', 'totalusers': 50,
+            'activeusers': 5, 'teachers': 2, 'courses': 1, 'admins': 1
+        })
+        self.assertEqual(rows[2]['courses'], None)
+        self.assertEqual(rows[2]['totalusers'], None)
+
+        self.assertEqual([row['site'] for row in
+                          iter_usage_report(dist_id=benton.id)],
+                         ['Corvallis'])
+        self.assertEqual([row['site'] for row in
+                          iter_usage_report(county='Lane')],
+                         ['Eugene', 'Eugene Old'])
+
+        # The newest details in the range, only sites that have some
+        rows = list(iter_usage_report(since=datetime(2014, 12, 1),
+                                      until=datetime(2014, 12, 4)))
+        self.assertEqual([(row['site'], row['totalusers'], row['courses'])
+                          for row in rows],
+                         [('Corvallis', 30, 0), ('Eugene', 10, 0)])
+
+    @db_context
+    def test_export_endpoint(self):
+        lane, benton = self.add_fixtures()
+        client = self.app.test_client()
+
+        resp = client.get('/1/report/export?county=Lane')
+        self.assertEqual(resp.mimetype, 'text/csv')
+        self.assertEqual(resp.data.splitlines(), [
+            'district,school,site,baseurl,totalusers,activeusers,teachers,'
+            'courses,admins',
+            'Lane,Eugene School,Eugene,eugene.example.com,50,5,2,1,1',
+            'Lane,Eugene School,Eugene Old,old.example.com,,,,,'
+        ])
+
+        resp = client.get('/1/report/export?format=ndjson&since=2014-12-04'
+                          '&district=%d' % lane.id)
+        self.assertEqual([json.loads(line)['site'] for line in
+                          resp.data.splitlines()], ['Eugene'])
+
+        for url in ['/1/report/export?format=xml',
+                    '/1/report/export?district=lane',
+                    '/1/report/export?since=yesterday']:
+            self.assertEqual(client.get(url).status_code, 400)
+
+    @db_context
+    def test_chunks_keyed_past_ties_and_nulls(self):
+        from orvsd_central.export import iter_usage_report
+        from orvsd_central.models import Site
+
+        lane, benton = self.add_fixtures()
+        eugene = Site.query.filter_by(name='Eugene').one()
+        for name in [None, 'Eugene', 'Eugene', None]:
+            g.db_session.add(Site(school_id=eugene.school_id, name=name))
+        g.db_session.commit()
+
+        self.assertEqual([row['site'] for row in iter_usage_report(lane.id)],
+                         [None, None, 'Eugene', 'Eugene', 'Eugene',
+                          'Eugene Old'])
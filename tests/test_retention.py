@@ -0,0 +1,48 @@
+"""
+Tests for the site_details retention policy
+"""
+from datetime import datetime, timedelta
+
+from flask import g
+
+from base import db_context, TestBase
+
+
+class RetentionTest(TestBase):
+
+    @db_context
+    def test_history_thinned_to_days_then_weeks(self):
+        from orvsd_central.models import Site, SiteDetail
+        from orvsd_central.retention import prune_site_details
+
+        site = Site(name='Test Site', baseurl='test.example.com')
+        g.db_session.add(site)
+        g.db_session.commit()
+
+        # Wednesday noon, so no day's harvests straddle a week boundary
+        now = datetime(2014, 12, 17, 12)
+        hours_ago = [1, 2, 30, 49, 50, 51, 100 * 24, 100 * 24 + 1,
+                     200 * 24, 200 * 24 + 2, 203 * 24]
+        for hours in hours_ago:
+            details = SiteDetail(site_id=site.id, totalusers=hours,
+                                 timemodified=now - timedelta(hours=hours))
+            g.db_session.add(details)
+        g.db_session.commit()
+
+        # The latest pointer is kept even when the policy would drop it
+        site.latest_site_detail = SiteDetail.query.filter_by(
+            totalusers=203 * 24
+        ).one()
+        g.db_session.commit()
+
+        counts = prune_site_details(full_days=2, daily_days=150,
+                                    chunk_size=2, dry_run=True, now=now)
+        self.assertEqual(counts['deleted'], 4)
+        self.assertEqual(SiteDetail.query.count(), len(hours_ago))
+
+        prune_site_details(full_days=2, daily_days=150, chunk_size=2,
+                           now=now)
+        self.assertEqual(
+            sorted(detail.totalusers for detail in SiteDetail.query),
+            [1, 2, 30, 49, 100 * 24, 200 * 24, 203 * 24]
+        )
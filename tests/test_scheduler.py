@@ -0,0 +1,95 @@
+"""
+Tests for the per-host install limits
+"""
+from datetime import datetime, timedelta
+
+from flask import g
+
+from base import db_context, TestBase
+
+
+class SchedulerTest(TestBase):
+
+    def setUp(self):
+        super(SchedulerTest, self).setUp({'INSTALL_HOST_CONCURRENCY': 2})
+
+    @db_context
+    def test_slots_limit_installs_per_host(self):
+        from orvsd_central.models import InstallHostSlot
+        from orvsd_central.scheduler import acquire_slot, release_slot
+
+        self.assertEqual(acquire_slot('a.example.com', 'task1'), 0)
+        self.assertEqual(acquire_slot('a.example.com', 'task2'), 1)
+        self.assertEqual(acquire_slot('a.example.com', 'task3'), None)
+
+        # Other hosts are not held up
+        self.assertEqual(acquire_slot('b.example.com', 'task4'), 0)
+
+        release_slot('a.example.com', 0, 'task1')
+        self.assertEqual(acquire_slot('a.example.com', 'task3'), 0)
+
+        # A slot whose holder died is free once it expires
+        g.db_session.query(InstallHostSlot).filter_by(
+            host='a.example.com', slot=1
+        ).update({'expires': datetime.now() - timedelta(seconds=1)})
+        g.db_session.commit()
+        self.assertEqual(acquire_slot('a.example.com', 'task5'), 1)
+
+        # The dead task releasing late does not free the new holder's slot
+        release_slot('a.example.com', 1, 'task2')
+        self.assertEqual(acquire_slot('a.example.com', 'task6'), None)
+
+    @db_context
+    def test_install_host(self):
+        from orvsd_central.models import Site
+        from orvsd_central.scheduler import get_install_host
+
+        site = Site(baseurl='moodle.example.com/site1', location='web3')
+        self.assertEqual(get_install_host(site), 'moodle.example.com')
+
+        site.baseurl = 'https://moodle.example.com:8443/site1'
+        self.assertEqual(get_install_host(site), 'moodle.example.com')
+
+        self.app.config['INSTALL_HOST_KEY'] = 'location'
+        self.assertEqual(get_install_host(site), 'web3')
+
+    @db_context
+    def test_retries_back_off(self):
+        from orvsd_central.scheduler import retry_countdown
+
+        self.app.config['INSTALL_RETRY_BACKOFF'] = 10
+        for attempt in range(5):
+            countdown = retry_countdown(attempt)
+            self.assertTrue(5 * 2 ** attempt <= countdown <= 10 * 2 ** attempt)
+
+    @db_context
+    def test_dead_installs_requeued(self):
+        from orvsd_central.models import (Course, InstallDeadLetter, Site,
+                                          SiteCourse)
+        from orvsd_central.util import celery, requeue_dead_installs
+
+        site = Site(name='Site', baseurl='127.0.0.1:9', moodle_tokens='{}')
+        site.add_token('orvsd_installcourse', 'token')
+        course = Course(name='Algebra', source='flvs')
+        g.db_session.add_all([site, course])
+        g.db_session.commit()
+        g.db_session.add(InstallDeadLetter(task_id='task1', site_id=site.id,
+                                           course_id=course.id,
+                                           host='127.0.0.1', attempts=6))
+        g.db_session.commit()
+
+        self.assertEqual(requeue_dead_installs('other.example.com'), (None, 0))
+
+        celery.conf.CELERY_ALWAYS_EAGER = True
+        self.app.config['INSTALL_MAX_RETRIES'] = 0
+        try:
+            batch_id, count = requeue_dead_installs('127.0.0.1')
+        finally:
+            celery.conf.CELERY_ALWAYS_EAGER = False
+
+        self.assertTrue(batch_id)
+        self.assertEqual(count, 1)
+        install = SiteCourse.query.one()
+        # The old letter is gone, the requeued install failed again
+        letter = InstallDeadLetter.query.one()
+        self.assertEqual(letter.task_id, install.celery_task_id)
@@ -0,0 +1,62 @@
+"""
+Tests for the per-site course enrolments
+"""
+import json
+
+from flask import g
+
+from base import db_context, TestBase
+
+
+class SiteCoursesTest(TestBase):
+
+    def add_site(self, courses):
+        from orvsd_central.models import Site
+        from orvsd_central.util import store_siteinfo
+
+        site = Site(name='Test Site', baseurl='test.example.com')
+        g.db_session.add(site)
+        g.db_session.commit()
+
+        store_siteinfo(site, {'courses': json.dumps(courses),
+                              'adminlist': []})
+        g.db_session.commit()
+        return site
+
+    @db_context
+    def test_courses_stored_as_rows(self):
+        from orvsd_central.models import SiteDetailCourse
+
+        site = self.add_site([{'serial': '1001', 'shortname': 'Algebra',
+                               'enrolled': 12},
+                              {'serial': '1002', 'shortname': 'Biology',
+                               'enrolled': 0}])
+
+        self.assertEqual(
+            [(course.shortname, course.enrolled) for course in
+             SiteDetailCourse.query.filter_by(
+                 site_detail_id=site.latest_site_detail_id
+             ).order_by(SiteDetailCourse.shortname)],
+            [('Algebra', 12), ('Biology', 0)]
+        )
+
+    @db_context
+    def test_courses_filtered_and_paged(self):
+        site = self.add_site([{'serial': str(1000 + i),
+                               'shortname': 'Course %02d' % i,
+                               'enrolled': i}
+                              for i in range(10)])
+        client = self.app.test_client()
+
+        everything = json.loads(
+            client.get('/1/site/%d/courses' % site.id).data
+        )
+        self.assertEqual((len(everything['content']), everything['total']),
+                         (10, 10))
+
+        page = json.loads(client.get(
+            '/1/site/%d/courses?min_enrolled=3&page=2&per_page=4' % site.id
+        ).data)
+        self.assertEqual(page['total'], 6)
+        self.assertEqual([course['shortname'] for course in page['content']],
+                         ['Course 08', 'Course 09'])
@@ -0,0 +1,117 @@
+"""
+Tests for the precomputed report snapshots
+"""
+from datetime import datetime
+
+from flask import g
+
+from base import db_context, TestBase
+
+
+class ReportSnapshotTest(TestBase):
+
+    def add_site(self, district, name, users):
+        from orvsd_central.models import School, Site, SiteDetail
+
+        school = School(district_id=district.id, name=name + ' School')
+        g.db_session.add(school)
+        g.db_session.commit()
+
+        site = Site(school_id=school.id, name=name, sitetype='moodle',
+                    baseurl=name.lower() + '.example.com')
+        g.db_session.add(site)
+        g.db_session.commit()
+
+        self.add_details(site, users)
+        return site
+
+    def add_details(self, site, users):
+        from orvsd_central.models import SiteDetail
+
+        details = SiteDetail(site_id=site.id, courses='[{}, {}]',
+                             adminlist='[]', totalusers=users, adminusers=1,
+                             teachers=2, activeusers=users / 2,
+                             timemodified=datetime.now())
+        g.db_session.add(details)
+        site.latest_site_detail = details
+        g.db_session.commit()
+
+    def add_fixtures(self):
+        from orvsd_central.models import District
+
+        sites = []
+        for name in ['Lane', 'Benton']:
+            district = District(name=name, shortname=name.lower())
+            g.db_session.add(district)
+            g.db_session.commit()
+            sites.append(self.add_site(district, name + ' High', 10))
+        return sites
+
+    @db_context
+    def test_snapshot_matches_live_report(self):
+        from orvsd_central.models import School
+        from orvsd_central.snapshot import (build_report_snapshot,
+                                            report_counts, report_districts,
+                                            report_schools)
+        from orvsd_central.util import (get_active_counts,
+                                        get_district_report, get_schools)
+
+        lane, benton = self.add_fixtures()
+        build_report_snapshot()
+
+        self.assertEqual(report_counts(), get_active_counts())
+        self.assertEqual(list(report_districts()),
+                         list(get_district_report()))
+        dist_id = School.query.get(lane.school_id).district_id
+        self.assertEqual(report_schools(dist_id), get_schools(dist_id, True))
+
+    @db_context
+    def test_report_reads_current_snapshot(self):
+        from orvsd_central.models import (ReportSnapshot,
+                                          ReportSnapshotDistrict,
+                                          ReportSnapshotSite)
+        from orvsd_central.snapshot import build_report_snapshot
+
+        lane, benton = self.add_fixtures()
+        build_report_snapshot(keep=2)
+        client = self.app.test_client()
+
+        self.add_details(lane, 30)
+        # Not in the report until the next snapshot
+        self.assertIn('"totalusers": 20',
+                      client.get('/1/report/stats').data)
+
+        build_report_snapshot(keep=2)
+        build_report_snapshot(keep=2)
+        self.assertIn('"totalusers": 40',
+                      client.get('/1/report/stats').data)
+
+        snapshot_ids = [snapshot.id for snapshot in ReportSnapshot.query]
+        self.assertEqual(len(snapshot_ids), 2)
+        for table in [ReportSnapshotSite, ReportSnapshotDistrict]:
+            self.assertEqual(
+                set(row.snapshot_id for row in table.query),
+                set(snapshot_ids)
+            )
+
+    @db_context
+    def test_edit_makes_snapshot_stale(self):
+        from orvsd_central.models import Site
+        from orvsd_central.snapshot import (build_report_snapshot,
+                                            get_report_snapshot)
+
+        lane, benton = self.add_fixtures()
+        build_report_snapshot()
+        client = self.app.test_client()
+        self.assertIn('"sites": 2', client.get('/1/report/stats').data)
+
+        response = client.post('/1/sites/%d/delete' % benton.id,
+                               data={'id': benton.id})
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(get_report_snapshot())
+        # Read live until the next snapshot
+        self.assertIn('"sites": 1', client.get('/1/report/stats').data)
+
+        build_report_snapshot()
+        self.assertIsNotNone(get_report_snapshot())
+        self.assertIn('"sites": 1', client.get('/1/report/stats').data)
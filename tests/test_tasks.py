@@ -0,0 +1,107 @@
+"""
+Tests for the install task listing and status endpoints
+"""
+from datetime import datetime
+import json
+
+from flask import g
+
+from base import db_context, TestBase
+
+
+class TaskStatusTest(TestBase):
+
+    def add_installs(self):
+        from orvsd_central.models import (Course, InstallDeadLetter, Site,
+                                          SiteCourse)
+        from orvsd_central.util import TaskMeta
+
+        TaskMeta.__table__.create(bind=g.db_session.get_bind(),
+                                  checkfirst=True)
+
+        sites = [Site(name='Site %d' % i, baseurl='site%d.example.com' % i)
+                 for i in range(2)]
+        course = Course(name='Algebra', source='flvs')
+        g.db_session.add_all(sites + [course])
+        g.db_session.commit()
+
+        for i in range(6):
+            g.db_session.add(SiteCourse(site_id=sites[i % 2].id,
+                                        course_id=course.id,
+                                        celery_task_id='task%d' % i,
+                                        install_batch_id='batch'))
+        # task5 has not run yet
+        g.db_session.execute(TaskMeta.__table__.insert(), [
+            {'task_id': 'task%d' % i,
+             'status': status,
+             'date_done': datetime(2014, 12, 1 + i)}
+            for i, status in enumerate(['SUCCESS', 'SUCCESS', 'RETRY',
+                                        'SUCCESS', 'FAILURE'])
+        ])
+        # task1 was given up on
+        g.db_session.add(InstallDeadLetter(task_id='task1', error='HTTP 404'))
+        g.db_session.commit()
+
+        return sites
+
+    @db_context
+    def test_tasks_paged_and_filtered(self):
+        sites = self.add_installs()
+        client = self.app.test_client()
+
+        resp = json.loads(client.get('/1/celery/tasks?limit=4').data)
+        self.assertEqual([task['task_id'] for task in resp['tasks']],
+                         ['task5', 'task4', 'task3', 'task2'])
+        self.assertEqual(resp['tasks'][0]['status'], 'PENDING')
+
+        resp = json.loads(client.get(
+            '/1/celery/tasks?limit=4&after=%d' % resp['next']
+        ).data)
+        self.assertEqual([task['task_id'] for task in resp['tasks']],
+                         ['task1', 'task0'])
+        self.assertEqual(resp['tasks'][0]['status'], 'FAILURE')
+        self.assertEqual(resp['tasks'][0]['error'], 'HTTP 404')
+        self.assertEqual(resp['next'], None)
+
+        resp = json.loads(client.get(
+            '/1/celery/tasks?status=success,pending'
+        ).data)
+        self.assertEqual([task['task_id'] for task in resp['tasks']],
+                         ['task5', 'task3', 'task0'])
+
+        # Including the install given up on, its task succeeded
+        resp = json.loads(client.get('/1/celery/tasks?status=FAILURE').data)
+        self.assertEqual([(task['task_id'], task['status'])
+                          for task in resp['tasks']],
+                         [('task4', 'FAILURE'), ('task1', 'FAILURE')])
+
+        resp = json.loads(client.get(
+            '/1/celery/tasks?site_id=%d&since=2014-12-02&until=2014-12-06'
+            % sites[0].id
+        ).data)
+        self.assertEqual([task['task_id'] for task in resp['tasks']],
+                         ['task4', 'task2'])
+
+        self.assertEqual(
+            client.get('/1/celery/tasks?since=yesterday').status_code, 400
+        )
+
+    @db_context
+    def test_bulk_status(self):
+        self.add_installs()
+        client = self.app.test_client()
+
+        resp = json.loads(client.get(
+            '/1/celery/status?ids=task0,task1&ids=task2,unknown'
+        ).data)
+        self.assertEqual(resp['statuses'], {'task0': 'SUCCESS',
+                                            'task1': 'FAILURE',
+                                            'task2': 'RETRY',
+                                            'unknown': 'PENDING'})
+
+        resp = json.loads(client.post(
+            '/1/celery/status', data=json.dumps({'ids': ['task4', 'task5']}),
+            content_type='application/json'
+        ).data)
+        self.assertEqual(resp['statuses'], {'task4': 'FAILURE',
+                                            'task5': 'PENDING'})